@@ -0,0 +1,218 @@
+"""
+Benchmark suite for the settlement and estimation stages
+
+Every (stage, orders, brokers) case runs in a fresh subprocess, so its peak RSS is its own.
+Results go to a JSON file and are compared against a stored baseline:
+
+    python benchmarks/run.py                      # quick preset, compare with benchmarks/baseline.json
+    python benchmarks/run.py --preset nightly     # 10k / 1M orders, 100 / 3000 brokers
+    python benchmarks/run.py --preset full        # up to 10M orders and 30000 brokers
+    python benchmarks/run.py --stages netting eod_netting --orders 1000000 --brokers 3000
+    python benchmarks/run.py --save-baseline      # store this run as the new baseline
+
+Exits with status 1 when a case is slower (or uses more memory) than the baseline by more than
+--threshold, when a case errors or times out, or when a baseline case this run covers is missing
+from the results, so it can gate the nightly runs.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+RESULTS_PATH = os.path.join(HERE, "results.json")
+
+# a ratio over --threshold only counts as a regression when the change is also bigger than this,
+# so sub-millisecond cases don't flag on timer noise
+MIN_CHANGE = {"wall_s": 0.01, "peak_rss_mb": 10.0}
+
+PRESETS = {
+    "quick": {"orders": [10_000], "brokers": [100]},
+    "nightly": {"orders": [10_000, 1_000_000], "brokers": [100, 3000]},
+    "full": {"orders": [10_000, 1_000_000, 10_000_000], "brokers": [100, 3000, 30_000]},
+}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_case(stage, num_orders, num_brokers, seed=0, repeat=3):
+    """Run one case in this process; returns its result dict (best wall time of `repeat` runs)"""
+    from stages import STAGES
+
+    setup, _ = STAGES[stage]
+    start = time.perf_counter()
+    run, items = setup(num_orders, num_brokers, seed)
+    setup_s = time.perf_counter() - start
+    setup_rss = _peak_rss_mb()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    wall = min(times)
+    return {
+        "stage": stage, "orders": num_orders, "brokers": num_brokers,
+        "items": items,
+        "wall_s": wall,
+        "mean_s": sum(times) / len(times),
+        "throughput": items / wall if wall > 0 else None,
+        "setup_s": setup_s,
+        "setup_rss_mb": setup_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def case_key(result):
+    return f"{result['stage']}[orders={result['orders']},brokers={result['brokers']}]"
+
+
+def cases(stages, orders, brokers):
+    """(stage, orders, brokers) to run, each stage only over the size axes it uses"""
+    from stages import STAGES
+
+    for stage in stages:
+        _, axes = STAGES[stage]
+        for num_orders, num_brokers in itertools.product(
+            orders if "orders" in axes else [orders[0]], brokers if "brokers" in axes else [brokers[0]]
+        ):
+            yield stage, num_orders, num_brokers
+
+
+def _run_isolated(stage, num_orders, num_brokers, seed, repeat, timeout):
+    command = [sys.executable, os.path.abspath(__file__), "--case", stage, str(num_orders), str(num_brokers),
+               "--seed", str(seed), "--repeat", str(repeat)]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"stage": stage, "orders": num_orders, "brokers": num_brokers, "error": f"timed out after {timeout}s"}
+    if completed.returncode != 0:
+        return {"stage": stage, "orders": num_orders, "brokers": num_brokers,
+                "error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """Cases whose wall time or peak RSS grew by more than threshold (a ratio) against the baseline"""
+    previous = {case_key(result): result for result in baseline.get("results", []) if "error" not in result}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None or "error" in result:
+            continue
+        for metric in ("wall_s", "peak_rss_mb"):
+            ratio = result[metric] / before[metric] if before[metric] else None
+            result[f"{metric}_vs_baseline"] = ratio
+            if ratio is not None and ratio > threshold and result[metric] - before[metric] > MIN_CHANGE[metric]:
+                regressions.append((case_key(result), metric, before[metric], result[metric], ratio))
+    return regressions
+
+
+def missing_cases(results, baseline, stages=None, orders=None, brokers=None):
+    """
+    Baseline cases within this run's selection that have no result, e.g. a stage renamed or dropped
+
+    stages, orders, brokers narrow the selection (None for all), so running a subset of the
+    suite doesn't count the rest of the baseline as missing.
+    """
+    ran = {case_key(result) for result in results}
+    return [
+        case_key(before) for before in baseline.get("results", [])
+        if case_key(before) not in ran
+        and (stages is None or before["stage"] in stages)
+        and (orders is None or before["orders"] in orders)
+        and (brokers is None or before["brokers"] in brokers)
+    ]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--stages", nargs="+", default=None, help="stages to run (default: all)")
+    parser.add_argument("--orders", type=int, nargs="+", default=None, help="order counts (overrides the preset)")
+    parser.add_argument("--brokers", type=int, nargs="+", default=None, help="broker counts (overrides the preset)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best one is kept")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds before a case is abandoned")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio that counts as a regression")
+    parser.add_argument("--case", nargs=3, metavar=("STAGE", "ORDERS", "BROKERS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # child process: one case, result as the last line of stdout
+        stage, num_orders, num_brokers = args.case
+        print(json.dumps(run_case(stage, int(num_orders), int(num_brokers), args.seed, args.repeat)))
+        return 0
+
+    from stages import STAGES
+
+    stages = args.stages or list(STAGES)
+    orders = args.orders or PRESETS[args.preset]["orders"]
+    brokers = args.brokers or PRESETS[args.preset]["brokers"]
+
+    results = []
+    for stage, num_orders, num_brokers in cases(stages, orders, brokers):
+        result = _run_isolated(stage, num_orders, num_brokers, args.seed, args.repeat, args.timeout)
+        results.append(result)
+        if "error" in result:
+            print(f"{case_key(result):<55} ERROR {result['error']}")
+        else:
+            print(f"{case_key(result):<55} {result['wall_s']:>9.4f}s {result['throughput']:>14,.0f}/s "
+                  f"{result['peak_rss_mb']:>9.1f} MB")
+
+    regressions, missing = [], []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        missing = missing_cases(results, baseline, args.stages, orders, brokers)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+
+    for key, metric, before, after, ratio in regressions:
+        print(f"REGRESSION {key} {metric}: {before:.4g} -> {after:.4g} ({ratio:.2f}x)")
+    for key in missing:
+        print(f"MISSING {key}: in the baseline but not run")
+    errors = [result for result in results if "error" in result]
+    if errors:
+        print(f"{len(errors)} case(s) errored or timed out")
+    return 1 if regressions or missing or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import polars as pl
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "settlement_det"))
+sys.path.append(os.path.join(ROOT, "ir-estimation"))
+sys.path.append(os.path.join(ROOT, "matchingengine"))
+
+from broker import Broker, BrokerPool
+from mbo import load_mbo
+from mbo_store import MBOStore, convert_mbo
+from mm_filter import MarketMakerClassifier
+from simulation import simulate_brokers
+from synthetic import SyntheticMBO
+
+# per-event netting_algorithm is benchmarked on at most this many orders, it's ~1000x slower than net_slots
+MAX_PER_EVENT = 20_000
+
+DAY = np.datetime64("2024-12-06T00:00:00", "ns").astype(np.int64)
+NS_PER_HOUR = 3600 * 10**9
+
+
+def synthetic_orders(num_orders: int, seed: int = 0) -> pl.DataFrame:
+    """Preprocessed-looking orders (ts_event, side, price, size) spread over the 14:00-22:00 UTC session"""
+    rng = np.random.default_rng(seed)
+    ts = np.sort(DAY + 14 * NS_PER_HOUR + rng.integers(0, 8 * NS_PER_HOUR, num_orders))
+    return pl.DataFrame({
+        "ts_event": pl.Series(ts).cast(pl.Datetime("ns", "UTC")),
+        "side": np.where(rng.random(num_orders) < 0.5, "A", "B"),
+        "price": rng.normal(170, 2, num_orders),
+        "size": rng.integers(1, 500, num_orders),
+    })
+
+
+def synthetic_mbo(path, num_orders: int, seed: int = 0):
+    """Raw databento-shaped MBO day with about num_orders events at path, streamed by SyntheticMBO"""
+    SyntheticMBO(rows=num_orders, date="2024-12-06", instruments=(1, 2, 3), seed=seed,
+                 chunk_rows=min(num_orders, 1_000_000)).write(path)
+
+
+# Each stage does its setup and returns (run, items): run() is the timed part, items is what
+# throughput is counted in. The sizes a stage doesn't use are ignored.
+
+def netting(num_orders, num_brokers, seed):
+    """simulate_brokers in-process: shuffle, split and Broker.net_slots for every broker"""
+    df = synthetic_orders(num_orders, seed)
+    return lambda: simulate_brokers(df, num_brokers, workers=1, seed=seed), num_orders
+
+
+def netting_algorithm(num_orders, num_brokers, seed):
+    """The per-event Broker.netting_algorithm, on at most MAX_PER_EVENT single-row frames"""
+    df = synthetic_orders(min(num_orders, MAX_PER_EVENT), seed)
+    events = [df.slice(i, 1) for i in range(len(df))]
+
+    def run():
+        broker = Broker(client_orders=None, seed=seed)
+        for event in events:
+            broker.netting_algorithm(event)
+        broker.save_rng()
+
+    return run, len(events)
+
+
+def eod_netting(num_orders, num_brokers, seed):
+    """BrokerPool.eod_netting over every broker's orders"""
+    df = synthetic_orders(num_orders, seed).with_columns(
+        broker_id=np.random.default_rng(seed).integers(0, num_brokers, num_orders)
+    )
+    pool = BrokerPool(num_brokers)
+    return lambda: pool.eod_netting(df), num_orders
+
+
+def preprocessing(num_orders, num_brokers, seed):
+    """load_mbo of a parquet MBO file, MM classification and exclusion, price filter"""
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    path = os.path.join(directory, "mbo.parquet")
+    synthetic_mbo(path, num_orders, seed)
+
+    def run():
+        df = load_mbo(path, date="2024-12-06")
+        classifier = MarketMakerClassifier.from_orders(df)
+        filtered = classifier.exclude(df, cancel_threshold=0.8, modify_threshold=0.8)
+        return filtered.filter(pl.col("price") < 1e6)
+
+    return run, num_orders
+
+
+def store_preprocessing(num_orders, num_brokers, seed):
+    """preprocessing from the memory-mapped MBO store: open the day, MM classification and exclusion, price filter"""
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    path = os.path.join(directory, "mbo.parquet")
+    synthetic_mbo(path, num_orders, seed)
+    convert_mbo(path, os.path.join(directory, "store"))
+
+    def run():
+        day = MBOStore(os.path.join(directory, "store")).open("2024-12-06")
+        classifier = MarketMakerClassifier(day.action_counts())
+        return day.order_columns(exclude_ids=classifier.market_maker_ids(0.8, 0.8), max_price=1e6)
+
+    return run, num_orders
+
+
+def book_replay(num_orders, num_brokers, seed):
+    """BookReplay of a synthetic MBO day, top of book after every event"""
+    from orderbook import BookReplay
+
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    path = os.path.join(directory, "mbo.parquet")
+    synthetic_mbo(path, num_orders, seed)
+    df = load_mbo(path, date="2024-12-06", columns=["ts_event", "action", "side", "price", "size", "order_id",
+                                                     "instrument_id"])
+    return lambda: BookReplay().update(df), len(df)
+
+
+def estimate_parameters(num_orders, num_brokers, seed):
+    """params.estimate_parameters on one series of num_orders (r, Q) observations"""
+    import params
+
+    rng = np.random.default_rng(seed)
+    r = np.sort(rng.uniform(0.01, 0.1, num_orders))
+    Q = 1000 * np.exp(-10 * r) + rng.normal(0, 50, num_orders)
+    return lambda: params.estimate_parameters(r, Q), num_orders
+
+
+def fit_curves(num_orders, num_brokers, seed):
+    """params.fit_curves on num_brokers series of 100 observations each"""
+    import params
+
+    rng = np.random.default_rng(seed)
+    r = np.linspace(0.01, 0.1, 100)
+    a, ed = rng.uniform(500, 2000, num_brokers), rng.uniform(1, 30, num_brokers)
+    Q = a[:, None] * np.exp(-ed[:, None] * r) + rng.normal(0, 50, (num_brokers, 100))
+    return lambda: params.fit_curves(r, Q), num_brokers
+
+
+def ir_estim(num_orders, num_brokers, seed):
+    """ir_estim fit (sufficient statistics + BFGS) on num_orders rate/volume observations"""
+    import ir_estim
+
+    rng = np.random.default_rng(seed)
+    r = rng.normal(4.6, 0.3, num_orders)
+    Q = rng.normal(0, 100, num_orders)
+    return lambda: ir_estim.fit(ir_estim.sufficient_stats(r, Q)), num_orders
+
+
+# stage name -> (setup function, size axes it uses)
+STAGES = {
+    "netting": (netting, ("orders", "brokers")),
+    "netting_algorithm": (netting_algorithm, ("orders",)),
+    "eod_netting": (eod_netting, ("orders", "brokers")),
+    "preprocessing": (preprocessing, ("orders",)),
+    "store_preprocessing": (store_preprocessing, ("orders",)),
+    "book_replay": (book_replay, ("orders",)),
+    "estimate_parameters": (estimate_parameters, ("orders",)),
+    "fit_curves": (fit_curves, ("brokers",)),
+    "ir_estim": (ir_estim, ("orders",)),
+}
@@ -1,60 +1,184 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
 from scipy.optimize import minimize
 
-# Objective function
-def objective(params, r_obs, Q_obs):
-    a_s, b_s, a_d, b_d = params
+PARAM_NAMES = ("a_s", "b_s", "a_d", "b_d")
+
+# Initial parameter guesses
+INITIAL_GUESS = [1, 1.5, 1, -1.5]  # Replace with reasonable initial guesses
+
+
+def sufficient_stats(r_obs, Q_obs, counts=None):
+    """
+    [n, sum r, sum r^2, sum Q, sum Q^2] - all the objective needs, since r_pred and Q_pred are constants
+
+    Parameters:
+    - r_obs, Q_obs: observed rates and volumes
+    - counts: optional (resamples, n) matrix of how often each observation is drawn, which gives
+      the statistics of every resample in one matrix product
+
+    Returns: shape (5,), or (resamples, 5) with counts
+    """
+    columns = np.column_stack([np.ones(len(r_obs)), r_obs, r_obs ** 2, Q_obs, Q_obs ** 2])
+    return columns.sum(axis=0) if counts is None else counts @ columns
+
 
-    # Calculate predicted r and Q for all time periods
+def objective_from_stats(params, stats):
+    """Sum of squared r and Q errors from sufficient_stats, vectorized: params (..., 4) against stats (..., 5)"""
+    params, stats = np.asarray(params, dtype=np.float64), np.asarray(stats, dtype=np.float64)
+    a_s, b_s, a_d, b_d = np.moveaxis(params, -1, 0)
+    n, sum_r, sum_r2, sum_Q, sum_Q2 = np.moveaxis(stats, -1, 0)
     r_pred = (a_d - a_s) / (b_s - b_d)
     Q_pred = a_s + b_s * r_pred
+    return (n * r_pred ** 2 - 2 * r_pred * sum_r + sum_r2) + (n * Q_pred ** 2 - 2 * Q_pred * sum_Q + sum_Q2)
 
-    # Compute errors
-    error_r = np.sum((r_pred - r_obs) ** 2)  # Sum of squared errors for r
-    error_Q = np.sum((Q_pred - Q_obs) ** 2)  # Sum of squared errors for Q
 
-    return error_r + error_Q
+def gradient_from_stats(params, stats):
+    """Analytic gradient of objective_from_stats with respect to [a_s, b_s, a_d, b_d]"""
+    params, stats = np.asarray(params, dtype=np.float64), np.asarray(stats, dtype=np.float64)
+    a_s, b_s, a_d, b_d = np.moveaxis(params, -1, 0)
+    n, sum_r, sum_r2, sum_Q, sum_Q2 = np.moveaxis(stats, -1, 0)
+    slope_gap = b_s - b_d
+    r_pred = (a_d - a_s) / slope_gap
+    Q_pred = a_s + b_s * r_pred
 
-# Observed data (example)
-# Replace with your actual data
-import pandas as pd
+    d_r = 2 * (n * r_pred - sum_r)
+    d_Q = 2 * (n * Q_pred - sum_Q)
+    # partial derivatives of r_pred with respect to a_s, b_s, a_d, b_d
+    r_grad = np.stack([-1 / slope_gap, -r_pred / slope_gap, 1 / slope_gap, r_pred / slope_gap], axis=-1)
+    Q_grad = b_s[..., None] * r_grad
+    Q_grad[..., 0] += 1
+    Q_grad[..., 1] += r_pred
+    return d_r[..., None] * r_grad + d_Q[..., None] * Q_grad
 
-df = pd.read_csv('ir-estimation/repostats.csv')
-df = df.dropna()
 
-# Stationarize Q (volume) if needed
-df['Volume_bil_diff'] = df['Volume_bil'].diff().dropna()
-df['Volume_bil_diff'] = df['Volume_bil_diff'] - df['Volume_bil_diff'].mean()
-df = df.dropna()
+def fit(stats, x0=INITIAL_GUESS):
+    """BFGS fit of [a_s, b_s, a_d, b_d] to one set of sufficient statistics"""
+    result = minimize(objective_from_stats, x0, args=(stats,), jac=gradient_from_stats, method='BFGS')
+    return result.x
 
-# Observed values
-r_obs = df['Rate (%)'].values
-Q_obs = df['Volume_bil_diff'].values
 
-# Initial parameter guesses
-initial_guess = [1, 1.5, 1, -1.5]  # Replace with reasonable initial guesses
-
-# Optimization
-result = minimize(
-    objective,
-    initial_guess,
-    args=(r_obs, Q_obs),
-    method='BFGS'
-)
-
-# Extract optimized parameters
-a_s_opt, b_s_opt, a_d_opt, b_d_opt = result.x
-print("Optimized parameters:")
-print(f"a_s = {a_s_opt}, b_s = {b_s_opt}, a_d = {a_d_opt}, b_d = {b_d_opt}")
-
-# Predicted values for r and Q
-r_pred = (a_d_opt - a_s_opt) / (b_s_opt - b_d_opt)
-Q_pred = a_s_opt + b_s_opt * r_pred
-
-# Residuals
-residuals_r = r_obs - r_pred
-residuals_Q = Q_obs - Q_pred
-
-# Print residuals
-print("Residuals for r:", residuals_r)
-print("Residuals for Q:", residuals_Q)
+def load_repostats(path='ir-estimation/repostats.csv'):
+    """Observed rates and (stationarized) volumes from repostats.csv"""
+    df = pd.read_csv(path)
+    df = df.dropna()
+
+    # Stationarize Q (volume) if needed
+    df['Volume_bil_diff'] = df['Volume_bil'].diff().dropna()
+    df['Volume_bil_diff'] = df['Volume_bil_diff'] - df['Volume_bil_diff'].mean()
+    df = df.dropna()
+
+    # Observed values
+    return df['Rate (%)'].values, df['Volume_bil_diff'].values
+
+
+def resample_counts(num_obs, replications, rng, block=None):
+    """
+    How often each observation is drawn in every resample, shape (replications, num_obs)
+
+    iid bootstrap by default. With block, a moving-block bootstrap: each resample glues together
+    randomly placed runs of `block` consecutive observations (cut to num_obs), which keeps the
+    autocorrelation of the rate / volume series within a block.
+    """
+    if block is None or block <= 1:
+        draws = rng.integers(0, num_obs, size=(replications, num_obs))
+    else:
+        block = min(block, num_obs)
+        num_blocks = -(-num_obs // block)
+        starts = rng.integers(0, num_obs - block + 1, size=(replications, num_blocks))
+        draws = (starts[:, :, None] + np.arange(block)).reshape(replications, -1)[:, :num_obs]
+    rows = np.arange(replications)[:, None] * num_obs
+    return np.bincount((rows + draws).ravel(), minlength=replications * num_obs).reshape(replications, num_obs)
+
+
+def _fit_batch(stats, x0):
+    # worker side of bootstrap: one warm-started fit per resample
+    return np.array([fit(row, x0) for row in stats])
+
+
+def bootstrap(r_obs, Q_obs, replications=2000, block=None, seed=None, workers=None, level=0.95, batch=250):
+    """
+    Bootstrap percentile intervals for a_s, b_s, a_d, b_d
+
+    Parameters:
+    - r_obs, Q_obs: observed rates and volumes
+    - replications: number of bootstrap resamples
+    - block: block length for the moving-block bootstrap, None for iid resampling
+    - seed: seed for the resampling
+    - workers: number of worker processes (defaults to the number of cores, 1 runs in-process)
+    - level: coverage of the percentile intervals
+    - batch: resamples per task
+
+    Every resample is reduced to its sufficient statistics in one matrix product, and each fit
+    starts from the full-sample solution. Only a combination of the four parameters is
+    identified by the objective (r_pred and Q_pred are constants), so the warm start also keeps
+    each resample's fit on the same branch as the full-sample one.
+
+    Returns: (full-sample estimate (4,), bootstrap estimates (replications, 4),
+    {name: (lower, upper)})
+    """
+    full = fit(sufficient_stats(r_obs, Q_obs))
+    rng = np.random.default_rng(seed)
+    stats = sufficient_stats(r_obs, Q_obs, resample_counts(len(r_obs), replications, rng, block))
+    batches = [stats[start:start + batch] for start in range(0, replications, batch)]
+
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        estimates = np.vstack([_fit_batch(part, full) for part in batches])
+    else:
+        # numpy / scipy only, so fork where possible, like the settlement simulation's pool
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            estimates = np.vstack(list(pool.map(_fit_batch, batches, [full] * len(batches))))
+
+    tail = (1 - level) / 2 * 100
+    lower, upper = np.percentile(estimates, [tail, 100 - tail], axis=0)
+    intervals = {name: (lower[i], upper[i]) for i, name in enumerate(PARAM_NAMES)}
+    return full, estimates, intervals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supply/demand fit of repo rates and volumes")
+    parser.add_argument("--data", default='ir-estimation/repostats.csv')
+    parser.add_argument("--bootstrap", type=int, default=0, help="number of bootstrap resamples (0 skips it)")
+    parser.add_argument("--block", type=int, default=None, help="block length for a block bootstrap")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    r_obs, Q_obs = load_repostats(args.data)
+
+    # Optimization (same objective, from its sufficient statistics with the analytic gradient)
+    a_s_opt, b_s_opt, a_d_opt, b_d_opt = fit(sufficient_stats(r_obs, Q_obs))
+    print("Optimized parameters:")
+    print(f"a_s = {a_s_opt}, b_s = {b_s_opt}, a_d = {a_d_opt}, b_d = {b_d_opt}")
+
+    # Predicted values for r and Q
+    r_pred = (a_d_opt - a_s_opt) / (b_s_opt - b_d_opt)
+    Q_pred = a_s_opt + b_s_opt * r_pred
+
+    # Residuals
+    residuals_r = r_obs - r_pred
+    residuals_Q = Q_obs - Q_pred
+
+    # Print residuals
+    print("Residuals for r:", residuals_r)
+    print("Residuals for Q:", residuals_Q)
+
+    if args.bootstrap:
+        kind = f"block bootstrap (block={args.block})" if args.block else "iid bootstrap"
+        _, _, intervals = bootstrap(r_obs, Q_obs, args.bootstrap, block=args.block, seed=args.seed,
+                                    workers=args.workers)
+        print(f"95% percentile intervals, {args.bootstrap}-resample {kind}:")
+        for name, (lower, upper) in intervals.items():
+            print(f"{name}: [{lower}, {upper}]")
+
+
+if __name__ == "__main__":
+    main()
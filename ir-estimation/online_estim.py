@@ -0,0 +1,83 @@
+import numpy as np
+
+from ir_estim import INITIAL_GUESS, fit, objective_from_stats, sufficient_stats
+
+
+def _through(intercept, slope, r_mean, Q_mean):
+    # smallest change to (intercept, slope) that puts the line Q = intercept + slope * r through (r_mean, Q_mean)
+    shift = (Q_mean - intercept - slope * r_mean) / (1 + r_mean ** 2)
+    return intercept + shift, slope + shift * r_mean
+
+
+class OnlineSupplyDemand():
+    """
+    Recursive estimate of the supply/demand lines a_s + b_s * r and a_d + b_d * r for the rate engine
+
+    The ir_estim objective only depends on the sufficient statistics [n, sum r, sum r^2, sum Q,
+    sum Q^2], so each observation is an O(1) update of five numbers, optionally exponentially
+    forgotten. The objective is minimised by any pair of lines that cross at the (weighted) mean
+    rate and volume, so current_params moves the previous lines the least possible distance onto
+    that point instead of refitting: exact, constant time, and it keeps the slopes from the
+    batch fit (only a combination of the four parameters is identified by the data).
+
+    Parameters:
+    - params: starting [a_s, b_s, a_d, b_d], e.g. ir_estim's full-sample fit
+    - forgetting: per-observation forgetting factor (1.0 keeps every observation with equal weight)
+    """
+
+    def __init__(self, params=INITIAL_GUESS, forgetting: float = 1.0):
+        self.forgetting = forgetting
+        self.stats = np.zeros(5)
+        self.params = np.array(params, dtype=np.float64)
+        self._current = None
+
+    @classmethod
+    def from_history(cls, r_obs, Q_obs, forgetting: float = 1.0):
+        """Start from a batch fit over past observations, which are then kept as the initial statistics"""
+        estimator = cls(fit(sufficient_stats(r_obs, Q_obs)), forgetting)
+        estimator.update(r_obs, Q_obs)
+        return estimator
+
+    def update(self, r, Q):
+        """Add one observation (scalars) or a small batch (arrays, oldest first)"""
+        r = np.atleast_1d(np.asarray(r, dtype=np.float64))
+        Q = np.atleast_1d(np.asarray(Q, dtype=np.float64))
+        if len(r) == 0:
+            return
+        if self.forgetting != 1.0:
+            # observation i is len(r) - 1 - i steps old once the whole batch is in
+            weights = self.forgetting ** np.arange(len(r) - 1, -1, -1)
+            self.stats *= self.forgetting ** len(r)
+        else:
+            weights = np.ones(len(r))
+        self.stats += weights @ np.column_stack([np.ones(len(r)), r, r ** 2, Q, Q ** 2])
+        self._current = None
+
+    @property
+    def weight(self):
+        # effective number of observations
+        return self.stats[0]
+
+    def means(self):
+        """(weighted mean rate, weighted mean volume) the fitted lines cross at"""
+        return self.stats[1] / self.stats[0], self.stats[3] / self.stats[0]
+
+    def current_params(self):
+        """Current (a_s, b_s, a_d, b_d), cached until the next update"""
+        if self._current is None:
+            if self.weight > 0:
+                r_mean, Q_mean = self.means()
+                a_s, b_s, a_d, b_d = self.params
+                self.params = np.array([*_through(a_s, b_s, r_mean, Q_mean), *_through(a_d, b_d, r_mean, Q_mean)])
+            self._current = tuple(self.params.tolist())
+        return self._current
+
+    def objective(self):
+        """ir_estim objective of the current parameters over the (weighted) observations"""
+        return float(objective_from_stats(self.current_params(), self.stats))
+
+    def refit(self):
+        """Full BFGS refit on the current statistics, warm-started from the current parameters"""
+        self.params = fit(self.stats, self.current_params())
+        self._current = None
+        return self.current_params()
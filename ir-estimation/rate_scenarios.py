@@ -0,0 +1,179 @@
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from ir_estim import fit, load_repostats, sufficient_stats
+
+# dynamic-ir/Program.cs: its hand-tuned supply/demand lines and run
+PROGRAM_PARAMS = (-1.2, 0.65, 7.0, -0.79)
+ADJUSTMENT_GAIN = 0.001  # r_mm += gain * netEffect
+SPREAD = 0.2  # lender rate r_mm + spread, borrower rate r_mm - spread
+EVENT_THRESHOLD = 0.001  # supply / demand changes below this don't move the states
+
+
+def scenario_grid(scaling=(500.0,), gain=(ADJUSTMENT_GAIN,), spread=(SPREAD,), initial_rate=(5.0,)):
+    """Every combination of the given values, as flat arrays (scaling, gain, spread, initial_rate)"""
+    combos = np.array(list(itertools.product(scaling, gain, spread, initial_rate)), dtype=np.float64)
+    return tuple(combos.T)
+
+
+def sweep(params, scaling, gain, spread, initial_rate, steps: int = 1000, shift: float = 1.0,
+          shift_step: int = 5, rate_tol: float = 1e-6, state_tol: float = EVENT_THRESHOLD,
+          max_rate: float = 1e3, initial_scaling: float = 1.0):
+    """
+    Run Program.cs's rate-adjustment loop for many scenarios at once
+
+    Each scenario is one lane of a set of numpy arrays advanced in lockstep. Every step, supply
+    k * (a_s + b_s * r_l) and demand k * (a_d + b_d * r_b) are compared with their states, the
+    mid-market rate moves by gain * (demand change - supply change), and each state moves halfway
+    to its new value when that change is bigger than EVENT_THRESHOLD. At shift_step a_d goes up
+    by shift (ApplyOneTimeShift).
+
+    The starting states are supply and demand at the initial rate with initial_scaling as k:
+    Program.cs builds its engine at the default ScalingFactor of 1.0 and only then sets 500, so
+    its loop starts well away from the scaled curves. With initial_scaling=None the states start
+    on each lane's own scaled curves, at rest, and only the shift moves them.
+
+    After the shift, a lane whose rate adjustment is below rate_tol and whose supply and demand
+    changes are below state_tol has converged. Converged lanes (and diverged ones, whose rate
+    leaves +-max_rate) are dropped from the arrays, so later steps only cost what is still moving.
+
+    Parameters:
+    - params: [a_s, b_s, a_d, b_d], e.g. ir_estim's fit, shape (4,) or one row per scenario
+    - scaling, gain, spread, initial_rate: per-scenario arrays (see scenario_grid), or scalars
+    - steps: most steps to run a lane for
+    - shift, shift_step: one-time demand shift and the step (1-based) it's applied at
+    - initial_scaling: k the starting states are computed with (Program.cs: 1.0), None for each lane's scaling
+
+    Returns: DataFrame with one row per scenario - its settings, converged / diverged, the
+    convergence step (-1 if never), final rates and states, reversals (times the rate changed
+    direction), overshoot (how far the rate went past the range between its start and final
+    value), profit (final per-step (r_l - r_b) / 100 * min(supply, demand)) and total_profit
+    (summed over all steps)
+    """
+    scaling, gain, spread, initial_rate = np.broadcast_arrays(
+        *(np.asarray(values, dtype=np.float64) for values in (scaling, gain, spread, initial_rate))
+    )
+    num = scaling.size
+    scaling, gain, spread, initial_rate = (values.ravel() for values in (scaling, gain, spread, initial_rate))
+    a_s, b_s, a_d, b_d = (np.broadcast_to(column, num).copy()
+                          for column in np.asarray(params, dtype=np.float64).reshape(-1, 4).T)
+
+    # results, written when a lane finishes
+    final = {name: np.full(num, np.nan) for name in ("rate", "supply", "demand", "profit", "total_profit", "overshoot")}
+    converged_at = np.full(num, -1)
+    diverged = np.zeros(num, dtype=bool)
+    reversals = np.zeros(num, dtype=np.int64)
+
+    # lane state, compacted to the lanes still running
+    lane = np.arange(num)
+    rate = initial_rate.copy()
+    start = scaling if initial_scaling is None else np.full(num, float(initial_scaling))
+    supply = start * (a_s + b_s * (rate + spread))
+    demand = start * (a_d + b_d * (rate - spread))
+    rate_max, rate_min = rate.copy(), rate.copy()
+    direction = np.zeros(num)
+    reversal_count = np.zeros(num, dtype=np.int64)
+    total_profit = np.zeros(num)
+    k, g, s, r0 = scaling, gain, spread, initial_rate
+
+    def finish(done, step):
+        index = lane[done]
+        end = rate[done]
+        final["rate"][index] = end
+        final["supply"][index] = supply[done]
+        final["demand"][index] = demand[done]
+        final["profit"][index] = 2 * s[done] / 100 * np.minimum(supply[done], demand[done])
+        # a converged lane keeps earning its final profit, a diverged one stops counting
+        final["total_profit"][index] = total_profit[done] + np.where(diverged[index], 0, steps - step) * final["profit"][index]
+        final["overshoot"][index] = np.maximum.reduce([
+            rate_max[done] - np.maximum(r0[done], end), np.minimum(r0[done], end) - rate_min[done], np.zeros(len(end)),
+        ])
+        reversals[index] = reversal_count[done]
+
+    for step in range(1, steps + 1):
+        # profit as PrintStatus reports it, before this step's response
+        total_profit += 2 * s / 100 * np.minimum(supply, demand)
+        if step == shift_step:
+            a_d += shift
+
+        supply_change = k * (a_s + b_s * (rate + s)) - supply
+        demand_change = k * (a_d + b_d * (rate - s)) - demand
+        adjustment = g * (demand_change - supply_change)
+        rate += adjustment
+        supply += np.where(np.abs(supply_change) > EVENT_THRESHOLD, supply_change / 2, 0)
+        demand += np.where(np.abs(demand_change) > EVENT_THRESHOLD, demand_change / 2, 0)
+
+        np.maximum(rate_max, rate, out=rate_max)
+        np.minimum(rate_min, rate, out=rate_min)
+        sign = np.sign(adjustment)
+        reversal_count += (sign != 0) & (direction != 0) & (sign != direction)
+        direction = np.where(sign != 0, sign, direction)
+
+        blown = ~np.isfinite(rate) | (np.abs(rate) > max_rate)
+        settled = (
+            (np.abs(adjustment) < rate_tol) & (np.abs(supply_change) < state_tol) & (np.abs(demand_change) < state_tol)
+        )
+        done = blown | (settled & (step >= shift_step))
+        if done.any():
+            diverged[lane[blown]] = True
+            converged_at[lane[done & ~blown]] = step
+            finish(done, step)
+            keep = ~done
+            lane = lane[keep]
+            (rate, supply, demand, rate_max, rate_min, direction, total_profit, reversal_count,
+             k, g, s, r0, a_s, b_s, a_d, b_d) = (
+                values[keep] for values in (rate, supply, demand, rate_max, rate_min, direction, total_profit,
+                                            reversal_count, k, g, s, r0, a_s, b_s, a_d, b_d)
+            )
+            if len(lane) == 0:
+                break
+
+    if len(lane):
+        finish(np.ones(len(lane), dtype=bool), steps)
+
+    return pd.DataFrame({
+        "scaling": scaling, "gain": gain, "spread": spread, "initial_rate": initial_rate,
+        "converged": converged_at >= 0, "diverged": diverged, "convergence_step": converged_at,
+        "final_rate": final["rate"], "lender_rate": final["rate"] + spread, "borrower_rate": final["rate"] - spread,
+        "supply": final["supply"], "demand": final["demand"],
+        "reversals": reversals, "overshoot": final["overshoot"],
+        "profit": final["profit"], "total_profit": final["total_profit"],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scenario sweep of the dynamic interest-rate loop")
+    parser.add_argument("--data", default='ir-estimation/repostats.csv')
+    parser.add_argument("--program-params", action="store_true",
+                        help="use Program.cs's supply/demand lines instead of fitting repostats")
+    parser.add_argument("--scaling", type=float, nargs="+", default=[100.0, 250.0, 500.0, 1000.0])
+    parser.add_argument("--gain", type=float, nargs="+", default=list(np.geomspace(1e-4, 1e-2, 9)))
+    parser.add_argument("--spread", type=float, nargs="+", default=[0.1, 0.2, 0.3])
+    parser.add_argument("--initial-rate", type=float, nargs="+", default=[4.0, 5.0, 6.0])
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--shift", type=float, default=1.0)
+    parser.add_argument("--start-at-rest", action="store_true",
+                        help="start the states on the scaled curves instead of at ScalingFactor 1.0 like Program.cs")
+    parser.add_argument("--output", default="rate_scenarios.csv")
+    args = parser.parse_args()
+
+    if args.program_params:
+        params = PROGRAM_PARAMS
+    else:
+        params = fit(sufficient_stats(*load_repostats(args.data)))
+    print("a_s = {}, b_s = {}, a_d = {}, b_d = {}".format(*params))
+
+    grid = scenario_grid(args.scaling, args.gain, args.spread, args.initial_rate)
+    results = sweep(params, *grid, steps=args.steps, shift=args.shift,
+                    initial_scaling=None if args.start_at_rest else 1.0)
+    results.to_csv(args.output, index=False)
+    print(f"{len(results)} scenarios: {results['converged'].sum()} converged, {results['diverged'].sum()} diverged")
+    converged = results[results["converged"]]
+    print(converged.sort_values("total_profit", ascending=False).head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
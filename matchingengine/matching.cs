@@ -3,6 +3,8 @@ using System.Collections.Generic;
 using System.Linq;
 using System.IO;
 using System.Text.Json;
+using Apache.Arrow;
+using Apache.Arrow.Ipc;
 
 public class MatchingEngine
 {
@@ -168,6 +170,65 @@ public class MatchingEngine
         }
     }
 
+    public void LoadContractsFromArrow(string filePath)
+    {
+        // Arrow IPC file written by settlement_det/contracts.py: integer broker ids and settlement slots,
+        // dictionary-encoded order type, bucket labels in the schema metadata
+        using var stream = File.OpenRead(filePath);
+        using var reader = new ArrowFileReader(stream);
+
+        RecordBatch batch;
+        while ((batch = reader.ReadNextRecordBatch()) != null)
+        {
+            var labels = JsonSerializer.Deserialize<List<string>>(batch.Schema.Metadata["settlement_labels"])!;
+            var brokerIds = (UInt32Array)batch.Column("broker_id");
+            var slots = (UInt16Array)batch.Column("settlement_slot");
+            var orderTypes = (DictionaryArray)batch.Column("order_type");
+            var orderTypeCodes = (Int8Array)orderTypes.Indices;
+            var orderTypeNames = (StringArray)orderTypes.Dictionary;
+            var prices = (DoubleArray)batch.Column("price");
+            var quantities = (DoubleArray)batch.Column("quantity");
+
+            for (int i = 0; i < batch.Length; i++)
+            {
+                string hour = labels[slots.GetValue(i)!.Value];
+                string orderType = orderTypeNames.GetString(orderTypeCodes.GetValue(i)!.Value);
+
+                AddContract(new Contract
+                {
+                    Id = $"Broker_{brokerIds.GetValue(i)}_{orderType}_{hour}",
+                    SettlementHour = hour,
+                    Price = (decimal)prices.GetValue(i)!.Value,
+                    Quantity = (decimal)quantities.GetValue(i)!.Value,
+                    OrderType = orderType,
+                });
+            }
+        }
+    }
+
+    public void LoadContracts(string filePath)
+    {
+        // contracts.json is the old export, .arrow / .ipc / .feather the Arrow IPC one; a parquet export
+        // (contracts.py's other format) can't be read here, so it's rejected up front rather than
+        // failing inside the IPC reader
+        string extension = Path.GetExtension(filePath).ToLowerInvariant();
+        switch (extension)
+        {
+            case ".json":
+                LoadContractsFromJson(filePath);
+                break;
+            case ".arrow":
+            case ".ipc":
+            case ".feather":
+                LoadContractsFromArrow(filePath);
+                break;
+            default:
+                throw new ArgumentException(
+                    $"Unsupported contracts file {filePath}: export with settlement_det/contracts.py to .arrow (or .json)",
+                    nameof(filePath));
+        }
+    }
+
     public void PrintUnsettledContracts()
     {
         Console.WriteLine("Unsettled contracts by settlement hour:");
@@ -210,8 +271,8 @@ class Program
     {
         MatchingEngine engine = new MatchingEngine();
 
-        // Load contracts from the JSON file exported by Python
-        engine.LoadContractsFromJson("contracts.json");
+        // Load contracts exported by Python (settlement_det/setdet_forcs.py), contracts.arrow by default
+        engine.LoadContracts(args.Length > 0 ? args[0] : "contracts.arrow");
 
         // Settle all contracts
         decimal settlementFeePercentage = 0.000002m; // 0.0001%
@@ -12,126 +12,67 @@
 # let's take a close look 
 
 
+import os
+import sys
 import polars as pl
-import numpy as np
 
-df = pl.read_csv("/Users/samuelho/databento/DBEQ-20241209-UB4KFCCU7A/dbeq-basic-20241107-20241206.mbo.csv")
+# shared MBO loader lives with the settlement scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'settlement_det'))
+from mbo import MBO_COLUMNS, load_mbo
+from mm_filter import MarketMakerClassifier
+from mm_regression import MultiResolutionRegression
+from orderbook import BookReplay, relative_spread
 
+MBO_PATH = "/Users/samuelho/databento/DBEQ-20241209-UB4KFCCU7A/dbeq-basic-20241107-20241206.mbo.csv"
 
-df = df.filter(pl.col("ts_recv").str.starts_with("2024-12-02"))
 
 # STEP 1: PREPROCESSING
 
-df = df.select(['ts_event', 'side', 'price', 'size', 'action', 'order_id']) # select only relevant volumns
+# select only relevant columns, only bids and asks (idk what N is), price from fixed precision integer
+# to decimal and ts_event to a UTC datetime - all pushed into one lazy scan of the file, for one day only
+# (instrument_id too, every instrument has its own order book)
+df = load_mbo(MBO_PATH, date="2024-12-02", columns=MBO_COLUMNS + ["instrument_id"])
 
-df = df.filter(pl.col("side") != "N") # only filter for bids and asks (idk what N is)
+# Per-order add/cancel/modify counts are shared with the other scripts through a parquet cache
+classifier = MarketMakerClassifier.cached(df, "mm_action_counts_2024-12-02.parquet")
 
-
-df = df.with_columns((pl.col('price') * 1e-9).alias('price')) # convert from fixed precision integer to decimal
-
-df = df.with_columns(
-    pl.col("ts_event").str.to_datetime()
-) # convert to datetime, in UTC currently
-
-# Group by 'order_id' and count occurrences of each action
-action_counts = (
-    df.group_by("order_id")
-    .agg([
-        pl.col("action").filter(pl.col("action") == "A").count().alias("add_count"),
-        pl.col("action").filter(pl.col("action") == "C").count().alias("cancel_count"),
-        pl.col("action").filter(pl.col("action") == "M").count().alias("modify_count"),
-    ])
-)
-
-# Add cancel-to-add and modify-to-add ratios
-action_counts = action_counts.with_columns([
-    (pl.col("cancel_count") / pl.col("add_count")).alias("cancel_to_add_ratio"),
-    (pl.col("modify_count") / pl.col("add_count")).alias("modify_to_add_ratio"),
-])
-
-# Set thresholds for exclusion (e.g., 30% cancel-to-add or modify-to-add ratio)
-market_maker_order_ids = action_counts.filter(
-    (pl.col("cancel_to_add_ratio") > 0.3) | (pl.col("modify_to_add_ratio") > 0.3)
-).select("order_id")
-
-# Include only these order_ids from the original dataframe
-filtered_df = df.join(
-    market_maker_order_ids, on="order_id", how="inner"
-)
+# Include only market-maker order_ids (e.g., 30% cancel-to-add or modify-to-add ratio) from the original dataframe
+filtered_df = classifier.include(df, cancel_threshold=0.3, modify_threshold=0.3)
 
 # remove absurd quoted prices (those above 1e6)
 filtered_df = filtered_df.filter(pl.col("price") < 1e6)
 
 
 
-# NOW, take the original df, and on a minute by minute basis, group the bid/ask prices, find the highest bid and the lowest ask, calculate that as the spread, make a new column, 
+# NOW, take the original df and replay it into per-instrument order books (orderbook.py > BookReplay), which gives
+# the real best bid / best ask after every event, and how much the market makers flagged above have resting
 # side[str]: B for bid, A for ask
 # price[f64]
-# Calculate the spread on a minute-by-minute basis
 
 df = df.sort('ts_event')
 
-minute_grouped = df.group_by_dynamic(
-    "ts_event", every="1h", closed="right"
-).agg([
-    pl.col("price").filter(pl.col("side") == "B").mean().alias("max_bid"),
-    pl.col("price").filter(pl.col("side") == "A").mean().alias("min_ask"),
-    pl.col('price').mean().alias("midmarket_price")
-])
-
-# Calculate the spread
-minute_grouped = minute_grouped.with_columns(
-    ( (pl.col("min_ask") - pl.col("max_bid") ) / (pl.col("midmarket_price"))).alias("spread")
-)
+book = BookReplay(market_makers=classifier.market_maker_ids(cancel_threshold=0.3, modify_threshold=0.3))
+quotes = pl.concat([book.update(events) for events in df.iter_slices(1_000_000)])
 
-# Get rid of datetimes with any null
-minute_grouped = minute_grouped.drop_nulls()
-
-# Calculate cumulative quantity of orders put up by MMs
-qty = df.group_by_dynamic(
-    "ts_event", every="1h", closed="right"
-).agg([
-    (pl.when(pl.col("action") == "A").then(pl.col("size"))
-     .when(pl.col("action") == "C").then(-pl.col("size"))
-     .otherwise(0)).sum().alias("quantity_delta")
-])
-
-# add quantity_delta to its lag to get cumulative
-qty = qty.with_columns(
-    pl.col("quantity_delta").cum_sum().alias("cumulative_quantity")
+# spread relative to the midmarket price, and the change in the MMs' resting quantity on the event's instrument
+mm_quoted = pl.col("mm_bid_sz") + pl.col("mm_ask_sz")
+df = pl.concat([df, quotes], how="horizontal").with_columns(
+    relative_spread(),
+    mm_quoted.diff().fill_null(mm_quoted).over("instrument_id").alias("quantity_delta"),
 )
 
+# for every bar (1m, 5m, 15m and 1h at once) average the spread and add up the quantity change
+# mm_regression.py > MultiResolutionRegression does this in one pass over the time-sorted events and keeps
+# least-squares sufficient statistics per resolution, so new MBO data just updates the coefficients
+# (window=N fits the last N bars only, forgetting=0.99 down-weights older bars)
 
-# Join the spread and cumulative quantity dataframes
-result_df = minute_grouped.join(
-    qty, on="ts_event", how="inner"
-)
-
-# remove those ts_event outside of ET trading hours
-result_df = result_df.filter(
-    (pl.col("ts_event").dt.hour() >= 14) & (pl.col("ts_event").dt.hour() <= 22)
-)
-
-# regress cumulative_quantity against spread
-import statsmodels.api as sm
-# Prepare the data for regression
-X = result_df["spread"]
-y = result_df["quantity_delta"]
-
-# Add a constant to the independent variable
-#X = sm.add_constant(X)
-
-# Fit the regression model
-# Coerce to numpy arrays
-X = np.array(result_df["spread"])
-y = np.array(result_df["quantity_delta"])
-
-# Add a constant to the independent variable
-X = sm.add_constant(X)
-
-# Fit the regression model
-model = sm.OLS(y, X).fit()
+regression = MultiResolutionRegression(resolutions=("1m", "5m", "15m", "1h"), hours=(14, 22))
+for events in df.iter_slices(100_000):
+    regression.update(events)
+regression.flush()
 
-# Print the regression results
-print(model.summary())
+# per-resolution bars: spread, quantity_delta and cumulative_quantity (bars outside 14:00-22:59 UTC dropped)
+result_df = regression.bar_frame("1h")
 
+# regress quantity_delta against spread, one row per resolution
+print(regression.summary())
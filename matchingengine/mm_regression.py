@@ -0,0 +1,255 @@
+from collections import deque
+
+import numpy as np
+import polars as pl
+
+NS_PER_SECOND = 10**9
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# per-bar sums kept for every resolution, in this order
+BAR_STATS = ("bid_sum", "bid_count", "ask_sum", "ask_count", "price_sum", "price_count", "quantity_delta",
+             "spread_sum", "spread_count")
+
+
+def duration_ns(every: str) -> int:
+    # "1m", "15m", "1h", ... -> nanoseconds
+    return int(every[:-1]) * UNITS[every[-1]] * NS_PER_SECOND
+
+
+class RecursiveLeastSquares():
+    """
+    Least squares kept as sufficient statistics (X'X, X'y, y'y), updated one batch of rows at a time
+
+    Coefficients can be read off at any point without refitting. With forgetting < 1 older rows are
+    down-weighted geometrically (forgetting ** age); downdate removes rows again, which is what the
+    rolling-window variant uses. An intercept is expected as the first column of X.
+    """
+
+    def __init__(self, num_features: int, forgetting: float = 1.0):
+        self.forgetting = forgetting
+        self.xtx = np.zeros((num_features, num_features))
+        self.xty = np.zeros(num_features)
+        self.yty = 0.0
+        self.count = 0
+
+    def update(self, X, y):
+        """Add rows X (n, num_features) with targets y (n,), oldest row first"""
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if len(y) == 0:
+            return
+        if self.forgetting != 1.0:
+            # row i is len(y) - 1 - i steps old once the whole batch is in
+            weights = self.forgetting ** np.arange(len(y) - 1, -1, -1)
+            decay = self.forgetting ** len(y)
+            self.xtx *= decay
+            self.xty *= decay
+            self.yty *= decay
+        else:
+            weights = np.ones(len(y))
+        self.xtx += (X * weights[:, None]).T @ X
+        self.xty += (X * weights[:, None]).T @ y
+        self.yty += float(weights @ (y * y))
+        self.count += len(y)
+
+    def downdate(self, X, y):
+        """Remove rows previously added (only exact without forgetting)"""
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        self.xtx -= X.T @ X
+        self.xty -= X.T @ y
+        self.yty -= float(y @ y)
+        self.count -= len(y)
+
+    @property
+    def coef(self):
+        return np.linalg.lstsq(self.xtx, self.xty, rcond=None)[0]
+
+    @property
+    def weight(self):
+        # effective number of rows, the (intercept, intercept) entry of X'X
+        return self.xtx[0, 0]
+
+    def rss(self):
+        coef = self.coef
+        return max(self.yty - 2 * coef @ self.xty + coef @ self.xtx @ coef, 0.0)
+
+    def r_squared(self):
+        tss = self.yty - self.xty[0] ** 2 / self.weight if self.weight > 0 else 0.0
+        return 1 - self.rss() / tss if tss > 0 else np.nan
+
+    def standard_errors(self):
+        dof = self.weight - len(self.xty)
+        if dof <= 0:
+            return np.full(len(self.xty), np.nan)
+        return np.sqrt(np.diag(np.linalg.pinv(self.xtx)) * self.rss() / dof)
+
+
+class _BarAccumulator():
+    """
+    Sums BAR_STATS into right-closed bars (start, start + every] labelled by their start
+
+    Events arrive time-sorted, so only the last bar of a batch can still be open; it's carried
+    over and completed by the next batch.
+    """
+
+    def __init__(self, every_ns: int):
+        self.every_ns = every_ns
+        self.open_bar = None
+        self.open_sums = None
+
+    def add(self, ts_ns, stats):
+        """Fold in a batch of events; returns (bar start ns, sums) of the bars it closed"""
+        if len(ts_ns) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(BAR_STATS)))
+        bars = (ts_ns - 1) // self.every_ns
+        starts = np.flatnonzero(np.r_[True, bars[1:] != bars[:-1]])
+        bar_ids = bars[starts]
+        sums = np.add.reduceat(stats, starts, axis=0)
+
+        if self.open_bar is not None:
+            if bar_ids[0] == self.open_bar:
+                sums[0] += self.open_sums
+            else:
+                bar_ids = np.r_[self.open_bar, bar_ids]
+                sums = np.vstack([self.open_sums, sums])
+
+        self.open_bar, self.open_sums = bar_ids[-1], sums[-1].copy()
+        return bar_ids[:-1] * self.every_ns, sums[:-1]
+
+    def flush(self):
+        """Close the open bar (end of data)"""
+        if self.open_bar is None:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(BAR_STATS)))
+        bar_ids, sums = np.array([self.open_bar]), self.open_sums[None, :]
+        self.open_bar = self.open_sums = None
+        return bar_ids * self.every_ns, sums
+
+
+class MultiResolutionRegression():
+    """
+    Streaming regression of the MM quantity delta on the relative spread at several bar sizes at once
+
+    Every bar, per resolution: spread = (mean ask - mean bid) / mean price, and quantity_delta =
+    added size - cancelled size. Events that carry a "spread" column (e.g. the quoted spread from
+    orderbook.BookReplay) use the bar's mean of it instead, and a "quantity_delta" column replaces
+    the added - cancelled size. Bars without a spread are dropped, and only bars starting in
+    [hours[0], hours[1]] UTC are fitted. Each resolution keeps its own RecursiveLeastSquares for
+    quantity_delta ~ 1 + spread, so feeding more MBO data just updates the coefficients.
+
+    Parameters:
+    - resolutions: bar sizes like "1m", "5m", "15m", "1h"
+    - window: fit only the last `window` bars of each resolution (rolling variant), None for all
+    - forgetting: per-bar forgetting factor for exponentially weighted fits (1.0 is plain OLS)
+    - hours: inclusive range of bar start hours (UTC) that are fitted
+    """
+
+    def __init__(self, resolutions=("1m", "5m", "15m", "1h"), window: int = None, forgetting: float = 1.0,
+                 hours=(14, 22)):
+        if window is not None and forgetting != 1.0:
+            raise ValueError("use either a rolling window or a forgetting factor, not both")
+        self.resolutions = list(resolutions)
+        self.window = window
+        self.hours = hours
+        self.bars = {every: _BarAccumulator(duration_ns(every)) for every in self.resolutions}
+        self.models = {every: RecursiveLeastSquares(2, forgetting) for every in self.resolutions}
+        self.recent = {every: deque() for every in self.resolutions}
+        self.history = {every: [] for every in self.resolutions}
+        self.last_ts = None
+        self.quoted_spread = False  # set once events come with their own spread column
+
+    def update(self, df: pl.DataFrame):
+        """Feed the next time-sorted batch of MBO events (ts_event, side, price, action, size)"""
+        if len(df) == 0:
+            return
+        ts_ns = df["ts_event"].dt.cast_time_unit("ns").to_physical().to_numpy()
+        if np.any(np.diff(ts_ns) < 0) or (self.last_ts is not None and ts_ns[0] < self.last_ts):
+            raise ValueError("MBO events must be fed in ts_event order")
+        self.last_ts = ts_ns[-1]
+
+        is_bid = (df["side"] == "B").to_numpy()
+        is_ask = (df["side"] == "A").to_numpy()
+        price = df["price"].to_numpy().astype(np.float64)
+        size = df["size"].to_numpy().astype(np.float64)
+        action = df["action"]
+        signed_size = np.where((action == "A").to_numpy(), size, np.where((action == "C").to_numpy(), -size, 0.0))
+        if "quantity_delta" in df.columns:
+            signed_size = df["quantity_delta"].fill_null(0).to_numpy().astype(np.float64)
+        quoted = df["spread"].cast(pl.Float64).fill_null(np.nan).to_numpy() if "spread" in df.columns \
+            else np.full(len(df), np.nan)
+        has_quote = ~np.isnan(quoted)
+        self.quoted_spread = self.quoted_spread or "spread" in df.columns
+
+        stats = np.column_stack([
+            np.where(is_bid, price, 0.0), is_bid,
+            np.where(is_ask, price, 0.0), is_ask,
+            price, np.ones(len(price)),
+            signed_size,
+            np.where(has_quote, quoted, 0.0), has_quote,
+        ])
+        for every in self.resolutions:
+            self._fit(every, *self.bars[every].add(ts_ns, stats))
+
+    def flush(self):
+        """Close the last open bar of every resolution, once no more data is coming"""
+        for every in self.resolutions:
+            self._fit(every, *self.bars[every].flush())
+
+    def _fit(self, every, bar_starts, sums):
+        if len(bar_starts) == 0:
+            return
+        columns = dict(zip(BAR_STATS, sums.T))
+        hour = bar_starts // (3600 * NS_PER_SECOND) % 24
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.quoted_spread:
+                has_spread = columns["spread_count"] > 0
+                spread = columns["spread_sum"] / columns["spread_count"]
+            else:
+                has_spread = (columns["bid_count"] > 0) & (columns["ask_count"] > 0)
+                spread = (
+                    columns["ask_sum"] / columns["ask_count"] - columns["bid_sum"] / columns["bid_count"]
+                ) / (columns["price_sum"] / columns["price_count"])
+        keep = has_spread & (hour >= self.hours[0]) & (hour <= self.hours[1])
+        X = np.column_stack([np.ones(keep.sum()), spread[keep]])
+        y = columns["quantity_delta"][keep]
+        self.history[every].append((bar_starts[keep], spread[keep], y))
+
+        model = self.models[every]
+        if self.window is None:
+            model.update(X, y)
+            return
+        recent = self.recent[every]
+        for row, target in zip(X, y):
+            model.update(row, target)
+            recent.append((row, target))
+            if len(recent) > self.window:
+                model.downdate(*recent.popleft())
+
+    def bar_frame(self, every: str) -> pl.DataFrame:
+        """Fitted bars of one resolution: ts_event (bar start), spread, quantity_delta, cumulative_quantity"""
+        parts = self.history[every]
+        starts = np.concatenate([part[0] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+        spread = np.concatenate([part[1] for part in parts]) if parts else np.empty(0)
+        delta = np.concatenate([part[2] for part in parts]) if parts else np.empty(0)
+        return pl.DataFrame({
+            "ts_event": pl.Series(starts).cast(pl.Datetime("ns", "UTC")),
+            "spread": spread,
+            "quantity_delta": delta,
+            "cumulative_quantity": np.cumsum(delta),
+        })
+
+    def summary(self) -> pl.DataFrame:
+        """One row per resolution: bars fitted, intercept, slope on spread, their standard errors, R^2"""
+        rows = []
+        for every in self.resolutions:
+            model = self.models[every]
+            coef = model.coef if model.count else np.full(2, np.nan)
+            stderr = model.standard_errors() if model.count else np.full(2, np.nan)
+            rows.append({
+                "resolution": every,
+                "bars": model.count,
+                "const": coef[0], "spread": coef[1],
+                "const_se": stderr[0], "spread_se": stderr[1],
+                "r_squared": model.r_squared() if model.count else np.nan,
+            })
+        return pl.DataFrame(rows)
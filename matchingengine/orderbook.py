@@ -0,0 +1,511 @@
+from bisect import bisect_left, insort
+
+import numpy as np
+import polars as pl
+
+from mm_regression import duration_ns
+
+# order actions that change the book; trades (T) don't, the resting side gets its own fill (F)
+RESETS = ("A", "M")     # order now rests at (side, price) with size
+REDUCTIONS = ("C", "F") # size comes off the resting order
+
+
+class _Timeline():
+    """
+    Rows sorted by (group, event), searched for the last row of a group at or before an event
+
+    Events start at -1 (state carried into the batch). Queries are fastest sorted by (group, event) too.
+    """
+
+    def __init__(self, group, event, num_events):
+        self.group = group
+        self.stride = num_events + 1
+        self.keys = group * self.stride + (event + 1)
+
+    def last_rows(self, query_group, query_event):
+        """Row index per query, -1 where the group has no row at or before the event"""
+        pos = np.searchsorted(self.keys, query_group * self.stride + (query_event + 1), side="right") - 1
+        found = pos >= 0
+        found[found] = self.group[pos[found]] == query_group[found]
+        return np.where(found, pos, -1)
+
+
+def _sort_by_book(books, num_books):
+    # stable order of events by book; small book indices get numpy's radix sort
+    return np.argsort(books.astype(np.uint16) if num_books < 2**16 else books, kind="stable")
+
+
+def _group_starts(*columns):
+    # True where any of the (sorted) columns changes from the row before, and on the first row
+    starts = np.zeros(len(columns[0]), dtype=bool)
+    starts[:1] = True
+    for column in columns:
+        starts[1:] |= column[1:] != column[:-1]
+    return starts
+
+
+def _shift(values, fill):
+    # values moved one row down, fill in the first row
+    shifted = np.empty_like(values)
+    shifted[:1] = fill
+    shifted[1:] = values[:-1]
+    return shifted
+
+
+def _take(values, rows, fill=0.0):
+    # values[rows], fill where rows is -1 - values may be empty when nothing rests anywhere
+    taken = np.full(len(rows), fill)
+    found = rows >= 0
+    taken[found] = values[rows[found]]
+    return taken
+
+
+def _fill(length, *marks):
+    """
+    Per position, the value of the last mark at or before it; marks are (positions, values) pairs,
+    later pairs overriding earlier ones at the same position. Position 0 must be marked.
+    """
+    value = np.empty(length, dtype=np.int64)
+    source = np.full(length, -1, dtype=np.int64)
+    for positions, values in marks:
+        value[positions] = values
+        source[positions] = positions
+    np.maximum.accumulate(source, out=source)
+    return value[source]
+
+
+def _segment_cumsum(values, starts):
+    # inclusive cumulative sum that restarts wherever starts is True
+    total = np.cumsum(values)
+    first = np.flatnonzero(starts)
+    offsets = (total[first] - values[first])[np.cumsum(starts) - 1]
+    return total - offsets
+
+
+class BookReplay():
+    """
+    Replays MBO events into per-instrument limit order books, a columnar batch at a time
+
+    Parameters:
+    - every: sampling interval like "1s", "1m", "1h"; None reports the book after every event
+    - depth: number of price levels per side to report (1 is top of book)
+    - market_makers: optional order_ids whose resting size is reported as mm_bid_sz / mm_ask_sz
+
+    Add (A) and modify (M) place an order at its side / price / size, cancel (C) and fill (F) take
+    size off it, clear (R) empties the instrument's book and trades (T) leave it alone. Cancels and
+    fills of orders that were resting before the replay started are skipped.
+
+    Book state between batches lives in sorted arrays: resting orders by order_id and price levels
+    by (book side, level key), where the key is the price for bids and -price for asks so the best
+    level is always the largest key. Within a batch, order sizes and level sizes come from segmented
+    cumulative sums; only levels appearing or emptying go through a Python loop, which keeps one
+    sorted key list per book side to find the new best levels.
+    """
+
+    def __init__(self, every: str = None, depth: int = 1, market_makers=None):
+        self.every_ns = None if every is None else duration_ns(every)
+        self.depth = depth
+        self.market_makers = None if market_makers is None else np.unique(np.asarray(market_makers))
+
+        self.columns = []
+        for level in range(depth):
+            self.columns += [f"bid_px_{level:02d}", f"bid_sz_{level:02d}", f"ask_px_{level:02d}", f"ask_sz_{level:02d}"]
+        if self.market_makers is not None:
+            self.columns += ["mm_bid_sz", "mm_ask_sz"]
+
+        self.instruments = {}  # instrument_id -> book index; book side = 2 * book + (1 for bids)
+        self.next_sample = None
+        self._orders = {"order_id": np.empty(0, np.int64), "side": np.empty(0, np.int64),
+                        "key": np.empty(0), "size": np.empty(0)}
+        self._levels = {"side": np.empty(0, np.int64), "key": np.empty(0), "size": np.empty(0)}
+        self._keys = {}                          # book side -> sorted level keys
+        self._mm = {}                            # book side -> resting market-maker size
+        self._last = np.empty((0, len(self.columns)))  # book -> its row after its latest event
+        self._seen = np.empty(0, dtype=bool)           # book -> has had an event
+
+    def _empty_row(self):
+        return [np.nan if "_px_" in name else 0.0 for name in self.columns]
+
+    def _books(self, df: pl.DataFrame):
+        # book index per event, registering instruments on first sight
+        if "instrument_id" not in df.columns:
+            instruments, inverse = [None], np.zeros(len(df), dtype=np.int64)
+        else:
+            self._instrument_dtype = df.schema["instrument_id"]
+            instruments, inverse = np.unique(df["instrument_id"].to_numpy(), return_inverse=True)
+            instruments = instruments.tolist()
+        for instrument in instruments:
+            if instrument not in self.instruments:
+                self.instruments[instrument] = len(self.instruments)
+        new_books = len(self.instruments) - len(self._last)
+        if new_books:
+            self._last = np.vstack([self._last, [self._empty_row()] * new_books])
+            self._seen = np.r_[self._seen, np.zeros(new_books, dtype=bool)]
+        return np.array([self.instruments[instrument] for instrument in instruments], dtype=np.int64)[inverse]
+
+    def update(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Apply a time-sorted batch of MBO events (ts_event, action, side, price, size, order_id and
+        optionally instrument_id)
+
+        Returns: with every=None, one row per event (same order) holding the book columns of the
+        event's instrument after it was applied; otherwise one row per (sample time, instrument) for
+        every sampling boundary b this batch moved past, with all events at ts_event <= b applied.
+        """
+        if len(df) == 0:
+            return self._sampled_frame(np.empty((0, len(self.columns))), [], []) if self.every_ns else \
+                self._frame(np.empty((0, len(self.columns))))
+
+        events = {
+            "ts": df["ts_event"].dt.cast_time_unit("ns").to_physical().to_numpy(),
+            "book": self._books(df),
+            "reset": df["action"].is_in(RESETS).to_numpy(),
+            "reduce": df["action"].is_in(REDUCTIONS).to_numpy(),
+            "is_bid": (df["side"] == "B").to_numpy(),
+            "price": df["price"].cast(pl.Float64).to_numpy(),
+            "size": df["size"].cast(pl.Float64).to_numpy(),
+            "order_id": df["order_id"].cast(pl.Int64).to_numpy(),
+        }
+        if self.every_ns is not None and self.next_sample is None:
+            self.next_sample = -(-int(events["ts"][0]) // self.every_ns) * self.every_ns
+
+        # a clear (R) splits the batch: everything before it is applied, then the book is emptied
+        clears = np.flatnonzero((df["action"] == "R").to_numpy())
+        bounds = [0] + [int(i) for i in clears if i > 0] + [len(df)]
+        rows, samples = [], []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            # boundaries before the part's first event still see the books as they were
+            previous, seen = self._last.copy(), self._seen.copy()
+            if start in clears:
+                self._clear(int(events["book"][start]))
+            part = {name: values[start:stop] for name, values in events.items()}
+            until = int(events["ts"][stop]) if stop < len(df) else None
+            part_rows = self._apply(part)
+            rows.append(part_rows)
+            if self.every_ns is not None:
+                samples.append(self._sample(part, part_rows, until, previous, seen))
+
+        if self.every_ns is None:
+            return self._frame(np.vstack(rows))
+        values = np.vstack([sample[0] for sample in samples])
+        return self._sampled_frame(values, sum((sample[1] for sample in samples), []),
+                                   sum((sample[2] for sample in samples), []))
+
+    def flush(self) -> pl.DataFrame:
+        """Snapshot of every book at the boundary closing the last (partial) interval"""
+        if self.every_ns is None or self.next_sample is None:
+            return self._sampled_frame(np.empty((0, len(self.columns))), [], [])
+        books = self._sorted_books()
+        names = list(self.instruments)
+        frame = self._sampled_frame(self._last[books], [self.next_sample] * len(books),
+                                    [names[book] for book in books.tolist()])
+        self.next_sample += self.every_ns
+        return frame
+
+    def _clear(self, book):
+        orders, levels = self._orders, self._levels
+        keep = orders["side"] // 2 != book
+        self._orders = {name: values[keep] for name, values in orders.items()}
+        keep = levels["side"] // 2 != book
+        self._levels = {name: values[keep] for name, values in levels.items()}
+        for side in (2 * book, 2 * book + 1):
+            self._keys.pop(side, None)
+            self._mm.pop(side, None)
+        self._last[book] = self._empty_row()
+
+    def _apply(self, events):
+        """Apply one batch (no clears inside) and return the book row after each event"""
+        num_events = len(events["ts"])
+        event_side = 2 * events["book"] + events["is_bid"]
+        event_key = np.where(events["is_bid"], events["price"], -events["price"])
+
+        # --- orders: resting size and place before / after each event, order by order ---
+        touched = np.flatnonzero(events["reset"] | events["reduce"])
+        by_order = touched[np.argsort(events["order_id"][touched], kind="stable")]
+        order_id = events["order_id"][by_order]
+        first = _group_starts(order_id)
+        last = np.roll(first, -1)
+        reset = events["reset"][by_order]
+        size = events["size"][by_order]
+
+        orders = self._orders
+        pos = np.searchsorted(orders["order_id"], order_id)
+        resting = pos < len(orders["order_id"])
+        resting[resting] = orders["order_id"][pos[resting]] == order_id[resting]
+        carried_size = np.zeros(len(order_id))
+        carried_side = np.full(len(order_id), -1)
+        carried_key = np.full(len(order_id), np.nan)
+        carried_size[resting] = orders["size"][pos[resting]]
+        carried_side[resting] = orders["side"][pos[resting]]
+        carried_key[resting] = orders["key"][pos[resting]]
+
+        # a segment starts at an order's first event in the batch and at every add / modify
+        starts = first | reset
+        segment = np.cumsum(starts) - 1
+        heads = np.flatnonzero(starts)
+        head_reset = reset[heads]
+        base = np.where(head_reset, size[heads], carried_size[heads])[segment]
+        place_side = np.where(head_reset, event_side[by_order[heads]], carried_side[heads])[segment]
+        place_key = np.where(head_reset, event_key[by_order[heads]], carried_key[heads])[segment]
+
+        reduction = np.where(reset, 0.0, size)
+        after = base - _segment_cumsum(reduction, starts)
+        before = _shift(after, 0.0)
+        before[first] = carried_size[first]
+        before = np.maximum(before, 0.0)
+        before_side = _shift(place_side, -1)
+        before_side[first] = carried_side[first]
+        before_key = _shift(place_key, np.nan)
+        before_key[first] = carried_key[first]
+
+        # resting orders after the batch
+        left = np.maximum(after[last], 0.0)
+        untouched = ~np.isin(orders["order_id"], order_id[last])
+        alive = left > 0
+        merged = {
+            "order_id": np.r_[orders["order_id"][untouched], order_id[last][alive]],
+            "side": np.r_[orders["side"][untouched], place_side[last][alive]],
+            "key": np.r_[orders["key"][untouched], place_key[last][alive]],
+            "size": np.r_[orders["size"][untouched], left[alive]],
+        }
+        order = np.argsort(merged["order_id"], kind="stable")
+        self._orders = {name: values[order] for name, values in merged.items()}
+
+        # --- level deltas: what each event takes off its old place and puts on its new one ---
+        taken = np.where(reset, before, np.minimum(size, before))
+        removed = taken > 0
+        added = reset & (size > 0)
+        removed_event, added_event = by_order[removed], by_order[added]
+        delta_event = np.r_[removed_event, added_event]
+        delta_seq = np.r_[2 * removed_event, 2 * added_event + 1]  # removal before addition
+        delta_side = np.r_[before_side[removed], event_side[added_event]]
+        delta_key = np.r_[before_key[removed], event_key[added_event]]
+        delta_size = np.r_[-taken[removed], size[added]]
+
+        # --- levels: size after every delta, carried levels enter as rows at event -1 ---
+        levels = self._levels
+        row_seq = np.r_[np.full(len(levels["side"]), -1), delta_seq]
+        row_side = np.r_[levels["side"], delta_side]
+        row_key = np.r_[levels["key"], delta_key]
+        row_size = np.r_[levels["size"], delta_size]
+
+        # one integer code per (side, key) level in level order, then rows sorted by (level, seq);
+        # an event has at most one removal and one addition, so (level, seq) is unique
+        # (np.unique with return_inverse does a stable sort, the default one is faster)
+        by_key = np.argsort(row_key)
+        sorted_keys = row_key[by_key]
+        new_key = _group_starts(sorted_keys)
+        unique_keys = sorted_keys[new_key]
+        key_rank = np.empty(len(row_key), dtype=np.int64)
+        key_rank[by_key] = np.cumsum(new_key) - 1
+        row_level = row_side * len(unique_keys) + key_rank
+        order = np.argsort(row_level * (2 * num_events + 1) + (row_seq + 1))
+        row_level, row_seq, row_size = row_level[order], row_seq[order], row_size[order]
+        # side and key follow from the level code, only needed for a few rows
+        num_keys = len(unique_keys)
+        row_event = row_seq // 2
+
+        level_start = _group_starts(row_level)
+        level_end = np.roll(level_start, -1)
+        level_size = _segment_cumsum(row_size, level_start)
+
+        # level sizes after the batch
+        kept = level_end & (level_size > 0)
+        self._levels = {"side": row_level[kept] // num_keys, "key": unique_keys[row_level[kept] % num_keys],
+                        "size": level_size[kept]}
+
+        # a level appears / empties when its size after an event crosses zero
+        ends = np.flatnonzero(np.roll(level_start | _group_starts(row_event), -1))
+        previous = _shift(ends, -1)
+        same_level = previous >= 0
+        same_level[same_level] = ~level_start[previous[same_level] + 1]
+        size_before = np.where(same_level, level_size[np.maximum(previous, 0)], 0.0)
+        flips = ends[((size_before > 0) != (level_size[ends] > 0)) & (row_event[ends] >= 0)]
+        flips = flips[np.argsort(row_event[flips], kind="stable")]
+
+        # every lookup runs over the events in (book, event) order, so the searches go in sorted order
+        event_index = _sort_by_book(events["book"], len(self.instruments))
+        event_book = events["book"][event_index]
+        book_start = _group_starts(event_book)
+        batch_books = event_book[book_start]
+
+        # --- best levels: sorted key lists per book side, replayed over appear / empty only ---
+        depth = self.depth
+        change_event, change_side, change_keys = [], [], []
+        for side in np.sort(np.r_[2 * batch_books, 2 * batch_books + 1]).tolist():
+            keys = self._keys.get(side, [])
+            change_event.append(-1)
+            change_side.append(side)
+            change_keys.append(keys[:-depth - 1:-1])
+        for event, side, key, appears in zip(row_event[flips].tolist(), (row_level[flips] // num_keys).tolist(),
+                                             unique_keys[row_level[flips] % num_keys].tolist(),
+                                             (level_size[flips] > 0).tolist()):
+            keys = self._keys.setdefault(side, [])
+            if appears:
+                insort(keys, key)
+            elif keys[-1] == key:
+                keys.pop()
+            else:
+                del keys[bisect_left(keys, key)]
+            change_event.append(event)
+            change_side.append(side)
+            change_keys.append(keys[:-depth - 1:-1])
+
+        change_event = np.array(change_event, dtype=np.int64)
+        change_side = np.array(change_side, dtype=np.int64)
+        top = np.full((len(change_keys), depth), np.nan)
+        for i, keys in enumerate(change_keys):
+            top[i, :len(keys)] = keys
+        order = np.lexsort((change_event, change_side))
+        change_event, change_side, top = change_event[order], change_side[order], top[order]
+
+        # level row ranges of the best keys, found once per change rather than once per event
+        known = ~np.isnan(top)
+        code = change_side[:, None] * len(unique_keys) + np.searchsorted(unique_keys, np.where(known, top, 0.0))
+        top_level = np.where(known, np.searchsorted(row_level[level_start], code), -1)
+
+        # --- book rows per event, in (book, event) order: the best levels only move at a change
+        # and a best level's size only at its own rows, so both are forward fills over the events ---
+        position = np.empty(num_events, dtype=np.int64)
+        position[event_index] = np.arange(num_events)
+        first_position = np.zeros(len(self.instruments), dtype=np.int64)
+        first_position[batch_books] = np.flatnonzero(book_start)
+        change_position = np.where(change_event >= 0, position[np.maximum(change_event, 0)],
+                                   first_position[change_side // 2])
+        # a change holds until the next one on its side, and is dropped if that one is at the same event
+        next_same = np.r_[change_side[1:] == change_side[:-1], False]
+        next_event = np.where(next_same, np.r_[change_event[1:], 0], num_events)
+        holds = ~next_same | (np.r_[change_position[1:], 0] != change_position)
+
+        stride = num_events + 1
+        level_id = np.cumsum(level_start) - 1
+        level_keys = level_id * stride + (row_event + 1)
+        # the last row of a level at an event is its size after that event
+        last_at_event = np.r_[(level_keys[1:] != level_keys[:-1]), True]
+
+        out = np.empty((num_events, len(self.columns)))
+        for book_side, column in ((1, 0), (0, 2)):  # bids then asks in each depth block
+            held = np.flatnonzero(holds & (change_side % 2 == book_side))
+            change = _fill(num_events, (change_position[held], held))
+            for level in range(depth):
+                key = top[change, level]
+                out[:, 4 * level + column] = key if book_side == 1 else -key
+
+                # each held change: the level's size carried into it, then its rows up to the next change
+                best = top_level[held, level]
+                start = np.searchsorted(level_keys, best * stride + change_event[held] + 1, side="right")
+                stop = np.searchsorted(level_keys, best * stride + next_event[held] + 1, side="left")
+                stop = np.where(best >= 0, stop, start)
+                carried = start - 1
+                found = (best >= 0) & (carried >= 0)
+                found[found] = level_id[carried[found]] == best[found]
+                count = stop - start
+                rows = np.repeat(start - np.cumsum(count) + count, count) + np.arange(count.sum())
+                rows = rows[last_at_event[rows]]
+                size_row = _fill(num_events, (change_position[held], np.where(found, carried, -1)),
+                                 (position[row_event[rows]], rows))
+                out[:, 4 * level + column + 1] = _take(level_size, size_row)
+
+        if self.market_makers is not None:
+            is_mm = np.isin(events["order_id"][delta_event], self.market_makers)
+            # carried totals enter as rows at event -1, then every market-maker delta in order
+            carried = np.unique(np.r_[2 * batch_books, 2 * batch_books + 1, delta_side[is_mm]])
+            mm_side = np.r_[carried, delta_side[is_mm]]
+            mm_event = np.r_[np.full(len(carried), -1), delta_event[is_mm]]
+            mm_size = np.r_[[self._mm.get(side, 0.0) for side in carried.tolist()], delta_size[is_mm]]
+            order = np.lexsort((np.r_[np.full(len(carried), -1), delta_seq[is_mm]], mm_side))
+            mm_side, mm_event, mm_size = mm_side[order], mm_event[order], mm_size[order]
+            mm_starts = _group_starts(mm_side)
+            mm_total = _segment_cumsum(mm_size, mm_starts)
+            mm_position = np.where(mm_event >= 0, position[np.maximum(mm_event, 0)], first_position[mm_side // 2])
+            last_at_event = np.r_[(mm_side[1:] != mm_side[:-1]) | (mm_event[1:] != mm_event[:-1]), True]
+            for book_side, column in ((1, -2), (0, -1)):
+                on_side = mm_side % 2 == book_side
+                carried_rows = np.flatnonzero(on_side & (mm_event < 0))
+                rows = np.flatnonzero(on_side & (mm_event >= 0) & last_at_event)
+                out[:, column] = mm_total[_fill(num_events, (mm_position[carried_rows], carried_rows),
+                                                (mm_position[rows], rows))]
+            ends = np.roll(mm_starts, -1)
+            self._mm.update(zip(mm_side[ends].tolist(), mm_total[ends].tolist()))
+
+        # back to event order; each book's latest row carries into the next batch
+        out = out[position]
+        latest = event_index[np.roll(book_start, -1)]
+        self._last[batch_books] = out[latest]
+        self._seen[batch_books] = True
+        return out
+
+    def _sample(self, events, rows, until, previous, seen):
+        """
+        Rows for the sampling boundaries b with next_sample <= b < until (the last ts when None), given
+        the batch rows and each book's row / whether it had events before the batch
+        """
+        limit = until if until is not None else int(events["ts"][-1])
+        boundaries = np.arange(self.next_sample, limit, self.every_ns, dtype=np.int64)
+        if len(boundaries) == 0:
+            return np.empty((0, len(self.columns))), [], []
+        self.next_sample = int(boundaries[-1]) + self.every_ns
+
+        # last event at or before each boundary, then the last event of each book up to there
+        last_event = np.searchsorted(events["ts"], boundaries, side="right") - 1
+        order = _sort_by_book(events["book"], len(self.instruments))
+        books = self._sorted_books()
+        book_grid, event_grid = np.meshgrid(books, last_event)
+        row = _Timeline(events["book"][order], order, len(order)).last_rows(book_grid.ravel(), event_grid.ravel())
+        row = np.where(row >= 0, order[row], -1)
+
+        # books whose first event comes after the boundary aren't there yet
+        first_event = np.full(len(self.instruments), len(events["ts"]))
+        np.minimum.at(first_event, events["book"], np.arange(len(events["ts"])))
+        present = (seen[book_grid] | (first_event[book_grid] <= event_grid)).ravel()
+
+        # books without events up to the boundary keep their row from before this batch
+        before = previous[book_grid.ravel()]
+        values = np.where((row >= 0)[:, None], rows[np.maximum(row, 0)], before)[present]
+        times = np.repeat(boundaries, len(books))[present].tolist()
+        names = list(self.instruments)
+        return values, times, [names[book] for book in book_grid.ravel()[present].tolist()]
+
+    def _sorted_books(self):
+        # book indices in instrument_id order, the order snapshot rows come out in
+        names = list(self.instruments)
+        return np.array(sorted(range(len(names)), key=lambda book: (names[book] is not None, names[book])),
+                        dtype=np.int64)
+
+    def _frame(self, values):
+        return pl.DataFrame({name: values[:, i] for i, name in enumerate(self.columns)})
+
+    def _sampled_frame(self, values, times, instruments):
+        frame = self._frame(values).insert_column(
+            0, pl.Series("ts_event", times, dtype=pl.Int64).cast(pl.Datetime("ns", "UTC")))
+        if any(instrument is not None for instrument in self.instruments):
+            frame = frame.insert_column(1, pl.Series("instrument_id", instruments, dtype=self._instrument_dtype))
+        return frame
+
+
+def relative_spread() -> pl.Expr:
+    """(best ask - best bid) / mid from the book columns; null while a side is empty or the book is crossed"""
+    spread = (pl.col("ask_px_00") - pl.col("bid_px_00")) / ((pl.col("ask_px_00") + pl.col("bid_px_00")) / 2)
+    spread = spread.fill_nan(None)
+    return pl.when(spread >= 0).then(spread).alias("spread")
+
+
+def _check_empty_books():
+    # batches that find no resting levels and add none: a first batch of only trades / cancels,
+    # and one right after a clear - the replay has to come back with empty books, not fail
+    ts = pl.Series(np.datetime64("2024-12-06T15:00:00", "ns").astype(np.int64) + np.arange(4) * 10**9)
+    ts = ts.cast(pl.Datetime("ns", "UTC"))
+    book = pl.DataFrame({"ts_event": ts[:2], "action": ["T", "C"], "side": ["B", "A"], "price": [170.0, 170.1],
+                         "size": [1, 1], "order_id": [0, 5]})
+    BookReplay().update(book)
+    replay = BookReplay(depth=2, market_makers=[5])
+    replay.update(book.with_columns(action=pl.Series(["A", "T"])))
+    rows = replay.update(book.with_columns(ts_event=ts[2:], action=pl.Series(["R", "C"])))
+    if rows.select(pl.sum_horizontal(pl.col("^.*_sz.*$")).sum()).item():
+        raise AssertionError("book not empty after a clear")
+
+
+if __name__ == "__main__":
+    # self-check: python matchingengine/orderbook.py
+    _check_empty_books()
+    print("empty-book replays ok")
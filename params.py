@@ -3,65 +3,141 @@ import numpy as np
 import scipy.optimize as optimize
 import matplotlib.pyplot as plt
 
-def market_clearing_model(params, r, Q):
-    """
-    Non-linear least squares objective function
-    
-    Parameters:
-    - params: [a, b, ed, ef]
-    - r: array of interest rates
-    - Q: array of quantities
-    
-    Returns: Sum of squared residuals
-    """
-    a, b, ed, ef = params
-    
-    # Predicted quantities based on model
-    Q_pred = a * np.exp(-ed * r)
-    
-    # Sum of squared errors
-    return np.sum((Q - Q_pred)**2)
+# model parameters [a, ed] (b and ef never enter Q_pred, so they can't be estimated from (r, Q))
+PARAM_NAMES = ("a", "ed")
+
+# bounds on [a, ed] to prevent unrealistic values: a positive, ed a reasonable sensitivity
+LOWER = np.array([0.0, 0.0])
+UPPER = np.array([np.inf, 100.0])
+
+
+def model_residuals(params, r, Q):
+    """Residuals a * exp(-ed * r) - Q"""
+    a, ed = params
+    return a * np.exp(-ed * r) - Q
 
-def estimate_parameters(r, Q):
+
+def model_jacobian(params, r, Q=None):
+    """Analytic Jacobian of the residuals: columns d/da = exp(-ed * r) and d/ded = -a * r * exp(-ed * r)"""
+    a, ed = params
+    decay = np.exp(-ed * r)
+    return np.column_stack([decay, -a * r * decay])
+
+
+def initial_guess(Q):
+    # a: max quantity, ed: 1.0 - one row per series
+    Q = np.atleast_2d(Q)
+    return np.column_stack([np.nanmax(Q, axis=1), np.ones(len(Q))])
+
+
+def estimate_parameters(r, Q, x0=None):
     """
     Estimate market clearing parameters using non-linear least squares
-    
+
     Args:
     - r: Interest rates
     - Q: Quantities
-    
-    Returns: Estimated parameters [a, b, ed, ef]
+    - x0: starting [a, ed], e.g. the previous window's estimate (defaults to [max(Q), 1.0])
+
+    Returns: Estimated parameters [a, ed]
     """
-    # Initial guess for parameters
-    initial_guess = [
-        np.max(Q),    # a: max quantity 
-        np.max(Q),    # b: max quantity
-        1.0,          # ed: demand rate sensitivity
-        1.0           # ef: supply rate sensitivity
-    ]
-    
-    # Bounds for parameters to prevent unrealistic values
-    bounds = [
-        (0, np.inf),  # a: positive
-        (0, np.inf),  # b: positive
-        (0, 100),     # ed: reasonable sensitivity
-        (0, 100)      # ef: reasonable sensitivity
-    ]
-    
-    # Perform non-linear least squares optimization
-    result = optimize.minimize(
-        lambda params: market_clearing_model(params, r, Q), 
-        initial_guess, 
-        method='L-BFGS-B',
-        bounds=bounds
+    r = np.asarray(r, dtype=np.float64)
+    Q = np.asarray(Q, dtype=np.float64)
+    x0 = initial_guess(Q)[0] if x0 is None else np.asarray(x0, dtype=np.float64)
+
+    # trust-region least squares with the exact Jacobian instead of finite differences
+    result = optimize.least_squares(
+        model_residuals,
+        np.clip(x0, LOWER, UPPER),
+        jac=model_jacobian,
+        bounds=(LOWER, UPPER),
+        args=(r, Q),
     )
-    
     return result.x
 
+
+def fit_curves(r, Q, x0=None, max_iter: int = 100, tol: float = 1e-10):
+    """
+    Fit Q = a * exp(-ed * r) to many series at once
+
+    Every series gets its own Levenberg-Marquardt iteration (own damping, own convergence test)
+    but all of them are stepped together with numpy, using the analytic Jacobian and closed-form
+    2x2 normal equations. Handing the stacked series to least_squares as one block-diagonal
+    problem is far slower (one global trust region over 2 x series parameters) and stops on a
+    global tolerance, so small series aren't fitted to the same precision. Series that haven't
+    converged after max_iter steps are finished off one by one with estimate_parameters.
+
+    Parameters:
+    - r: rates, shape (series, observations), or (observations,) shared by every series
+    - Q: quantities, shape (series, observations); NaN marks missing observations (ragged series)
+    - x0: starting [a, ed] per series, shape (series, 2) - pass the previous window's estimates
+      to warm start, defaults to [max(Q), 1.0]
+    - max_iter: maximum Levenberg-Marquardt steps
+    - tol: a series has converged once a step lowers its SSE by less than this fraction
+
+    Returns: (params (series, 2) of [a, ed], SSE (series,))
+    """
+    Q = np.atleast_2d(np.asarray(Q, dtype=np.float64))
+    r = np.broadcast_to(np.asarray(r, dtype=np.float64), Q.shape)
+    valid = ~np.isnan(Q)
+    Q = np.where(valid, Q, 0.0)
+    r = np.where(valid, r, 0.0)
+
+    num_series = len(Q)
+    x = initial_guess(np.where(valid, Q, np.nan)) if x0 is None else np.array(x0, dtype=np.float64).reshape(num_series, 2)
+    x = np.clip(np.nan_to_num(x), LOWER, UPPER)
+
+    def residuals(x, rows):
+        decay = np.where(valid[rows], np.exp(-x[:, 1:] * r[rows]), 0.0)
+        return x[:, :1] * decay - Q[rows], decay
+
+    everything = np.arange(num_series)
+    f, decay = residuals(x, everything)
+    sse = (f * f).sum(axis=1)
+    damping = np.full(num_series, 1e-3)
+    active = np.ones(num_series, dtype=bool)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for _ in range(max_iter):
+            rows = np.flatnonzero(active)
+            if len(rows) == 0:
+                break
+            J_a = decay[rows]
+            J_ed = -x[rows, :1] * r[rows] * J_a
+            g_a, g_ed = (J_a * f[rows]).sum(axis=1), (J_ed * f[rows]).sum(axis=1)
+            A_aa, A_ae, A_ee = (J_a * J_a).sum(axis=1), (J_a * J_ed).sum(axis=1), (J_ed * J_ed).sum(axis=1)
+
+            # (J'J + damping * diag(J'J)) step = -J'g, solved in closed form per series
+            D_aa, D_ee = A_aa * (1 + damping[rows]), A_ee * (1 + damping[rows])
+            det = D_aa * D_ee - A_ae * A_ae
+            step = np.column_stack([-(D_ee * g_a - A_ae * g_ed) / det, -(D_aa * g_ed - A_ae * g_a) / det])
+            trial = np.clip(x[rows] + step, LOWER, UPPER)
+            trial_f, trial_decay = residuals(trial, rows)
+            trial_sse = (trial_f * trial_f).sum(axis=1)
+
+            better = trial_sse < sse[rows]
+            accepted, rejected = rows[better], rows[~better]
+            improvement = (sse[accepted] - trial_sse[better]) / np.maximum(sse[accepted], np.finfo(float).tiny)
+            x[accepted], f[accepted], decay[accepted], sse[accepted] = trial[better], trial_f[better], trial_decay[better], trial_sse[better]
+            damping[accepted] /= 3
+            damping[rejected] *= 4
+
+            # converged: tiny improvement, or no step helps even with huge damping
+            active[accepted[improvement < tol]] = False
+            active[rejected[damping[rejected] > 1e12]] = False
+
+    for row in np.flatnonzero(active):
+        keep = valid[row]
+        x[row] = estimate_parameters(r[row, keep], Q[row, keep], x0=x[row])
+        f_row = model_residuals(x[row], r[row, keep], Q[row, keep])
+        sse[row] = f_row @ f_row
+    return x, sse
+
+
 # Example usage
-def generate_synthetic_data():
-    """Generate synthetic market data for demonstration"""
-    np.random.seed(42)
+def generate_synthetic_data(num_points=100, seed=42):
+    """Generate synthetic market data for demonstration (num_points rates between 1% and 10%)"""
+    np.random.seed(seed)
     
     # True parameters
     true_a = 1000
@@ -70,7 +146,7 @@ def generate_synthetic_data():
     true_ef = 10
     
     # Generate interest rates
-    r = np.linspace(0.01, 0.1, 100)
+    r = np.linspace(0.01, 0.1, num_points)
     
     # Generate quantities with some noise
     Q = true_a * np.exp(-true_ed * r) + np.random.normal(0, 50, r.shape)
@@ -91,7 +167,7 @@ def main():
         print(f"{name}: {val}")
     
     print("\nEstimated Parameters:")
-    for name, val in zip(param_names, estimated_params):
+    for name, val in zip(PARAM_NAMES, estimated_params):
         print(f"{name}: {val}")
     
     # Plotting
@@ -103,7 +179,7 @@ def main():
     plt.plot(r, Q_true, 'r-', label='True Model')
     
     # Estimated model prediction
-    Q_est = estimated_params[0] * np.exp(-estimated_params[2] * r)
+    Q_est = estimated_params[0] * np.exp(-estimated_params[1] * r)
     plt.plot(r, Q_est, 'g--', label='Estimated Model')
     
     plt.xlabel('Interest Rate')
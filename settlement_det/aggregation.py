@@ -0,0 +1,228 @@
+import numpy as np
+import polars as pl
+
+import profiling
+
+# quantiles reported by default: the box of a box / violin plot plus 5% tails
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+class RunningStats():
+    """
+    Streaming per-bucket mean and variance (Welford), mergeable across workers (Chan et al.)
+
+    Only count, mean and the sum of squared deviations are kept, so memory doesn't grow
+    with the number of replications.
+    """
+
+    def __init__(self, size: int):
+        self.count = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    @classmethod
+    def of(cls, values):
+        """Stats of a block of observations, one row per observation"""
+        values = np.asarray(values, dtype=np.float64)
+        stats = cls(values.shape[1])
+        if len(values):
+            stats.count = len(values)
+            stats.mean = values.mean(axis=0)
+            stats.m2 = ((values - stats.mean) ** 2).sum(axis=0)
+        return stats
+
+    def add(self, values):
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    def merge(self, other: "RunningStats"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.zeros_like(self.mean)
+
+    def band(self, z: float = 1.96):
+        """(lower, upper) band covering the spread of single replications, mean -/+ z std"""
+        return self.mean - z * self.std, self.mean + z * self.std
+
+    def mean_interval(self, z: float = 1.96):
+        """(lower, upper) confidence interval for the ensemble mean itself"""
+        half_width = z * self.std / np.sqrt(max(self.count, 1))
+        return self.mean - half_width, self.mean + half_width
+
+
+def _quantile_name(q):
+    return f"q{q * 100:g}"
+
+
+def summary_frame(keys, count, mean, std, minimum, maximum, quantiles):
+    """One row per bucket: count, mean, std, min, max and a q<percent> column per quantile"""
+    return pl.DataFrame({
+        "bucket": list(keys),
+        "count": np.full(len(keys), count, dtype=np.int64),
+        "mean": mean, "std": std, "min": minimum, "max": maximum,
+        **{_quantile_name(q): values for q, values in quantiles.items()},
+    })
+
+
+def summarize(matrix, keys=None, quantiles=QUANTILES) -> pl.DataFrame:
+    """
+    Per-bucket distribution across brokers of an in-memory ledger matrix, fully vectorized
+
+    Parameters:
+    - matrix: (num_brokers, num_buckets) ledger, e.g. BrokerPool.net or BrokerPool.eod
+    - keys: bucket labels (0, 1, ... by default)
+    - quantiles: quantiles to report, exact (linear interpolation)
+
+    Returns: summary_frame DataFrame; std is the sample std (ddof=1), like pl.Series.std
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    keys = range(matrix.shape[1]) if keys is None else keys
+    with profiling.stage("aggregation", rows_in=len(matrix), kind="exact") as span:
+        values = np.quantile(matrix, quantiles, axis=0) if len(matrix) else np.full((len(quantiles), matrix.shape[1]), np.nan)
+        stats = RunningStats.of(matrix)
+        frame = summary_frame(
+            keys, len(matrix), stats.mean, stats.std,
+            matrix.min(axis=0) if len(matrix) else np.full(matrix.shape[1], np.nan),
+            matrix.max(axis=0) if len(matrix) else np.full(matrix.shape[1], np.nan),
+            dict(zip(quantiles, values)),
+        )
+        span.rows_out = len(frame)
+    return frame
+
+
+class QuantileSketch():
+    """
+    Mergeable per-bucket quantile sketch with a relative accuracy guarantee (DDSketch-style)
+
+    Values are counted in logarithmically sized bins, one set for positive and one for negative
+    values plus a zero count, per bucket. Any quantile comes back within relative_accuracy of the
+    value at its rank (for magnitudes between min_value and max_value), memory is fixed by the bin
+    range whatever the number of values, and merging two sketches is adding their counts - so
+    workers, broker batches and replications can each keep their own and be combined in any order.
+
+    Parameters:
+    - num_buckets: settlement buckets tracked side by side
+    - relative_accuracy: bound on the relative error of every quantile
+    - min_value: magnitudes below this are counted as zero
+    - max_value: magnitudes above this share the top bin
+    """
+
+    def __init__(self, num_buckets: int, relative_accuracy: float = 0.01, min_value: float = 1e-6,
+                 max_value: float = 1e15):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self._offset = int(np.ceil(np.log(min_value) / self._log_gamma))
+        self.num_bins = int(np.ceil(np.log(max_value) / self._log_gamma)) - self._offset + 1
+
+        self.positive = np.zeros((num_buckets, self.num_bins), dtype=np.int64)
+        self.negative = np.zeros((num_buckets, self.num_bins), dtype=np.int64)
+        self.zero = np.zeros(num_buckets, dtype=np.int64)
+        self.count = 0
+
+    def _compatible(self, other):
+        return (self.positive.shape == other.positive.shape and self.gamma == other.gamma
+                and self.min_value == other.min_value)
+
+    def _bins(self, magnitudes):
+        bins = np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64) - self._offset
+        return np.clip(bins, 0, self.num_bins - 1)
+
+    def add(self, values):
+        """Count a block of values, shape (rows, num_buckets) - e.g. a batch of brokers' ledger rows"""
+        values = np.asarray(values, dtype=np.float64)
+        num_buckets = self.positive.shape[0]
+        columns = np.broadcast_to(np.arange(num_buckets), values.shape)
+        magnitudes = np.abs(values)
+        nonzero = magnitudes >= self.min_value
+        for counts, side in ((self.positive, nonzero & (values > 0)), (self.negative, nonzero & (values < 0))):
+            cells = columns[side] * self.num_bins + self._bins(magnitudes[side])
+            counts += np.bincount(cells, minlength=counts.size).reshape(counts.shape)
+        self.zero += (~nonzero).sum(axis=0)
+        self.count += len(values)
+
+    def merge(self, other: "QuantileSketch"):
+        if not self._compatible(other):
+            raise ValueError("only sketches with the same buckets and accuracy can be merged")
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero += other.zero
+        self.count += other.count
+
+    def quantiles(self, quantiles=QUANTILES):
+        """{q: (num_buckets,) estimate}, NaN before anything was added"""
+        # every bin in increasing value order: negatives from the largest magnitude down, zero, positives
+        counts = np.concatenate([self.negative[:, ::-1], self.zero[:, None], self.positive], axis=1)
+        bin_values = 2 * self.gamma ** (np.arange(self.num_bins) + self._offset) / (self.gamma + 1)
+        values = np.concatenate([-bin_values[::-1], [0.0], bin_values])
+        cumulative = np.cumsum(counts, axis=1)
+
+        estimates = {}
+        for q in quantiles:
+            rank = q * (self.count - 1)
+            position = (cumulative > rank).argmax(axis=1)
+            estimates[q] = values[position] if self.count else np.full(len(counts), np.nan)
+        return estimates
+
+
+class StreamingSummary():
+    """
+    summarize() in bounded memory: feed broker ledger rows in blocks, merge summaries across workers
+
+    Mean and std are exact (RunningStats), so are min and max; quantiles come from a
+    QuantileSketch and are within its relative accuracy (clipped to the exact min / max).
+
+        summary = StreamingSummary(len(grid))
+        simulate_brokers(df, 100_000, grid=grid, on_batch=lambda start, part: summary.add(part.net))
+        frame = summary.frame(grid.labels)
+    """
+
+    def __init__(self, num_buckets: int, relative_accuracy: float = 0.01, **sketch_args):
+        self.stats = RunningStats(num_buckets)
+        self.sketch = QuantileSketch(num_buckets, relative_accuracy, **sketch_args)
+        self.min = np.full(num_buckets, np.inf)
+        self.max = np.full(num_buckets, -np.inf)
+
+    @property
+    def count(self):
+        return self.stats.count
+
+    def add(self, values):
+        """Add a block of observations, shape (rows, num_buckets)"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self.stats.merge(RunningStats.of(values))
+        self.sketch.add(values)
+        np.minimum(self.min, values.min(axis=0), out=self.min)
+        np.maximum(self.max, values.max(axis=0), out=self.max)
+
+    def merge(self, other: "StreamingSummary"):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+
+    def frame(self, keys=None, quantiles=QUANTILES) -> pl.DataFrame:
+        """Same columns as summarize()"""
+        keys = range(len(self.min)) if keys is None else keys
+        estimates = {q: np.clip(values, self.min, self.max) for q, values in self.sketch.quantiles(quantiles).items()}
+        empty = self.count == 0
+        return summary_frame(
+            keys, self.count, self.stats.mean, self.stats.std,
+            np.where(empty, np.nan, self.min), np.where(empty, np.nan, self.max), estimates,
+        )
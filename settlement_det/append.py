@@ -0,0 +1,281 @@
+import io
+import os
+
+import numpy as np
+import polars as pl
+
+import profiling
+from broker import STATE_MATRICES, Broker, BrokerPool, unpack_rng
+from checkpoint import Checkpoint
+from ensemble import ENSEMBLE_OUTPUTS
+from grid import HOURLY, SettlementGrid
+from mbo import scan_mbo
+from mm_filter import MarketMakerClassifier
+
+# add / cancel / modify counts kept per order_id for the market-maker filter
+ACTIONS = (("add_count", "A"), ("cancel_count", "C"), ("modify_count", "M"))
+
+# ledger sums kept up to date across brokers, what ENSEMBLE_OUTPUTS are read from
+TOTALS = {"bid_volume": "bid", "ask_volume": "ask", "net_cashflow": "net", "eod_net_cashflow": "eod"}
+
+
+def route_orders(order_ids, num_brokers: int, salt: int = 0):
+    """
+    Broker of every order, from a stable hash (splitmix64) of its order_id
+
+    All events of one order land on the same broker, and an order keeps its broker however the
+    events are split into batches, so brokers can be netted as events arrive instead of after a
+    shuffle of the whole day.
+    """
+    with np.errstate(over="ignore"):
+        x = np.asarray(order_ids, dtype=np.uint64) ^ np.uint64(salt)
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(num_brokers)).astype(np.int64)
+
+
+class AppendSimulation():
+    """
+    Broker simulation that takes MBO events as they arrive, for intraday refreshes
+
+    Instead of shuffling a whole day across brokers, every order goes to route_orders'
+    broker, and each broker nets its orders in arrival order with net_slots, its generator
+    carried over between batches (BrokerPool.rng_states). A new batch of events only touches
+    the brokers it routes to: their net / ask / bid / eod rows move on from where they were, and
+    the per-bucket totals behind ENSEMBLE_OUTPUTS are updated by the change in those rows, so a
+    refresh costs what the new events cost, not the whole day. Without the market-maker filter,
+    appending a day in any number of batches nets it exactly as appending it in one (eod and the
+    totals up to float rounding).
+
+    Batches are new events only: an event stamped before the watermark (the latest ts_event seen
+    so far) is late and skipped, while one stamped at the watermark is the rest of a ts_event tie
+    group cut by the batch boundary and is netted. refresh keeps its place in the file (a byte
+    offset into a csv, a row offset into a parquet), so every row is read and netted once and a
+    refresh only parses what was written since the last one. The market-maker filter
+    uses each order's add / cancel / modify counts up to and including its batch; an order only
+    flagged later has already been netted and stays in.
+
+    With a directory the state (ledgers, generators, watermark, file offset, action counts) is kept there
+    through checkpoint.Checkpoint after every batch, writing only the brokers and orders the
+    batch changed, and picked up again by the next AppendSimulation on the same directory.
+
+        simulation = AppendSimulation(3000, seed=0, directory="intraday_state")
+        simulation.refresh(MBO_PATH, date="2024-12-06")  # again whenever the file has grown
+        outputs = simulation.outputs()
+
+    Parameters:
+    - num_brokers: number of brokers orders are routed to
+    - seed: seed for the routing and for every broker's settlement draws
+    - grid: settlement buckets (hourly 14:00-22:00 UTC by default)
+    - cancel_threshold, modify_threshold: market-maker filter (MarketMakerClassifier), None for no filter
+    - max_price: drop orders quoted at or above this
+    - directory: where the state is kept between runs, None to keep it in memory only
+    """
+
+    def __init__(self, num_brokers: int, seed=0, grid: SettlementGrid = None, cancel_threshold: float = 0.8,
+                 modify_threshold: float = 0.8, max_price: float = 1e6, directory=None):
+        self.grid = grid if grid is not None else HOURLY
+        self.cancel_threshold = cancel_threshold
+        self.modify_threshold = modify_threshold
+        self.max_price = max_price
+        self.pool = BrokerPool(num_brokers, self.grid)
+        self.watermark = None  # ns since the epoch
+        self.source = None  # file refresh reads, and how far into it
+        self.offset = 0
+
+        # cumulative action counts, sorted by order_id
+        self.order_ids = np.empty(0, dtype=np.uint64)
+        self.actions = np.empty((0, len(ACTIONS)), dtype=np.int64)
+        self._changed_ids = []
+
+        self.entropy = np.random.SeedSequence(seed).entropy
+        self.checkpoint = None
+        if directory is not None:
+            self.checkpoint = Checkpoint(directory, interval=0.0, matrices=STATE_MATRICES + ("eod",))
+            settings = {
+                "mode": "append",
+                "num_brokers": num_brokers,
+                "seed": int(seed) if isinstance(seed, (int, np.integer)) else None,
+                "grid": self.grid.boundaries.tolist(),
+                "cancel_threshold": cancel_threshold,
+                "modify_threshold": modify_threshold,
+                "max_price": max_price,
+            }
+            self.entropy = self.checkpoint.open(settings, self.entropy)
+            self._restore()
+        self.salt = int(np.random.SeedSequence(self.entropy, spawn_key=(2,)).generate_state(1, np.uint64)[0])
+        self.totals = {name: getattr(self.pool, matrix).sum(axis=0) for name, matrix in TOTALS.items()}
+
+    def _restore(self):
+        import pyarrow as pa
+
+        self.checkpoint.restore(self.pool)
+        state = self.checkpoint.state
+        if state is None:
+            return
+        self.watermark = state["watermark"]
+        self.source = state.get("source")
+        self.offset = state.get("offset", 0)
+        for name in state["counts"]:
+            with pa.memory_map(os.path.join(self.checkpoint.directory, name)) as source:
+                table = pa.ipc.open_file(source).read_all()
+                self._merge_counts(
+                    table.column("order_id").to_numpy(),
+                    np.column_stack([table.column(column).to_numpy() for column, _ in ACTIONS]),
+                    replace=True,
+                )
+        self._changed_ids = []
+
+    def _merge_counts(self, ids, counts, replace: bool = False):
+        """Add counts (or overwrite them, replace) for sorted unique ids"""
+        position = np.searchsorted(self.order_ids, ids)
+        found = position < len(self.order_ids)
+        found[found] = self.order_ids[position[found]] == ids[found]
+        if replace:
+            self.actions[position[found]] = counts[found]
+        else:
+            self.actions[position[found]] += counts[found]
+        self.order_ids = np.insert(self.order_ids, position[~found], ids[~found])
+        self.actions = np.insert(self.actions, position[~found], counts[~found], axis=0)
+        self._changed_ids.append(ids)
+
+    def _market_makers(self, order_ids, action):
+        """Market-maker flag per event, from its order's counts so far"""
+        ids, inverse = np.unique(order_ids, return_inverse=True)
+        counts = np.column_stack([
+            np.bincount(inverse, weights=action == letter, minlength=len(ids)).astype(np.int64)
+            for _, letter in ACTIONS
+        ])
+        self._merge_counts(ids, counts)
+        if self.cancel_threshold is None:
+            return np.zeros(len(order_ids), dtype=bool)
+
+        cumulative = self.actions[np.searchsorted(self.order_ids, ids)]
+        classifier = MarketMakerClassifier(pl.DataFrame({
+            "order_id": ids, **{name: cumulative[:, i] for i, (name, _) in enumerate(ACTIONS)},
+        }))
+        # ids are already sorted, so the classifier's rows line up with them
+        return classifier.mask(self.cancel_threshold, self.modify_threshold)[inverse]
+
+    def append(self, events: pl.DataFrame) -> int:
+        """
+        Net a batch of new MBO events (scan_mbo's shape) into the brokers they route to
+
+        Events before the watermark are dropped, so the same batch must not be appended twice.
+        Returns: the number of orders netted
+        """
+        ts_event = events["ts_event"].dt.epoch("ns").to_numpy() if len(events) else np.empty(0, dtype=np.int64)
+        if self.watermark is not None:
+            events = events.filter(pl.Series(ts_event >= self.watermark))
+            ts_event = ts_event[ts_event >= self.watermark]
+        if len(events) == 0:
+            self.save()
+            return 0
+
+        with profiling.stage("append", rows_in=len(events)) as span:
+            order_ids = events["order_id"].to_numpy().astype(np.uint64)
+            keep = ~self._market_makers(order_ids, events["action"].to_numpy())
+            if self.max_price is not None:
+                keep &= (events["price"] < self.max_price).to_numpy()
+            slots = self.grid.slots_of(events["ts_event"]).astype(np.int64)
+            # pre/post-market events have no settlement bucket
+            keep &= slots >= 0
+
+            rows = np.flatnonzero(keep)
+            brokers = route_orders(order_ids[rows], len(self.pool), self.salt)
+            # each broker's orders in arrival order
+            rows = rows[np.argsort(brokers, kind="stable")]
+            brokers = np.sort(brokers, kind="stable")
+            slots = slots[rows]
+            is_ask = (events["side"] == "A").to_numpy()[rows]
+            notionals = (events["price"] * events["size"]).to_numpy()[rows]
+
+            touched, starts = np.unique(brokers, return_index=True)
+            before = {name: getattr(self.pool, matrix)[touched].sum(axis=0) for name, matrix in TOTALS.items()}
+            bounds = np.append(starts, len(rows))
+            for i, broker_id in enumerate(touched.tolist()):
+                orders = slice(bounds[i], bounds[i + 1])
+                # a broker that has netted before carries on with its draws where it left off
+                if self.pool.counters[broker_id, 0] > 0:
+                    seed = unpack_rng(self.pool.rng_states[broker_id])
+                else:
+                    seed = np.random.SeedSequence(self.entropy, spawn_key=(1, broker_id))
+                broker = Broker(client_orders=None, seed=seed, pool=self.pool, index=broker_id)
+                broker.net_slots(slots[orders], is_ask[orders], notionals[orders])
+
+            # EOD is the running net since the open, so new orders in a bucket add to it and every later one
+            signed = np.where(is_ask, notionals, -notionals)
+            num_slots = len(self.grid)
+            cells = np.searchsorted(touched, brokers) * num_slots + slots
+            added = np.bincount(cells, weights=signed, minlength=len(touched) * num_slots)
+            self.pool.eod[touched] += np.cumsum(added.reshape(len(touched), num_slots), axis=1)
+
+            for name, matrix in TOTALS.items():
+                self.totals[name] += getattr(self.pool, matrix)[touched].sum(axis=0) - before[name]
+            self.watermark = int(max(ts_event.max(), self.watermark or 0))
+            span.rows_out = len(rows)
+        self.save()
+        return len(rows)
+
+    def _new_rows(self, path):
+        """Raw rows of path written since the last refresh, and the offset just past them"""
+        path = str(path)
+        offset = self.offset if path == self.source else 0
+        if path.endswith(".parquet"):
+            lf = pl.scan_parquet(path)
+            end = lf.select(pl.len()).collect().item()
+            return lf.slice(offset, end - offset), end
+
+        with open(path, "rb") as file:
+            header = file.readline()
+            offset = max(offset, len(header))
+            file.seek(offset)
+            tail = file.read()
+        # a row still being written is left for the next refresh
+        tail = tail[:tail.rfind(b"\n") + 1]
+        schema = pl.scan_csv(path).collect_schema()
+        rows = pl.read_csv(io.BytesIO(header + tail), schema=schema) if tail else pl.DataFrame(schema=schema)
+        return rows.lazy(), offset + len(tail)
+
+    def refresh(self, path, date=None, instrument_id=None) -> int:
+        """Append the events written to an MBO file since the last refresh; returns the number of orders netted"""
+        with profiling.stage("preprocessing", path=str(path), date=date) as span:
+            rows, offset = self._new_rows(path)
+            events = scan_mbo(rows, date, instrument_id=instrument_id).collect(engine="streaming")
+            span.rows_out = len(events)
+        self.source, self.offset = str(path), offset
+        return self.append(events)
+
+    def outputs(self):
+        """ENSEMBLE_OUTPUTS so far, the same values bucket_outputs gives for self.pool"""
+        num_brokers = len(self.pool)
+        outputs = {
+            "bid_volume": self.totals["bid_volume"].copy(),
+            "ask_volume": self.totals["ask_volume"].copy(),
+            "net_cashflow": self.totals["net_cashflow"] / num_brokers,
+            "eod_net_cashflow": self.totals["eod_net_cashflow"] / num_brokers,
+        }
+        return {name: outputs[name] for name in ENSEMBLE_OUTPUTS}
+
+    def save(self):
+        """Write the brokers and action counts changed since the last save, the watermark and the file offset"""
+        if self.checkpoint is None:
+            return
+        import pyarrow as pa
+
+        state = self.checkpoint.state or {"counts": []}
+        if self._changed_ids:
+            ids = np.unique(np.concatenate(self._changed_ids))
+            counts = self.actions[np.searchsorted(self.order_ids, ids)]
+            table = pa.table({"order_id": ids, **{name: counts[:, i] for i, (name, _) in enumerate(ACTIONS)}})
+            name = f"counts-{len(state['counts']):06d}.arrow"
+            path = os.path.join(self.checkpoint.directory, name)
+            with pa.OSFile(path + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(path + ".tmp", path)
+            state = {**state, "counts": state["counts"] + [name]}
+            self._changed_ids = []
+        state.update(watermark=self.watermark, source=self.source, offset=self.offset)
+        self.checkpoint.write(self.pool, np.ones(len(self.pool), dtype=bool), force=True, state=state)
@@ -1,102 +1,418 @@
 import polars as pl
-import random
+import numpy as np
+from bisect import bisect_left, insort
+from collections.abc import MutableMapping
+
+from grid import HOURLY, SettlementGrid
+import profiling
+from profiling import NETTING_COUNTERS
+
+# Broker attribute -> BrokerPool matrix holding that ledger
+LEDGERS = {"hashmap": "net", "ask_hashmap": "ask", "bid_hashmap": "bid", "eod_hashmap": "eod"}
+
+# per-broker state netting writes, what a checkpoint has to keep (eod is recomputed from the orders)
+STATE_MATRICES = ("net", "ask", "bid", "counters", "rng_states")
+
+# a packed PCG64 state: state and increment (128 bits each, high word first) and the buffered uint32
+RNG_STATE_WORDS = 6
+_MASK64 = (1 << 64) - 1
+
+
+def pack_rng(rng: np.random.Generator) -> np.ndarray:
+    """A generator's PCG64 state as RNG_STATE_WORDS uint64s, so it fits in a BrokerPool row"""
+    state = rng.bit_generator.state
+    inner = state["state"]
+    return np.array([inner["state"] >> 64, inner["state"] & _MASK64, inner["inc"] >> 64, inner["inc"] & _MASK64,
+                     state["has_uint32"], state["uinteger"]], dtype=np.uint64)
+
+
+def unpack_rng(words) -> np.random.Generator:
+    """Generator continuing from a pack_rng state"""
+    words = [int(word) for word in words]
+    bit_generator = np.random.PCG64()
+    bit_generator.state = {
+        "bit_generator": "PCG64",
+        "state": {"state": words[0] << 64 | words[1], "inc": words[2] << 64 | words[3]},
+        "has_uint32": words[4],
+        "uinteger": words[5],
+    }
+    return np.random.Generator(bit_generator)
+
+
+class LedgerView(MutableMapping):
+    """
+    Dict-compatible view of one broker's row in a BrokerPool ledger, keyed by bucket label ("HH:MM")
+
+    Reads and writes go straight to the underlying matrix, so code written against the old
+    per-broker dicts (.items(), [key] += x, dict(...)) keeps working.
+    """
+    __slots__ = ("_slots", "_row")
+
+    def __init__(self, slots, row):
+        self._slots = slots
+        self._row = row
+
+    def __getitem__(self, key):
+        return float(self._row[self._slots[key]])
+
+    def __setitem__(self, key, value):
+        self._row[self._slots[key]] = value
+
+    def __delitem__(self, key):
+        raise TypeError("settlement hours can't be removed from a ledger")
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class BrokerPool():
+    """
+    Structure-of-arrays ledger state for many brokers
+
+    One (num_brokers, num_buckets) float64 matrix per ledger: net (Broker.hashmap), ask, bid and eod.
+    Row i is broker i, column j is settlement bucket keys[j] of the grid (hourly 14:00-22:00 by
+    default). Cross-broker aggregation is a sum(axis=0) over the matrix, and pool[i] gives a
+    Broker bound to row i. counters holds each broker's netting counters (profiling.NETTING_COUNTERS),
+    rng_states the state its generator was left in by its last netting (pack_rng), and dirty flags
+    the brokers netting or EOD netting changed since it was last cleared (see checkpoint.Checkpoint).
+    """
+
+    def __init__(self, num_brokers: int, grid: SettlementGrid = None):
+        self.grid = grid if grid is not None else HOURLY
+        self.keys = list(self.grid.labels)
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+
+        shape = (num_brokers, len(self.keys))
+        self.net = np.zeros(shape)
+        self.ask = np.zeros(shape)
+        self.bid = np.zeros(shape)
+        self.eod = np.zeros(shape)
+        self.counters = np.zeros((num_brokers, len(NETTING_COUNTERS)))
+        self.rng_states = np.zeros((num_brokers, RNG_STATE_WORDS), dtype=np.uint64)
+        self.dirty = np.zeros(num_brokers, dtype=bool)
+
+    def __len__(self):
+        return self.net.shape[0]
+
+    def __getitem__(self, index):
+        return Broker(client_orders=None, pool=self, index=index)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def rows(self, start: int, stop: int) -> "BrokerPool":
+        """New pool holding a copy of brokers [start, stop)"""
+        part = BrokerPool(stop - start, self.grid)
+        for matrix in STATE_MATRICES + ("eod", "dirty"):
+            getattr(part, matrix)[:] = getattr(self, matrix)[start:stop]
+        return part
+
+    def ledger(self, name):
+        """Matrix for a Broker ledger attribute name ("hashmap", "ask_hashmap", ...)"""
+        return getattr(self, LEDGERS[name])
+
+    def eod_netting(self, orders: pl.DataFrame, broker_col: str = "broker_id"):
+        """
+        End-of-day netting for every broker at once
+
+        Parameters:
+        - orders: all brokers' client orders (ts_event, side, price, size) plus a broker_col column
+          holding each order's row in this pool
+
+        Each broker's net ask - bid cashflow per bucket is summed in a single pass over the orders
+        and carried forward with a cumulative sum along the buckets. Cost grows with the number of
+        orders, not with brokers x buckets.
+        """
+        self.eod_netting_arrays(
+            orders[broker_col].to_numpy(),
+            self.grid.slots_of(orders['ts_event']),
+            (orders['side'] == 'A').to_numpy(),
+            (orders['price'] * orders['size']).to_numpy(),
+        )
+
+    def eod_netting_arrays(self, broker_ids, slots, is_ask, notionals):
+        """Same as eod_netting, for orders already held as numpy arrays with their grid slots"""
+        num_brokers, num_slots = self.eod.shape
+        slots = np.asarray(slots, dtype=np.int64)
+        in_window = slots >= 0
+        signed = np.where(is_ask, notionals, -np.asarray(notionals))[in_window]
+        cells = np.asarray(broker_ids)[in_window] * num_slots + slots[in_window]
+        net = np.bincount(cells, weights=signed, minlength=num_brokers * num_slots)
+        np.cumsum(net.reshape(num_brokers, num_slots), axis=1, out=self.eod)
+        self.dirty[np.unique(broker_ids)] = True
+
+    def totals(self, name):
+        """Bucket key -> sum across all brokers of one ledger"""
+        with profiling.stage("aggregation", rows_in=len(self), ledger=name) as span:
+            totals = dict(zip(self.keys, self.ledger(name).sum(axis=0).tolist()))
+            span.rows_out = len(totals)
+        return totals
+
 
 class Broker():
+    __slots__ = ("client_orders", "rng", "pool", "index")
 
-    def __init__(self, client_orders: pl.DataFrame):
+    def __init__(self, client_orders: pl.DataFrame, seed=None, pool: BrokerPool = None, index: int = 0,
+                 grid: SettlementGrid = None):
         self.client_orders = client_orders
-        self.hashmap = {}
-        for hour in range(14, 22):
-            self.hashmap[f"{hour:02d}:00"] = 0
+        # every settlement draw comes from this generator so runs can be reproduced per broker
+        self.rng = np.random.default_rng(seed)
 
-        self.ask_hashmap = {}
-        for hour in range(14, 22):
-            self.ask_hashmap[f"{hour:02d}:00"] = 0
+        # ledgers live in a row of a BrokerPool, a standalone broker gets a pool of its own
+        self.pool = pool if pool is not None else BrokerPool(1, grid)
+        self.index = index
+        return
 
-        self.bid_hashmap = {}
-        for hour in range(14, 22):
-            self.bid_hashmap[f"{hour:02d}:00"] = 0
+    @property
+    def hashmap(self):
+        return LedgerView(self.pool.slots, self.pool.net[self.index])
+
+    @property
+    def ask_hashmap(self):
+        return LedgerView(self.pool.slots, self.pool.ask[self.index])
+
+    @property
+    def bid_hashmap(self):
+        return LedgerView(self.pool.slots, self.pool.bid[self.index])
+
+    @property
+    def eod_hashmap(self):
+        return LedgerView(self.pool.slots, self.pool.eod[self.index])
+
+    def save_rng(self):
+        """Record the generator's state in the pool's rng_states row and flag the broker dirty"""
+        self.pool.rng_states[self.index] = pack_rng(self.rng)
+        self.pool.dirty[self.index] = True
 
-        self.eod_hashmap = {}
-        for hour in range(14, 22):
-            self.eod_hashmap[f"{hour:02d}:00"] = 0
-        return
-    
     def netting_algorithm(self, event: pl.DataFrame):
+        # one event at a time, so the generator state isn't packed here - call save_rng once the
+        # broker's events are done, before the pool is checkpointed
         # Extract relevant details from the event
         event_time = event['ts_event'][0]  # Timestamp of the event
-        hour_of_trade = event_time.hour  # Extract the hour
         is_ask = event['side'][0] == 'A'  # True if it's an ask (selling), False if it's a bid (buying)
         value_of_trade = event['price'][0] * event['size'][0]  # Total value of the trade
 
+        net = self.pool.net[self.index]
+        ask = self.pool.ask[self.index]
+        bid = self.pool.bid[self.index]
+
         # Calculate cash flow impact
         cashflow_impact = value_of_trade if is_ask else -value_of_trade
 
+        counters = self.pool.counters[self.index]
+        counters[0] += 1
+
         # Random settlement logic
-        if random.random() < 0.2:  # 20% probability
-            fixed_hour = random.choice(list(self.hashmap.keys()))  # Choose a random hour
-            self.hashmap[fixed_hour] += cashflow_impact
+        # always take two draws per event (branch, bucket) so this path lines up with net_orders
+        u, v = self.rng.random(2)
+        if u < 0.2:  # 20% probability
+            counters[1] += 1
+            fixed = int(v * len(net))  # Choose a random bucket
+            net[fixed] += cashflow_impact
             if is_ask:
-                self.ask_hashmap[fixed_hour] += value_of_trade
+                ask[fixed] += value_of_trade
             else:
-                self.bid_hashmap[fixed_hour] += value_of_trade
+                bid[fixed] += value_of_trade
             return  # Exit early as settlement time is fixed
 
-        # Update hashmap
-        current_hour_key = f"{hour_of_trade:02d}:00"
-        self.hashmap[current_hour_key] += cashflow_impact
+        # Update ledgers
+        current = self.pool.grid.slot_of_time(event_time)
+        if current < 0:
+            raise KeyError(f"{event_time:%H:%M:%S} is outside the settlement grid")
+        net[current] += cashflow_impact
         if is_ask:
-            self.ask_hashmap[current_hour_key] += value_of_trade
+            ask[current] += value_of_trade
         else:
-            self.bid_hashmap[current_hour_key] += value_of_trade
+            bid[current] += value_of_trade
 
-        # Netting logic
-        for hour_key, balance in sorted(self.hashmap.items()):
-            if hour_key >= current_hour_key:  # Only adjust from earlier to the current hour
-                break
+        # Netting logic: only adjust from earlier buckets to the current one
+        impact = cashflow_impact
+        transfers = 0
+        for slot in range(current):
+            balance = net[slot]
 
             # If there's an imbalance, net it out
             if balance > 0 and cashflow_impact < 0:  # Bid position
                 net_amount = min(balance, abs(cashflow_impact))
-                self.hashmap[hour_key] -= net_amount
+                net[slot] -= net_amount
                 cashflow_impact += net_amount
 
-                self.bid_hashmap[hour_key] += net_amount
-                self.bid_hashmap[current_hour_key] -= net_amount
+                bid[slot] += net_amount
+                bid[current] -= net_amount
+                transfers += 1
 
             elif balance < 0 and cashflow_impact > 0:  # Ask position
                 net_amount = min(abs(balance), cashflow_impact)
-                self.hashmap[hour_key] += net_amount
+                net[slot] += net_amount
                 cashflow_impact -= net_amount
 
-                self.ask_hashmap[hour_key] += net_amount
-                self.ask_hashmap[current_hour_key] -= net_amount
+                ask[slot] += net_amount
+                ask[current] -= net_amount
+                transfers += 1
 
             # Break early if fully netted
             if cashflow_impact == 0:
                 break
 
-        # Ensure the hashmap reflects final cashflow impact
-        self.hashmap[current_hour_key] = cashflow_impact
+        # Ensure the ledger reflects final cashflow impact
+        net[current] = cashflow_impact
+        counters[2] += transfers > 0
+        counters[3] += transfers
+        counters[4] += abs(impact - cashflow_impact)
+
+        return
+
+    def net_orders(self, hours, sides, notionals):
+        """
+        Batch version of netting_algorithm over a whole chunk of client orders
+
+        Parameters:
+        - hours: array of trade hours (UTC), one per order, placed at the top of the hour on the grid
+        - sides: array of 'A'/'B' sides (NumPy, Arrow or polars), or a boolean is-ask mask
+        - notionals: array of price * size, one per order
+
+        Orders are netted in the order given. The random settlement draws are taken in bulk
+        from self.rng, two per order, so the result matches feeding the same orders through
+        netting_algorithm one by one with the same seed.
+        """
+        self.net_slots(self.pool.grid.slot_of_hours(hours), sides, notionals)
+
+    def net_slots(self, slots, sides, notionals):
+        """
+        net_orders for orders already mapped onto the settlement grid (see SettlementGrid.slots_of)
+
+        Earlier buckets holding a balance of the opposite sign are kept in two sorted lists, so
+        each order only visits the buckets it actually nets against - O(log B) to find them instead
+        of scanning all B earlier buckets. This is what keeps minute-level grids cheap.
+        """
+        num_slots = len(self.pool.keys)
+        slots = np.asarray(slots, dtype=np.int64)
+
+        sides = np.asarray(sides)
+        is_ask = sides if sides.dtype == np.bool_ else sides == 'A'
+        notionals = np.asarray(notionals, dtype=np.float64)
+        impacts = np.where(is_ask, notionals, -notionals).tolist()
+
+        # two draws per order: whether it takes the random branch, and which bucket it lands on
+        draws = self.rng.random((len(slots), 2))
+        random_branch = draws[:, 0] < 0.2
+        fixed_slots = np.where(random_branch, (draws[:, 1] * num_slots).astype(np.int64), -1).tolist()
+
+        # work on plain lists indexed by bucket, the pool rows are only touched at the end
+        net_row = self.pool.net[self.index]
+        ask_row = self.pool.ask[self.index]
+        bid_row = self.pool.bid[self.index]
+        net = net_row.tolist()
+        ask = ask_row.tolist()
+        bid = bid_row.tolist()
+
+        # sorted bucket indices with a positive / negative net balance
+        positive = [slot for slot, balance in enumerate(net) if balance > 0]
+        negative = [slot for slot, balance in enumerate(net) if balance < 0]
+
+        def rebalance(slot, old, new):
+            # move a bucket between the sign indices after its balance changed
+            if (old > 0) == (new > 0) and (old < 0) == (new < 0):
+                return
+            if old > 0:
+                del positive[bisect_left(positive, slot)]
+            elif old < 0:
+                del negative[bisect_left(negative, slot)]
+            if new > 0:
+                insort(positive, slot)
+            elif new < 0:
+                insort(negative, slot)
+
+        # netting counters: orders that netted against an earlier bucket, transfers, notional offset
+        netted_orders = transfers = 0
+        notional_offset = 0.0
+
+        for current, fixed, cashflow_impact, ask_side, value_of_trade in zip(
+            slots.tolist(), fixed_slots, impacts, is_ask.tolist(), notionals.tolist()
+        ):
+            if fixed >= 0:
+                old = net[fixed]
+                net[fixed] = old + cashflow_impact
+                rebalance(fixed, old, net[fixed])
+                if ask_side:
+                    ask[fixed] += value_of_trade
+                else:
+                    bid[fixed] += value_of_trade
+                continue
+
+            if current < 0:
+                raise KeyError("order outside the settlement grid")
+
+            # the current bucket ends up holding whatever is left after netting,
+            # so its running balance never needs to be updated before the scan
+            impact = cashflow_impact
+            if ask_side:
+                ask[current] += value_of_trade
+                # asks net against earlier short (negative) buckets, earliest first
+                while cashflow_impact > 0 and negative and negative[0] < current:
+                    slot = negative[0]
+                    balance = net[slot]
+                    net_amount = min(abs(balance), cashflow_impact)
+                    net[slot] = balance + net_amount
+                    cashflow_impact -= net_amount
+
+                    ask[slot] += net_amount
+                    ask[current] -= net_amount
+                    transfers += 1
+                    if net[slot] == 0:
+                        del negative[0]
+            else:
+                bid[current] += value_of_trade
+                # bids net against earlier long (positive) buckets, earliest first
+                while cashflow_impact < 0 and positive and positive[0] < current:
+                    slot = positive[0]
+                    balance = net[slot]
+                    net_amount = min(balance, abs(cashflow_impact))
+                    net[slot] = balance - net_amount
+                    cashflow_impact += net_amount
+
+                    bid[slot] += net_amount
+                    bid[current] -= net_amount
+                    transfers += 1
+                    if net[slot] == 0:
+                        del positive[0]
+
+            if cashflow_impact != impact:
+                netted_orders += 1
+                notional_offset += abs(impact - cashflow_impact)
+
+            old = net[current]
+            net[current] = cashflow_impact
+            rebalance(current, old, cashflow_impact)
+
+        net_row[:] = net
+        ask_row[:] = ask
+        bid_row[:] = bid
+        self.pool.counters[self.index] += (
+            len(slots), random_branch.sum(), netted_orders, transfers, notional_offset
+        )
+        self.save_rng()
 
         return
 
 
     def eod_netting(self):
 
-        # Take the whole client_orders, then go through each row, determining the maximum amount of cash outlay they would have to keep
-        # basically net all orders within each hour - that's the max cash outlay
-        # add that to self.eod_hashmap
-        for hour in range(14, 22):
-            hour_key = f"{hour:02d}:00"
-            before_hour_key = f"{hour-1:02d}:00"
-            orders_in_hour = self.client_orders.filter(pl.col('ts_event').dt.hour() == hour)
-            ask_total = orders_in_hour.filter(pl.col('side') == 'A')
-            bid_total = orders_in_hour.filter(pl.col('side') == 'B')
-            net = sum(ask_total['price'] * ask_total['size']) - sum(bid_total['price'] * bid_total['size'])
-            if hour != 14:
-                self.eod_hashmap[hour_key] = self.eod_hashmap[before_hour_key] + net
-
-            # add to previous actually
-
-        return
\ No newline at end of file
+        # Take the whole client_orders and net all orders within each bucket - that's the max cash outlay
+        # for the bucket - then carry it forward so each bucket holds the running net since the open
+        slots = self.pool.grid.slots_of(self.client_orders['ts_event'])
+        in_window = slots >= 0
+        is_ask = (self.client_orders['side'] == 'A').to_numpy()
+        notionals = (self.client_orders['price'] * self.client_orders['size']).to_numpy()
+        signed = np.where(is_ask, notionals, -notionals)[in_window]
+        net = np.bincount(slots[in_window], weights=signed, minlength=len(self.pool.keys))
+        np.cumsum(net, out=self.pool.eod[self.index])
+        self.pool.dirty[self.index] = True
+
+        return
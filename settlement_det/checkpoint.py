@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import profiling
+from broker import STATE_MATRICES, BrokerPool
+
+MANIFEST = "manifest.json"
+
+
+def orders_fingerprint(columns) -> str:
+    """Hash of simulate_brokers' order columns, so a checkpoint is never resumed on different orders"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(columns):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(columns[name]).tobytes())
+    return digest.hexdigest()
+
+
+def _write_json(path, value):
+    with open(path + ".tmp", "w") as file:
+        json.dump(value, file)
+    os.replace(path + ".tmp", path)
+
+
+class Checkpoint():
+    """
+    Incremental on-disk checkpoint of a broker simulation, so a long run can be resumed
+
+    directory/manifest.json names the run (its settings and seed entropy) and lists the delta
+    files in the order they were written. Each delta-NNNNNN.arrow is an Arrow IPC file with one
+    row per broker that changed since the previous delta (BrokerPool.dirty): its net / ask / bid
+    / counters rows, its generator state and whether its netting is finished. Replaying the
+    deltas in order gives back the pool, and a checkpoint only costs what changed since the last
+    one. Deltas and the manifest go through temporary files, so a run killed mid-write still has
+    its last complete checkpoint.
+
+        checkpoint = Checkpoint("run.checkpoint")
+        pool = simulate_brokers(df, 100_000, seed=0, checkpoint=checkpoint)  # re-run to resume
+        checkpoint.clear()
+
+    Parameters:
+    - directory: where the manifest and deltas are kept
+    - interval: seconds between checkpoints, write() does nothing until one is due
+    - reset: start over when the directory holds a checkpoint of a run with other settings,
+      rather than raising ValueError
+    - matrices: BrokerPool matrices kept per broker, STATE_MATRICES by default
+    """
+
+    def __init__(self, directory, interval: float = 30.0, reset: bool = False, matrices=STATE_MATRICES):
+        self.directory = directory
+        self.interval = interval
+        self.reset = reset
+        self.matrices = tuple(matrices)
+        self.manifest = None
+        self._last = time.perf_counter()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def open(self, settings: dict, entropy: int) -> int:
+        """
+        Start a checkpoint for a run, or pick up the one already in the directory
+
+        Parameters:
+        - settings: JSON-able description of the run, a checkpoint left by a run with other
+          settings is never resumed
+        - entropy: seed entropy of this run, used only if there's nothing to resume
+
+        Returns: the seed entropy to run with, the checkpoint's own when resuming (so a run
+        started without a seed still resumes with the same draws)
+        """
+        path = self._path(MANIFEST)
+        manifest = None
+        if os.path.exists(path):
+            with open(path) as file:
+                manifest = json.load(file)
+            if manifest["settings"] != settings:
+                if not self.reset:
+                    raise ValueError(f"checkpoint at {self.directory} was written by a run with different settings")
+                self.clear()
+                manifest = None
+        if manifest is not None:
+            self.manifest = manifest
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            self.manifest = {"settings": settings, "entropy": int(entropy), "deltas": []}
+            _write_json(path, self.manifest)
+        self._last = time.perf_counter()
+        return self.manifest["entropy"]
+
+    def restore(self, pool: BrokerPool):
+        """
+        Replay every delta into pool
+
+        Returns: boolean array, True for brokers whose netting had finished
+        """
+        import pyarrow as pa
+
+        done = np.zeros(len(pool), dtype=bool)
+        with profiling.stage("checkpoint_restore", deltas=len(self.manifest["deltas"])) as span:
+            for name in self.manifest["deltas"]:
+                with pa.memory_map(self._path(name)) as source:
+                    table = pa.ipc.open_file(source).read_all()
+                    rows = table.column("broker_id").to_numpy()
+                    for matrix in self.matrices:
+                        values = table.column(matrix).combine_chunks().flatten().to_numpy()
+                        getattr(pool, matrix)[rows] = values.reshape(len(rows), -1)
+                    done[rows] = table.column("done").to_numpy(zero_copy_only=False)
+            span.rows_out = int(done.sum())
+        pool.dirty[:] = False
+        return done
+
+    @property
+    def state(self):
+        """The state passed to the last write(), None if there was none"""
+        return self.manifest.get("state") if self.manifest is not None else None
+
+    def write(self, pool: BrokerPool, done, force: bool = False, state: dict = None) -> bool:
+        """
+        Write the brokers changed since the last checkpoint if one is due (or force), and clear their dirty flags
+
+        Parameters:
+        - pool, done: the run's pool and its finished-broker flags
+        - force: write even if the interval hasn't passed
+        - state: JSON-able run state saved in the manifest along with this delta, e.g. a watermark
+
+        Returns: whether a checkpoint was written
+        """
+        if not force and time.perf_counter() - self._last < self.interval:
+            return False
+        if state is not None:
+            self.manifest["state"] = state
+        rows = np.flatnonzero(pool.dirty)
+        if len(rows):
+            import pyarrow as pa
+
+            with profiling.stage("checkpoint", rows_in=len(rows)) as span:
+                columns = {"broker_id": pa.array(rows.astype(np.uint32)), "done": pa.array(done[rows])}
+                for matrix in self.matrices:
+                    values = getattr(pool, matrix)[rows]
+                    columns[matrix] = pa.FixedSizeListArray.from_arrays(pa.array(values.ravel()), values.shape[1])
+                table = pa.table(columns)
+
+                name = f"delta-{len(self.manifest['deltas']):06d}.arrow"
+                with pa.OSFile(self._path(name) + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                os.replace(self._path(name) + ".tmp", self._path(name))
+                # the delta only counts once the manifest lists it
+                self.manifest["deltas"].append(name)
+                _write_json(self._path(MANIFEST), self.manifest)
+                pool.dirty[rows] = False
+                span.rows_out = len(rows)
+        elif state is not None:
+            _write_json(self._path(MANIFEST), self.manifest)
+        self._last = time.perf_counter()
+        return True
+
+    def clear(self):
+        """Remove the checkpoint, once the run's output is safely written"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.manifest = None
@@ -0,0 +1,199 @@
+import json
+
+import numpy as np
+
+import profiling
+from broker import BrokerPool
+from contracts import ORDER_TYPES, PRICE, contract_columns
+
+BID, ASK = ORDER_TYPES.index("Bid"), ORDER_TYPES.index("Ask")
+
+# matching.cs defaults: settlement fee, and the market-making regression behind the rebate volume
+SETTLEMENT_FEE = 0.000002
+REBATE_CONSTANT = 20_760_000
+REBATE_GRADIENT = 15_710_000
+
+
+def _match_slot(bid_price, bid_quantity, ask_price, ask_quantity):
+    """
+    Volume and value matched in one settlement slot, bids best (highest) first and asks best (lowest) first
+
+    Walking both sides along their cumulative quantity, every stretch where one bid overlaps one
+    ask is a fill; the bid price only falls and the ask price only rises along the way, so fills
+    stop at the first stretch that doesn't cross - what matching.cs's two-pointer loop does.
+
+    Returns: (matched quantity, matched value at the ask price)
+    """
+    if len(bid_quantity) == 0 or len(ask_quantity) == 0:
+        return 0.0, 0.0
+    bid_end, ask_end = np.cumsum(bid_quantity), np.cumsum(ask_quantity)
+    limit = min(bid_end[-1], ask_end[-1])
+
+    # stretches start at 0 and wherever a bid or an ask runs out
+    starts = np.unique(np.concatenate([[0.0], bid_end, ask_end]))
+    starts = starts[starts < limit]
+    lengths = np.diff(np.append(starts, limit))
+    bid_index = np.searchsorted(bid_end, starts, side="right")
+    ask_index = np.searchsorted(ask_end, starts, side="right")
+
+    crossed = bid_price[bid_index] >= ask_price[ask_index]
+    filled = len(crossed) if crossed.all() else int(np.argmin(crossed))
+    return float(lengths[:filled].sum()), float(lengths[:filled] @ ask_price[ask_index[:filled]])
+
+
+class Clearing():
+    """
+    In-process version of matching.cs: matches every broker's bid and ask contracts per settlement
+    slot, then prices whole grids of rebate / fee scenarios against what is left unsettled
+
+    Contracts come straight from the BrokerPool ledgers (bid_hashmap / ask_hashmap), so nothing
+    has to go through contracts.json / contracts.arrow and a dotnet run per scenario. Matching
+    doesn't depend on the scenario and is done once; scenarios() is then a broadcast over the
+    rebate x fee grid.
+
+    Parameters:
+    - columns: contract columns as contracts.contract_columns gives them (broker_id,
+      settlement_slot, order_type, price, quantity)
+    - keys: settlement bucket labels, indexed by settlement_slot
+
+    Attributes (per slot, in keys order):
+    - matched: quantity matched between bids and asks
+    - value: matched quantity x ask price, what SettleContractsAll adds to the settled volume
+    - unsettled_bid, unsettled_ask: quantity left over on each side
+    - residual: quantity left on each contract after matching, in the order of columns
+    """
+
+    def __init__(self, columns, keys):
+        self.columns = columns
+        self.keys = list(keys)
+        num_slots = len(self.keys)
+
+        slots = np.asarray(columns["settlement_slot"], dtype=np.int64)
+        order_type = np.asarray(columns["order_type"])
+        price = np.asarray(columns["price"], dtype=np.float64)
+        quantity = np.asarray(columns["quantity"], dtype=np.float64)
+
+        # slots matching.cs has an hour group for, the rebate is paid once for each of them
+        self.has_contracts = np.bincount(slots, minlength=num_slots) > 0
+
+        self.matched = np.zeros(num_slots)
+        self.value = np.zeros(num_slots)
+        self.residual = quantity.copy()
+
+        with profiling.stage("clearing", rows_in=len(quantity), slots=num_slots) as span:
+            is_bid = order_type == BID
+            # price-ordered within each slot, ties kept in contract order like the stable LINQ OrderBy
+            bids = np.flatnonzero(is_bid)
+            bids = bids[np.lexsort((-price[bids], slots[bids]))]
+            asks = np.flatnonzero(order_type == ASK)
+            asks = asks[np.lexsort((price[asks], slots[asks]))]
+            bid_bounds = np.searchsorted(slots[bids], np.arange(num_slots + 1))
+            ask_bounds = np.searchsorted(slots[asks], np.arange(num_slots + 1))
+
+            for slot in range(num_slots):
+                slot_bids = bids[bid_bounds[slot]:bid_bounds[slot + 1]]
+                slot_asks = asks[ask_bounds[slot]:ask_bounds[slot + 1]]
+                matched, value = _match_slot(price[slot_bids], quantity[slot_bids], price[slot_asks], quantity[slot_asks])
+                self.matched[slot], self.value[slot] = matched, value
+
+                # each side is filled from its best contract down until the matched quantity runs out
+                for side in (slot_bids, slot_asks):
+                    before = np.cumsum(quantity[side]) - quantity[side]
+                    self.residual[side] -= np.clip(matched - before, 0, quantity[side])
+
+            self.unsettled_bid = np.bincount(slots[is_bid], weights=self.residual[is_bid], minlength=num_slots)
+            self.unsettled_ask = np.bincount(slots[~is_bid], weights=self.residual[~is_bid], minlength=num_slots)
+            span.rows_out = int((self.residual > 0).sum())
+
+    @classmethod
+    def from_pool(cls, pool: BrokerPool, price: float = PRICE):
+        """Clear a finished pool's ask / bid ledgers, every contract at one price"""
+        return cls(contract_columns(pool, price=price), pool.keys)
+
+    @classmethod
+    def from_file(cls, path):
+        """Clear a contracts.arrow / contracts.parquet export written by contracts.ContractWriter"""
+        import pyarrow as pa
+
+        if str(path).endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            table = pq.read_table(path)
+        else:
+            with pa.memory_map(str(path)) as source:
+                table = pa.ipc.open_file(source).read_all()
+        keys = json.loads(table.schema.metadata[b"settlement_labels"])
+        order_type = table.column("order_type").combine_chunks()
+        # the dictionary may not list the types in ORDER_TYPES order
+        codes = np.array([ORDER_TYPES.index(name) for name in order_type.dictionary.to_pylist()], dtype=np.int8)
+        columns = {name: table.column(name).to_numpy() for name in ("broker_id", "settlement_slot", "price", "quantity")}
+        columns["order_type"] = codes[order_type.indices.to_numpy()]
+        return cls(columns, keys)
+
+    def unsettled(self):
+        """Settlement bucket -> quantity left unsettled on both sides, like PrintUnsettledContracts"""
+        left = self.unsettled_bid + self.unsettled_ask
+        return {key: float(left[slot]) for slot, key in enumerate(self.keys) if self.has_contracts[slot]}
+
+    def scenarios(self, rebates, fees=SETTLEMENT_FEE, constant: float = REBATE_CONSTANT,
+                  gradient: float = REBATE_GRADIENT, price: float = PRICE):
+        """
+        Rebate cost and fee revenue of every (rebate, fee) pair, matching.cs's metrics in one pass
+
+        Each settlement slot gets constant + gradient * (rebate * 100) * price of added market
+        making volume; the platform pays the rebate on it and charges the fee on it, and it
+        settles against what matching left over, asks first then bids (DynamicMarketMakerRebate).
+        Fees are also charged on the matched value (SettleContractsAll).
+
+        Parameters:
+        - rebates: rebate percentages as fractions (0.0014 is 0.14%), scalar or 1-d
+        - fees: settlement fee fractions, scalar or 1-d
+        - constant, gradient: market-making regression of added volume on the rebate
+        - price: contract price the regression is scaled by
+
+        Returns: dict of (len(rebates), len(fees)) arrays - added_volume (per slot),
+        rebate_volume (settled out of it), rebate_cost, fee_revenue, volume_settled (matched value
+        + rebate volume, summed the way PrintMetrics does) and net_profit
+        """
+        rebates = np.atleast_1d(np.asarray(rebates, dtype=np.float64))[:, None]
+        fees = np.atleast_1d(np.asarray(fees, dtype=np.float64))[None, :]
+        hours = int(self.has_contracts.sum())
+        left = (self.unsettled_ask + self.unsettled_bid)[self.has_contracts]
+
+        added = constant + gradient * (rebates * 100) * price
+        # (rebates, slots): what each slot's added volume settles against its leftovers
+        rebate_volume = np.minimum(np.maximum(added, 0), left[None, :]).sum(axis=1, keepdims=True)
+        rebate_cost = hours * added * rebates
+        fee_revenue = self.value.sum() * fees + hours * added * fees
+
+        shape = np.broadcast_shapes(rebates.shape, fees.shape)
+        return {
+            name: np.broadcast_to(values, shape).copy()
+            for name, values in {
+                "added_volume": added,
+                "rebate_volume": rebate_volume,
+                "rebate_cost": rebate_cost,
+                "fee_revenue": fee_revenue,
+                "volume_settled": self.value.sum() + rebate_volume,
+                "net_profit": fee_revenue - rebate_cost,
+            }.items()
+        }
+
+
+if __name__ == "__main__":
+    # same run as matching.cs's Program.Main, plus a small grid around its rebate
+    import sys
+
+    clearing = Clearing.from_file(sys.argv[1] if len(sys.argv) > 1 else "contracts.arrow")
+    print("Unsettled contracts by settlement hour:")
+    for key, left in clearing.unsettled().items():
+        print(f"{key}: {left} units")
+
+    rebates = np.array([0.0005, 0.001, 0.0014, 0.002, 0.005])
+    fees = np.array([0.00000046, 0.000002, 0.00001])
+    results = clearing.scenarios(rebates, fees)
+    for i, rebate in enumerate(rebates):
+        for j, fee in enumerate(fees):
+            print(f"rebate {rebate:.4%} fee {fee:.5%}: settled {results['volume_settled'][i, j]:,.0f} "
+                  f"revenue {results['fee_revenue'][i, j]:,.2f} rebate cost {results['rebate_cost'][i, j]:,.2f} "
+                  f"net {results['net_profit'][i, j]:,.2f}")
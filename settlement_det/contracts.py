@@ -0,0 +1,152 @@
+import json
+import os
+
+import numpy as np
+
+import profiling
+from broker import BrokerPool
+
+# dictionary of the order_type column, its int8 codes are the index into this tuple
+ORDER_TYPES = ("Bid", "Ask")
+
+# single price assumed across the prototype
+PRICE = 170
+
+FORMATS = {".arrow": "ipc", ".ipc": "ipc", ".feather": "ipc", ".parquet": "parquet", ".json": "json"}
+
+
+def contract_columns(pool: BrokerPool, offset: int = 0, price: float = PRICE):
+    """
+    Flat contract columns for every broker in pool, bid buckets then ask buckets per broker
+
+    Parameters:
+    - pool: BrokerPool (or a batch of one) with the ask / bid ledgers filled in
+    - offset: broker_id of the pool's first row
+    - price: contract price
+
+    Returns: dict of equal-length numpy arrays broker_id, settlement_slot, order_type (index into
+    ORDER_TYPES), price and quantity, in the same order contracts.json always listed them.
+    """
+    num_brokers, num_slots = pool.bid.shape
+    per_broker = 2 * num_slots
+    return {
+        "broker_id": np.repeat(np.arange(offset, offset + num_brokers, dtype=np.uint32), per_broker),
+        "settlement_slot": np.tile(np.arange(num_slots, dtype=np.uint16), 2 * num_brokers),
+        "order_type": np.tile(np.repeat(np.arange(len(ORDER_TYPES), dtype=np.int8), num_slots), num_brokers),
+        "price": np.full(num_brokers * per_broker, price, dtype=np.float64),
+        # (num_brokers, 2, num_slots) -> one row per broker of its bids then asks
+        "quantity": np.stack([pool.bid, pool.ask], axis=1).reshape(-1),
+    }
+
+
+class ContractWriter():
+    """
+    Streams broker contracts for the C# matcher to Arrow IPC, Parquet or JSON as brokers finish
+
+    Arrow / Parquet files hold integer broker ids and settlement slots and a dictionary-encoded
+    order type; the bucket labels ("14:00", ...) go in the schema metadata under
+    "settlement_labels". JSON mode writes the old contracts.json list of
+    {"Id": "Broker_{id}_Bid_{label}", "SettlementHour", "Price", "Quantity", "OrderType"} dicts.
+
+    Pass write as simulate_brokers' on_batch, or call write(pool) on a finished pool.
+    """
+
+    def __init__(self, path, keys, format: str = None, price: float = PRICE):
+        self.path = path
+        self.keys = list(keys)
+        self.format = format or FORMATS.get(os.path.splitext(path)[1].lower())
+        self.price = price
+        self.rows = 0
+        if self.format not in ("ipc", "parquet", "json"):
+            raise ValueError(f"unknown contracts format for {path}, pass format='ipc', 'parquet' or 'json'")
+
+        if self.format == "json":
+            self._file = open(path, "w")
+            self._file.write("[")
+            self._separator = ""
+            return
+
+        import pyarrow as pa
+
+        self._pa = pa
+        self.schema = pa.schema(
+            [
+                ("broker_id", pa.uint32()),
+                ("settlement_slot", pa.uint16()),
+                ("order_type", pa.dictionary(pa.int8(), pa.string())),
+                ("price", pa.float64()),
+                ("quantity", pa.float64()),
+            ],
+            metadata={"settlement_labels": json.dumps(self.keys)},
+        )
+        self._order_types = pa.array(ORDER_TYPES, type=pa.string())
+        if self.format == "ipc":
+            self._writer = pa.ipc.new_file(path, self.schema)
+        else:
+            import pyarrow.parquet as pq
+
+            self._writer = pq.ParquetWriter(path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, start, pool: BrokerPool = None):
+        """Append the contracts of a batch of brokers whose first broker_id is start (write(pool) for a whole pool)"""
+        if pool is None:
+            start, pool = 0, start
+        with profiling.stage("export", rows_in=len(pool), format=self.format) as span:
+            columns = contract_columns(pool, start, self.price)
+            span.rows_out = len(columns["quantity"])
+            self.rows += len(columns["quantity"])
+            if self.format == "json":
+                self._write_json(columns)
+            else:
+                self._write_arrow(columns)
+
+    def _write_arrow(self, columns):
+        pa = self._pa
+        order_type = pa.DictionaryArray.from_arrays(pa.array(columns["order_type"]), self._order_types)
+        batch = pa.record_batch(
+            [
+                pa.array(columns["broker_id"]),
+                pa.array(columns["settlement_slot"]),
+                order_type,
+                pa.array(columns["price"]),
+                pa.array(columns["quantity"]),
+            ],
+            schema=self.schema,
+        )
+        if self.format == "ipc":
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write_table(pa.Table.from_batches([batch]))
+
+    def _write_json(self, columns):
+        # same entries and separators json.dump gave the whole list in one go
+        entries = []
+        for broker_id, slot, order_type, price, quantity in zip(
+            columns["broker_id"].tolist(), columns["settlement_slot"].tolist(), columns["order_type"].tolist(),
+            columns["price"].tolist(), columns["quantity"].tolist(),
+        ):
+            side, label = ORDER_TYPES[order_type], self.keys[slot]
+            entries.append(json.dumps({
+                "Id": f"Broker_{broker_id}_{side}_{label}",
+                "SettlementHour": label,
+                "Price": int(price) if price == int(price) else price,
+                "Quantity": quantity,
+                "OrderType": side,
+            }))
+        if entries:
+            self._file.write(self._separator + ", ".join(entries))
+            self._separator = ", "
+
+    def close(self):
+        if self.format == "json":
+            if not self._file.closed:
+                self._file.write("]")
+                self._file.close()
+        else:
+            self._writer.close()
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import polars as pl
+
+import profiling
+import simulation
+from aggregation import RunningStats, StreamingSummary
+from broker import BrokerPool
+from grid import SettlementGrid
+from simulation import net_brokers, order_columns, order_pool, shuffle_orders
+
+# per-bucket outputs tracked for every replication
+ENSEMBLE_OUTPUTS = ("bid_volume", "ask_volume", "net_cashflow", "eod_net_cashflow")
+
+
+def bucket_outputs(pool: BrokerPool):
+    """ENSEMBLE_OUTPUTS of one run: bid / ask volume summed over brokers, net cashflows averaged over them"""
+    with profiling.stage("aggregation", rows_in=len(pool)) as span:
+        outputs = {
+            "bid_volume": pool.bid.sum(axis=0),
+            "ask_volume": pool.ask.sum(axis=0),
+            "net_cashflow": pool.net.mean(axis=0),
+            "eod_net_cashflow": pool.eod.mean(axis=0),
+        }
+        span.rows_out = len(pool.keys)
+    return outputs
+
+
+# ledgers whose distribution across brokers run_ensemble(distributions=True) keeps
+DISTRIBUTIONS = {"net_cashflow": "net", "eod_net_cashflow": "eod"}
+
+
+def _replicate(first, last, num_brokers, entropy, grid, distributions=False):
+    """
+    Run replications [first, last) on simulation._orders, each with its own shuffle and draws
+
+    Returns: (first, {output name: RunningStats over those replications}, {output name:
+    StreamingSummary over every broker of those replications} or None)
+    """
+    num_orders = len(simulation._orders["slot"])
+    chunk_size = num_orders // num_brokers
+    broker_ids = np.arange(chunk_size * num_brokers) // max(chunk_size, 1)
+
+    stats = sketches = None
+    for replication in range(first, last):
+        key = (replication,)
+        order = shuffle_orders(num_orders, entropy, key)[:chunk_size * num_brokers]
+        slots = simulation._orders["slot"][order]
+        is_ask = simulation._orders["is_ask"][order]
+        notionals = simulation._orders["notional"][order]
+
+        pool = BrokerPool(num_brokers, grid)
+        net_brokers(pool, 0, num_brokers, slots, is_ask, notionals, chunk_size, entropy, key)
+        pool.eod_netting_arrays(broker_ids, slots, is_ask, notionals)
+
+        if stats is None:
+            stats = {name: RunningStats(len(pool.keys)) for name in ENSEMBLE_OUTPUTS}
+            if distributions:
+                sketches = {name: StreamingSummary(len(pool.keys)) for name in DISTRIBUTIONS}
+        for name, values in bucket_outputs(pool).items():
+            stats[name].add(values)
+        if distributions:
+            for name, matrix in DISTRIBUTIONS.items():
+                sketches[name].add(getattr(pool, matrix))
+
+    return first, stats, sketches
+
+
+def run_ensemble(df: pl.DataFrame, num_brokers: int, replications: int, workers=None, seed=None, batch: int = 8,
+                 grid: SettlementGrid = None, distributions: bool = False):
+    """
+    Monte Carlo ensemble of the settlement-choice simulation
+
+    Parameters:
+    - df: preprocessed orders with ts_event, side, price and size columns
+    - num_brokers: number of brokers to split the orders across in every replication
+    - replications: number of replications K, each with its own shuffle and settlement draws
+    - workers: number of worker processes (defaults to the number of cores, 1 runs in-process)
+    - seed: seed for the whole ensemble
+    - batch: replications per task; partial results are merged in replication order, so for a
+      fixed batch the result doesn't depend on the number of workers
+    - grid: settlement buckets (hourly 14:00-22:00 UTC by default)
+    - distributions: also summarise the net / EOD cashflow of every broker in every replication
+      (aggregation.StreamingSummary, bounded memory however many brokers x replications)
+
+    Returns: (bucket keys, {output name: RunningStats}) for "bid_volume" and "ask_volume" (totals
+    across brokers), "net_cashflow" and "eod_net_cashflow" (averages across brokers). With
+    distributions, a third item {"net_cashflow" / "eod_net_cashflow": StreamingSummary}.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    columns = order_columns(df, grid)
+    tasks = [(first, min(first + batch, replications)) for first in range(0, replications, batch)]
+
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        simulation._orders = columns
+        parts = [_replicate(first, last, num_brokers, entropy, grid, distributions) for first, last in tasks]
+    else:
+        with order_pool(columns, workers) as pool:
+            parts = list(pool.map(_replicate, *zip(*tasks),
+                                  [num_brokers] * len(tasks), [entropy] * len(tasks), [grid] * len(tasks),
+                                  [distributions] * len(tasks)))
+
+    keys = BrokerPool(0, grid).keys
+    stats = {name: RunningStats(len(keys)) for name in ENSEMBLE_OUTPUTS}
+    sketches = {name: StreamingSummary(len(keys)) for name in DISTRIBUTIONS}
+    for first, part, part_sketches in sorted(parts, key=lambda item: item[0]):
+        for name in ENSEMBLE_OUTPUTS:
+            stats[name].merge(part[name])
+        if distributions:
+            for name in DISTRIBUTIONS:
+                sketches[name].merge(part_sketches[name])
+    return (keys, stats, sketches) if distributions else (keys, stats)
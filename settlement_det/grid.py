@@ -0,0 +1,82 @@
+import numpy as np
+import polars as pl
+
+NS_PER_SECOND = 10**9
+NS_PER_DAY = 24 * 3600 * NS_PER_SECOND
+
+
+def _time_of_day(text: str) -> int:
+    # "HH:MM" or "HH:MM:SS" -> nanoseconds since midnight
+    parts = [int(part) for part in text.split(":")]
+    hours, minutes, seconds = (parts + [0, 0])[:3]
+    return ((hours * 60 + minutes) * 60 + seconds) * NS_PER_SECOND
+
+
+def _label(time_of_day: int) -> str:
+    seconds = int(time_of_day) // NS_PER_SECOND
+    hours, minutes, seconds = seconds // 3600, seconds // 60 % 60, seconds % 60
+    return f"{hours:02d}:{minutes:02d}" + (f":{seconds:02d}" if seconds else "")
+
+
+class SettlementGrid():
+    """
+    Settlement buckets within the trading day, as [start, end) times of day in UTC
+
+    Bucket i runs from boundaries[i] to boundaries[i + 1] (nanoseconds since midnight) and is
+    labelled by its start, e.g. "14:00" or "14:15". Orders outside the grid map to slot -1.
+    """
+
+    def __init__(self, boundaries):
+        self.boundaries = np.asarray(boundaries, dtype=np.int64)
+        if len(self.boundaries) < 2 or np.any(np.diff(self.boundaries) <= 0):
+            raise ValueError("a settlement grid needs at least two strictly increasing boundaries")
+        self.labels = [_label(start) for start in self.boundaries[:-1]]
+
+    def __len__(self):
+        return len(self.boundaries) - 1
+
+    def __eq__(self, other):
+        return isinstance(other, SettlementGrid) and np.array_equal(self.boundaries, other.boundaries)
+
+    def __repr__(self):
+        return f"SettlementGrid({self.labels[0]}-{_label(self.boundaries[-1])}, {len(self)} buckets)"
+
+    @classmethod
+    def every(cls, minutes: float, start: str = "14:00", end: str = "22:00"):
+        """Equal buckets of `minutes` from start to end (a shorter last bucket if it doesn't divide)"""
+        step = int(minutes * 60 * NS_PER_SECOND)
+        first, last = _time_of_day(start), _time_of_day(end)
+        return cls(np.append(np.arange(first, last, step), last))
+
+    @classmethod
+    def hourly(cls, start_hour: int = 14, end_hour: int = 22):
+        return cls.every(60, f"{start_hour:02d}:00", f"{end_hour:02d}:00")
+
+    @classmethod
+    def from_times(cls, times):
+        """Arbitrary session boundaries, e.g. ["14:30", "16:00", "19:00", "21:00"]"""
+        return cls([_time_of_day(time) for time in times])
+
+    def slots(self, times_of_day):
+        """Bucket index for each time of day (ns since midnight), -1 outside the grid"""
+        slots = np.searchsorted(self.boundaries, np.asarray(times_of_day, dtype=np.int64), side="right") - 1
+        slots[slots >= len(self)] = -1
+        return slots
+
+    def slots_of(self, ts_event: pl.Series):
+        """Bucket index for each UTC timestamp"""
+        epoch_ns = ts_event.dt.cast_time_unit("ns").to_physical().to_numpy()
+        return self.slots(epoch_ns % NS_PER_DAY)
+
+    def slot_of_hours(self, hours):
+        """Bucket index for trades known only by their hour (placed at the top of the hour)"""
+        return self.slots(np.asarray(hours, dtype=np.int64) * 3600 * NS_PER_SECOND)
+
+    def slot_of_time(self, when):
+        """Bucket index for a single datetime"""
+        seconds = (when.hour * 60 + when.minute) * 60 + when.second
+        return int(self.slots([seconds * NS_PER_SECOND + when.microsecond * 1000])[0])
+
+
+# the grid everything used before settlement windows became configurable
+HOURLY = SettlementGrid.hourly(14, 22)
@@ -0,0 +1,142 @@
+import glob
+import itertools
+import os
+
+import polars as pl
+
+import profiling
+
+# columns every analysis keeps from the databento MBO file
+MBO_COLUMNS = ['ts_event', 'side', 'price', 'size', 'action', 'order_id']
+
+
+def _scan(path) -> pl.LazyFrame:
+    if isinstance(path, (pl.DataFrame, pl.LazyFrame)):
+        return path.lazy()
+    path = str(path)
+    return pl.scan_parquet(path) if path.endswith(".parquet") else pl.scan_csv(path)
+
+
+def scan_mbo(path, date=None, columns=MBO_COLUMNS, instrument_id=None, raw: bool = False) -> pl.LazyFrame:
+    """
+    Lazily scan a databento MBO file (csv or parquet) into the preprocessed shape the scripts use
+
+    Parameters:
+    - path: path to the .csv or .parquet MBO file, or a frame of its raw rows
+    - date: "YYYY-MM-DD" to keep only events received on that day (by ts_recv), None for everything
+    - columns: columns to keep
+    - instrument_id: keep only this instrument, None for every instrument in the file
+    - raw: keep price as the fixed precision integer and ts_event as int64 nanoseconds (mbo_store)
+
+    Returns: LazyFrame with bids/asks only, price converted from fixed precision to decimal and
+    ts_event as a UTC datetime (unless raw). The day filter, side filter and projection are all part of the
+    plan, so only the matching rows and columns are ever materialised.
+    """
+    lf = _scan(path)
+    schema = lf.collect_schema()
+
+    if date is not None:
+        if schema["ts_recv"] == pl.String:
+            lf = lf.filter(pl.col("ts_recv").str.starts_with(date))
+        else:
+            # typed timestamps (parquet): a range filter lets row groups outside the day be skipped
+            day = pl.lit(date).str.to_datetime("%Y-%m-%d", time_zone="UTC")
+            ts_recv = pl.col("ts_recv").dt.replace_time_zone("UTC") if schema["ts_recv"].time_zone is None else pl.col("ts_recv")
+            lf = lf.filter((ts_recv >= day) & (ts_recv < day.dt.offset_by("1d")))
+
+    if instrument_id is not None:
+        lf = lf.filter(pl.col("instrument_id") == instrument_id)
+
+    lf = lf.filter(pl.col("side") != "N").select(columns) # only bids and asks (idk what N is)
+
+    if "price" in columns and not raw:
+        lf = lf.with_columns((pl.col('price') * 1e-9).alias('price')) # fixed precision integer to decimal
+    if "ts_event" in columns and schema["ts_event"] == pl.String:
+        lf = lf.with_columns(pl.col("ts_event").str.to_datetime(time_unit="ns", time_zone="UTC")) # UTC
+    if "ts_event" in columns and raw:
+        lf = lf.with_columns(pl.col("ts_event").dt.cast_time_unit("ns").to_physical())
+
+    return lf
+
+
+def load_mbo(path, date=None, columns=MBO_COLUMNS, instrument_id=None) -> pl.DataFrame:
+    """Collect scan_mbo with the streaming engine, so peak memory follows the selected day, not the file"""
+    with profiling.stage("preprocessing", path=str(path), date=date) as span:
+        df = scan_mbo(path, date, columns, instrument_id).collect(engine="streaming")
+        span.rows_out = len(df)
+    return df
+
+
+def _recv_date(dtype) -> pl.Expr:
+    # "YYYY-MM-DD" of ts_recv, the day convention of scan_mbo's date filter
+    if dtype == pl.String:
+        return pl.col("ts_recv").str.slice(0, 10)
+    ts_recv = pl.col("ts_recv").dt.convert_time_zone("UTC") if dtype.time_zone is not None else pl.col("ts_recv")
+    return ts_recv.dt.date().cast(pl.String)
+
+
+def mbo_partitions(path) -> pl.DataFrame:
+    """
+    (date, instrument_id) partitions of a databento MBO file, in the same day convention as scan_mbo
+
+    Returns: DataFrame with date ("YYYY-MM-DD" of ts_recv), instrument_id and the number of bid/ask
+    events in each, sorted by date then instrument_id. Only those three columns are ever read.
+    """
+    lf = _scan(path)
+    date = _recv_date(lf.collect_schema()["ts_recv"])
+    return (
+        lf.filter(pl.col("side") != "N")
+        .group_by(date.alias("date"), "instrument_id")
+        .agg(pl.len().alias("events"))
+        .sort("date", "instrument_id")
+        .collect(engine="streaming")
+    )
+
+
+def split_path(root, date: str, instrument_id: int):
+    # every file split_mbo wrote for one partition, as a glob scan_mbo takes
+    return os.path.join(root, f"_date={date}", f"_instrument_id={instrument_id}", "*.parquet")
+
+
+def split_mbo(path, root, partitions=None) -> dict:
+    """
+    Split a databento MBO file into parquet files per (date, instrument_id), in one streaming pass
+
+    The rows keep the file's columns as they are, so scan_mbo / load_mbo on a partition's files
+    give what they give on the whole file filtered to that partition, while reading only its
+    rows. Memory stays at about one streaming batch however big the file is.
+
+    Parameters:
+    - path: databento MBO file (csv or parquet)
+    - root: directory the partitions are written under (replacing what's there)
+    - partitions: (date, instrument_id) pairs to keep, None for every partition
+
+    Returns: {(date, instrument_id): split_path of its files} for the partitions asked for
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    lf = _scan(path)
+    schema = lf.collect_schema()
+    lf = lf.filter(pl.col("side") != "N").with_columns(
+        _recv_date(schema["ts_recv"]).alias("_date"), pl.col("instrument_id").alias("_instrument_id"),
+    )
+    if partitions is not None:
+        dates, instruments = zip(*partitions) if partitions else ((), ())
+        lf = lf.filter(pl.col("_date").is_in(list(set(dates))) & pl.col("_instrument_id").is_in(list(set(instruments))))
+
+    with profiling.stage("split", path=str(path)):
+        batches = (batch for frame in lf.collect_batches(engine="streaming") for batch in frame.to_arrow().to_batches())
+        first = next(batches, None)
+        if first is not None:
+            keys = pa.schema([first.schema.field("_date"), first.schema.field("_instrument_id")])
+            ds.write_dataset(
+                itertools.chain([first], batches), root, schema=first.schema, format="parquet",
+                partitioning=ds.partitioning(keys, flavor="hive"),
+                basename_template="part-{i}.parquet", existing_data_behavior="delete_matching",
+            )
+    if partitions is None:
+        found = glob.glob(os.path.join(root, "_date=*", "_instrument_id=*"))
+        partitions = [(os.path.basename(os.path.dirname(directory))[len("_date="):],
+                       int(os.path.basename(directory)[len("_instrument_id="):])) for directory in found]
+    return {(date, instrument_id): split_path(root, date, instrument_id) for date, instrument_id in partitions}
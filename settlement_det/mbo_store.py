@@ -0,0 +1,217 @@
+import glob
+import json
+import os
+
+import numpy as np
+import polars as pl
+
+import profiling
+from grid import HOURLY, NS_PER_DAY, SettlementGrid
+from mbo import MBO_COLUMNS, mbo_partitions, scan_mbo
+
+# column -> dtype in the store, every one a plain fixed-width array
+STORE_COLUMNS = {
+    "ts_event": np.int64,  # ns since the epoch, UTC
+    "instrument_id": np.uint32,
+    "action": np.uint8,  # ASCII code, ord("A"), ord("C"), ...
+    "side": np.uint8,  # ASCII code, ord("A") or ord("B")
+    "price": np.int64,  # fixed precision, 1e-9 units
+    "size": np.uint32,
+    "order_id": np.uint64,
+    "slot": np.int16,  # settlement bucket of ts_event on the store's grid, -1 outside it
+}
+
+PRICE_SCALE = 1e-9
+
+# databento's single-letter actions and sides, stored as their ASCII codes
+CODES = {letter: ord(letter) for letter in "ABCFMNRT"}
+
+
+def day_path(root, date):
+    return os.path.join(root, f"{date}.arrow")
+
+
+def _encode(lf: pl.LazyFrame) -> pl.LazyFrame:
+    return lf.with_columns(
+        pl.col(name).replace_strict(CODES, default=0, return_dtype=pl.UInt8) for name in ("action", "side")
+    )
+
+
+def convert_mbo(path, root, dates=None, grid: SettlementGrid = None, overwrite: bool = False):
+    """
+    One-time conversion of a databento MBO file (csv or parquet) into a store of per-day files
+
+    Each day becomes root/YYYY-MM-DD.arrow: an uncompressed Arrow IPC file holding one record
+    batch of STORE_COLUMNS, the same bid / ask rows load_mbo gives for that day (in file order),
+    with integer timestamps and prices, ASCII-coded action / side and the settlement slot of
+    every event on grid precomputed. Nothing has to be parsed again when a day is opened, and
+    the file can be memory-mapped as is (see MBOStore).
+
+    Parameters:
+    - path: databento MBO file
+    - root: store directory
+    - dates: "YYYY-MM-DD" days to convert, every day in the file by default
+    - grid: settlement buckets for the slot column (hourly 14:00-22:00 UTC by default)
+    - overwrite: rewrite days already in the store
+
+    Returns: the dates written
+    """
+    import pyarrow as pa
+
+    grid = grid if grid is not None else HOURLY
+    os.makedirs(root, exist_ok=True)
+    if dates is None:
+        dates = mbo_partitions(path)["date"].unique().sort().to_list()
+
+    written = []
+    for date in dates:
+        target = day_path(root, date)
+        if os.path.exists(target) and not overwrite:
+            continue
+        with profiling.stage("store_convert", path=str(path), date=date) as span:
+            df = _encode(scan_mbo(path, date, MBO_COLUMNS + ["instrument_id"], raw=True)).collect(engine="streaming")
+            columns = {name: df[name].to_numpy() for name in STORE_COLUMNS if name != "slot"}
+            columns["slot"] = grid.slots(columns["ts_event"] % NS_PER_DAY)
+
+            schema = pa.schema(
+                [(name, pa.from_numpy_dtype(dtype)) for name, dtype in STORE_COLUMNS.items()],
+                metadata={"date": date, "grid": json.dumps(grid.boundaries.tolist())},
+            )
+            batch = pa.record_batch([pa.array(columns[name].astype(dtype, copy=False))
+                                     for name, dtype in STORE_COLUMNS.items()], schema=schema)
+            # a single batch keeps every column one contiguous buffer, so it maps straight onto numpy
+            partial = target + ".tmp"
+            with pa.OSFile(partial, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+                writer.write_batch(batch)
+            os.replace(partial, target)
+            span.rows_out = len(df)
+        written.append(date)
+    return written
+
+
+class MBODay():
+    """
+    One day of the store, memory-mapped: columns are zero-copy numpy views of the file
+
+    Opening a day costs next to nothing and pages are only read as columns are touched, so the
+    memory a simulation needs is the few columns it actually uses.
+
+    Parameters:
+    - path: the day's .arrow file
+    """
+
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self.path = path
+        self._source = pa.memory_map(path, "r")
+        self.table = pa.ipc.open_file(self._source).read_all()
+        metadata = self.table.schema.metadata
+        self.date = metadata[b"date"].decode()
+        self.grid = SettlementGrid(json.loads(metadata[b"grid"]))
+        self.columns = {
+            name: self.table.column(name).chunk(0).to_numpy(zero_copy_only=True) if self.table.num_rows
+            else np.empty(0, dtype=STORE_COLUMNS[name])
+            for name in self.table.column_names
+        }
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def slots(self, grid: SettlementGrid = None):
+        """Settlement slot of every event, precomputed for the store's grid and recomputed for any other"""
+        if grid is None or grid == self.grid:
+            return self.columns["slot"]
+        return grid.slots(self.columns["ts_event"] % NS_PER_DAY)
+
+    def prices(self):
+        """Prices as decimals (a new float64 array)"""
+        return self.columns["price"] * PRICE_SCALE
+
+    def frame(self, columns=MBO_COLUMNS) -> pl.DataFrame:
+        """The day in load_mbo's shape (UTC datetimes, decimal prices, letter action / side)"""
+        df = pl.from_arrow(self.table.select(list(columns)))
+        letters = {code: letter for letter, code in CODES.items()}
+        conversions = {
+            "ts_event": lambda column: column.cast(pl.Datetime("ns", "UTC")),
+            "price": lambda column: column * PRICE_SCALE,
+            "action": lambda column: column.replace_strict(letters, default=None, return_dtype=pl.String),
+            "side": lambda column: column.replace_strict(letters, default=None, return_dtype=pl.String),
+        }
+        return df.with_columns(conversions[name](pl.col(name)) for name in columns if name in conversions)
+
+    def action_counts(self) -> pl.DataFrame:
+        """Per order_id add / cancel / modify counts, what MarketMakerClassifier is built from"""
+        with profiling.stage("mm_classify", rows_in=len(self)) as span:
+            order_ids, index = np.unique(self.columns["order_id"], return_inverse=True)
+            action = self.columns["action"]
+            counts = pl.DataFrame({
+                "order_id": order_ids,
+                **{
+                    name: np.bincount(index, weights=action == CODES[letter], minlength=len(order_ids)).astype(np.uint32)
+                    for name, letter in (("add_count", "A"), ("cancel_count", "C"), ("modify_count", "M"))
+                },
+            })
+            span.rows_out = len(counts)
+        return counts
+
+    def order_columns(self, grid: SettlementGrid = None, exclude_ids=None, max_price: float = None,
+                      instrument_id: int = None):
+        """
+        slot / is_ask / notional arrays for simulate_brokers, straight from the mapped columns
+
+        Parameters:
+        - grid: settlement buckets, the store's grid by default
+        - exclude_ids: order_ids to drop, e.g. MarketMakerClassifier.market_maker_ids(...)
+        - max_price: keep only orders priced below this (decimal)
+        - instrument_id: keep only this instrument
+        """
+        with profiling.stage("preprocessing", path=self.path, date=self.date) as span:
+            keep = np.ones(len(self), dtype=bool)
+            if exclude_ids is not None:
+                keep &= ~np.isin(self.columns["order_id"], np.asarray(exclude_ids, dtype=np.uint64))
+            if max_price is not None:
+                keep &= self.columns["price"] < max_price / PRICE_SCALE
+            if instrument_id is not None:
+                keep &= self.columns["instrument_id"] == instrument_id
+            rows = None if keep.all() else np.flatnonzero(keep)
+
+            def take(values):
+                return values if rows is None else values[rows]
+
+            columns = {
+                "slot": take(self.slots(grid)).astype(np.int32),
+                "is_ask": take(self.columns["side"]) == CODES["A"],
+                "notional": take(self.columns["price"]) * PRICE_SCALE * take(self.columns["size"]),
+            }
+            span.rows_out = len(columns["slot"])
+        return columns
+
+
+class MBOStore():
+    """
+    Directory of per-day MBO files written by convert_mbo
+
+        store = MBOStore("mbo_store")
+        day = store.open("2024-12-06")
+        classifier = MarketMakerClassifier(day.action_counts())
+        columns = day.order_columns(exclude_ids=classifier.market_maker_ids(0.8, 0.8), max_price=1e6)
+        brokers = simulate_brokers(columns, 3000, seed=0)
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def dates(self):
+        return sorted(os.path.basename(path)[:-len(".arrow")] for path in glob.glob(os.path.join(self.root, "*.arrow")))
+
+    def __contains__(self, date):
+        return os.path.exists(day_path(self.root, date))
+
+    def open(self, date) -> MBODay:
+        if date not in self:
+            raise KeyError(f"{date} is not in the MBO store at {self.root}")
+        return MBODay(day_path(self.root, date))
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import polars as pl
+
+import profiling
+
+
+class MarketMakerClassifier():
+    """
+    Flags market-maker order_ids from how often each order is cancelled or modified
+
+    Per-order add/cancel/modify counts are computed once (optionally cached to parquet) and
+    every threshold rule is then evaluated on the cached arrays. An order is a market maker
+    when its cancel-to-add ratio > cancel_threshold or its modify-to-add ratio > modify_threshold.
+    """
+
+    def __init__(self, counts: pl.DataFrame):
+        counts = counts.sort("order_id")
+        self.counts = counts
+        self.order_ids = counts["order_id"].to_numpy()
+
+        # orders never seen being added give x / 0 = inf or 0 / 0 = NaN; polars sorts NaN above
+        # every number, so it counts as over any threshold - store it as inf to keep that
+        add_count = counts["add_count"].to_numpy().astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.cancel_to_add = np.nan_to_num(counts["cancel_count"].to_numpy() / add_count, nan=np.inf)
+            self.modify_to_add = np.nan_to_num(counts["modify_count"].to_numpy() / add_count, nan=np.inf)
+
+    @classmethod
+    def from_orders(cls, df: pl.DataFrame):
+        # Group by 'order_id' and count occurrences of each action
+        with profiling.stage("mm_classify", rows_in=len(df)) as span:
+            counts = (
+                df.lazy()
+                .group_by("order_id")
+                .agg([
+                    (pl.col("action") == "A").sum().alias("add_count"),
+                    (pl.col("action") == "C").sum().alias("cancel_count"),
+                    (pl.col("action") == "M").sum().alias("modify_count"),
+                ])
+                .collect()
+            )
+            span.rows_out = len(counts)
+        return cls(counts)
+
+    @classmethod
+    def cached(cls, df: pl.DataFrame, cache_path):
+        """
+        from_orders, reusing the counts saved at cache_path when they exist
+
+        The cache isn't tied to the input, so use one path per source file and day.
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            return cls(pl.read_parquet(cache_path))
+        classifier = cls.from_orders(df)
+        if cache_path is not None:
+            classifier.counts.write_parquet(cache_path)
+        return classifier
+
+    def mask(self, cancel_threshold: float, modify_threshold: float = None):
+        """Boolean market-maker flag per order in self.order_ids"""
+        modify_threshold = cancel_threshold if modify_threshold is None else modify_threshold
+        return (self.cancel_to_add > cancel_threshold) | (self.modify_to_add > modify_threshold)
+
+    def market_maker_ids(self, cancel_threshold: float, modify_threshold: float = None):
+        """Sorted array of market-maker order_ids"""
+        return self.order_ids[self.mask(cancel_threshold, modify_threshold)]
+
+    def sweep(self, cancel_thresholds, modify_thresholds, bitmaps: bool = False):
+        """
+        Market-maker sets for every (cancel, modify) threshold pair in one vectorized pass
+
+        Parameters:
+        - cancel_thresholds, modify_thresholds: 1-D grids, every combination is evaluated
+        - bitmaps: return np.packbits bitmaps over self.order_ids instead of order_id arrays
+
+        Returns: {(cancel_threshold, modify_threshold): sorted order_ids or packed bitmap}
+        """
+        cancel_thresholds = np.asarray(cancel_thresholds, dtype=np.float64)
+        modify_thresholds = np.asarray(modify_thresholds, dtype=np.float64)
+
+        # one comparison per order and threshold, shared by every pair that uses the threshold
+        over_cancel = self.cancel_to_add[:, None] > cancel_thresholds[None, :]
+        over_modify = self.modify_to_add[:, None] > modify_thresholds[None, :]
+
+        sets = {}
+        for i, cancel_threshold in enumerate(cancel_thresholds.tolist()):
+            for j, modify_threshold in enumerate(modify_thresholds.tolist()):
+                flagged = over_cancel[:, i] | over_modify[:, j]
+                sets[(cancel_threshold, modify_threshold)] = np.packbits(flagged) if bitmaps else self.order_ids[flagged]
+        return sets
+
+    def _is_market_maker(self, df: pl.DataFrame, cancel_threshold, modify_threshold):
+        ids = pl.Series("order_id", self.market_maker_ids(cancel_threshold, modify_threshold))
+        return pl.col("order_id").is_in(ids.cast(df.schema["order_id"]).implode())
+
+    def exclude(self, df: pl.DataFrame, cancel_threshold: float, modify_threshold: float = None):
+        """Orders from df that are not market makers"""
+        with profiling.stage("mm_filter", rows_in=len(df)) as span:
+            filtered = df.filter(~self._is_market_maker(df, cancel_threshold, modify_threshold))
+            span.rows_out = len(filtered)
+        return filtered
+
+    def include(self, df: pl.DataFrame, cancel_threshold: float, modify_threshold: float = None):
+        """Orders from df that are market makers"""
+        with profiling.stage("mm_filter", rows_in=len(df)) as span:
+            filtered = df.filter(self._is_market_maker(df, cancel_threshold, modify_threshold))
+            span.rows_out = len(filtered)
+        return filtered
@@ -0,0 +1,246 @@
+import time
+
+import numpy as np
+import polars as pl
+
+import profiling
+from grid import HOURLY, SettlementGrid
+from simulation import order_columns, shuffle_orders
+
+OBJECTIVES = ("total", "peak")
+
+
+def netting_inputs(df, num_brokers: int, seed=None, grid: SettlementGrid = None, free_random: bool = False):
+    """
+    What every broker has to settle, split the way simulate_brokers splits it
+
+    The orders are shuffled and dealt out exactly as in simulate_brokers, and each broker's
+    random-branch draws are replayed from its own seed, so the orders the greedy rule settled at
+    a random bucket are known.
+
+    Parameters:
+    - df: preprocessed orders, or their order_columns() arrays
+    - num_brokers, seed, grid: as passed to simulate_brokers
+    - free_random: let the solver also place the random-branch orders (otherwise they stay where
+      the draw put them, as in the greedy run)
+
+    Returns: (ask, bid, fixed), each (num_brokers, num_slots): ask / bid notional trading in each
+    bucket that may settle there or in any earlier bucket, and the net cashflow already fixed in
+    each bucket by random-branch orders
+    """
+    grid = grid if grid is not None else HOURLY
+    columns = df if isinstance(df, dict) else order_columns(df, grid)
+    num_slots = len(grid)
+    entropy = np.random.SeedSequence(seed).entropy
+
+    total = len(columns["slot"])
+    chunk_size = total // num_brokers
+    order = shuffle_orders(total, entropy)[:chunk_size * num_brokers]
+    slots = columns["slot"][order].astype(np.int64)
+    is_ask = columns["is_ask"][order]
+    notionals = columns["notional"][order]
+
+    # replay each broker's (branch, bucket) draws, two per order like Broker.net_slots
+    draws = np.empty((len(order), 2))
+    for broker_id in range(num_brokers):
+        rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(1, broker_id)))
+        draws[broker_id * chunk_size:(broker_id + 1) * chunk_size] = rng.random((chunk_size, 2))
+    random_branch = np.zeros(len(order), dtype=bool) if free_random else draws[:, 0] < 0.2
+    if np.any(slots[~random_branch] < 0):
+        raise KeyError("order outside the settlement grid")
+
+    broker_ids = np.arange(len(order)) // max(chunk_size, 1)
+    size = num_brokers * num_slots
+
+    def ledger(mask, slot, weights):
+        return np.bincount(broker_ids[mask] * num_slots + slot[mask], weights=weights[mask], minlength=size).reshape(
+            num_brokers, num_slots)
+
+    fixed_slots = (draws[:, 1] * num_slots).astype(np.int64)
+    signed = np.where(is_ask, notionals, -notionals)
+    return (
+        ledger(~random_branch & is_ask, slots, notionals),
+        ledger(~random_branch & ~is_ask, slots, notionals),
+        ledger(random_branch, fixed_slots, signed),
+    )
+
+
+def funding(net):
+    """(total, peak) net funding of per-bucket net cashflows: sum and max of |net| over the last axis"""
+    magnitude = np.abs(net)
+    return magnitude.sum(axis=-1), magnitude.max(axis=-1)
+
+
+def _template(num_slots: int, objective: str):
+    """
+    One broker's LP in COO form, to be tiled across brokers
+
+    Variables: u_s / v_s (s < num_slots - 1) ask / bid cashflow moved from buckets after s to
+    buckets up to s, p_s / m_s positive / negative part of the net in bucket s, and t the peak
+    (peak objective only). Moving only backwards along the chain is the same as letting every
+    order settle in its own bucket or any earlier one, with O(buckets) variables instead of
+    O(buckets^2) - or O(orders).
+    """
+    S = num_slots
+    u, v, p, m, t = 0, S - 1, 2 * S - 2, 3 * S - 2, 4 * S - 2
+    num_vars = 4 * S - 2 + (objective == "peak")
+
+    eq, ub = [], []
+    for s in range(S):
+        # net_s = D_s + (u_s - u_{s-1}) - (v_s - v_{s-1}) = p_s - m_s
+        row = [(p + s, -1.0), (m + s, 1.0)]
+        # settled ask / bid in bucket s can't go negative: A_s + u_s - u_{s-1} >= 0
+        ask_row, bid_row = [], []
+        if s < S - 1:
+            row += [(u + s, 1.0), (v + s, -1.0)]
+            ask_row.append((u + s, -1.0))
+            bid_row.append((v + s, -1.0))
+        if s > 0:
+            row += [(u + s - 1, -1.0), (v + s - 1, 1.0)]
+            ask_row.append((u + s - 1, 1.0))
+            bid_row.append((v + s - 1, 1.0))
+        eq.append(row)
+        ub += [ask_row, bid_row]
+    if objective == "peak":
+        ub += [[(p + s, 1.0), (m + s, 1.0), (t, -1.0)] for s in range(S)]
+
+    def coo(rows):
+        entries = [(i, j, value) for i, row in enumerate(rows) for j, value in row]
+        return tuple(np.array(part) for part in zip(*entries)) + (len(rows),)
+
+    cost = np.zeros(num_vars)
+    if objective == "total":
+        cost[p:t] = 1.0
+    else:
+        cost[t] = 1.0
+    return cost, coo(eq), coo(ub)
+
+
+def _tile(template, count, num_vars):
+    rows, columns, values, num_rows = template
+    offsets = np.arange(count)[:, None]
+    return (
+        np.tile(values, count),
+        ((rows + offsets * num_rows).ravel(), (columns + offsets * num_vars).ravel()),
+        (count * num_rows, count * num_vars),
+    )
+
+
+def _solve_block(ask, bid, fixed, objective, time_limit):
+    """Optimal nets for a block of brokers in one sparse LP (HiGHS), None if it didn't finish"""
+    from scipy.optimize import linprog
+    from scipy.sparse import csr_matrix
+
+    count, S = ask.shape
+    cost, eq, ub = _template(S, objective)
+    num_vars = len(cost)
+    direct = fixed + ask - bid
+    # one scale for the block keeps HiGHS' tolerances meaningful for notionals in the millions
+    scale = max(np.abs(direct).max(), ask.max(), bid.max(), 1.0)
+
+    b_ub = np.column_stack([ask, bid]).reshape(count, 2, S).transpose(0, 2, 1).reshape(count, -1) / scale
+    if objective == "peak":
+        b_ub = np.hstack([b_ub, np.zeros((count, S))])
+    values, indices, shape = _tile(ub, count, num_vars)
+    A_ub = csr_matrix((values, indices), shape=shape)
+    values, indices, shape = _tile(eq, count, num_vars)
+    A_eq = csr_matrix((values, indices), shape=shape)
+
+    options = {} if time_limit is None else {"time_limit": max(time_limit, 0.01)}
+    result = linprog(
+        np.tile(cost, count),
+        A_ub=A_ub,
+        b_ub=b_ub.ravel(),
+        A_eq=A_eq,
+        b_eq=(-direct / scale).ravel(),
+        bounds=(0, None),
+        method="highs",
+        options=options,
+    )
+    if result.status != 0:
+        return None
+
+    x = result.x.reshape(count, num_vars)
+    shift = np.zeros((count, S + 1))
+    shift[:, 1:S] = x[:, :S - 1] - x[:, S - 1:2 * S - 2]  # u_s - v_s, 0 at both ends
+    return direct + (shift[:, 1:] - shift[:, :-1]) * scale
+
+
+def optimal_nets(ask, bid, fixed, objective: str = "total", time_limit: float = None, block: int = 100):
+    """
+    Per-broker net cashflow per bucket that minimises total (sum |net|) or peak (max |net|) funding
+
+    Brokers are independent, so they are solved in blocks of `block` brokers, each block one
+    sparse LP. With a time_limit (seconds) blocks stop being started once it has passed, and
+    brokers left over come back as NaN rows.
+
+    Parameters:
+    - ask, bid, fixed: netting_inputs
+    - objective: "total" or "peak"
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"objective must be one of {OBJECTIVES}")
+    nets = np.full(ask.shape, np.nan)
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+    with profiling.stage("optimal_netting", rows_in=len(ask), objective=objective) as span:
+        solved = 0
+        for start in range(0, len(ask), block):
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                break
+            part = slice(start, start + block)
+            result = _solve_block(ask[part], bid[part], fixed[part], objective, remaining)
+            if result is None:
+                break
+            nets[part] = result
+            solved += len(result)
+        span.rows_out = solved
+    return nets
+
+
+def netting_gap(pool, inputs, objectives=OBJECTIVES, time_limit: float = None):
+    """
+    How far the greedy netting in pool is from the optimal settlement assignment
+
+    The greedy assignment is read from the ask / bid ledgers (ask - bid per bucket), which hold
+    where every order's cashflow ended up; pool.net keeps the rule's running balances instead.
+
+    Parameters:
+    - pool: BrokerPool from simulate_brokers
+    - inputs: netting_inputs for the same orders, num_brokers, seed and grid
+    - objectives: which of "total" / "peak" to solve for
+    - time_limit: seconds per objective for the per-broker solves
+
+    Returns: (per-broker DataFrame, pool dict). For each objective the DataFrame has the
+    funding with no netting (every order in its own bucket), with the greedy rule and at the
+    optimum, and gap = greedy - optimal. The pool dict gives the same for the shared cash pool,
+    where brokers' nets offset each other: its optimum comes from one LP on the summed inputs.
+    """
+    ask, bid, fixed = inputs
+    greedy = pool.ask - pool.bid
+    unnetted = fixed + ask - bid
+    pooled_inputs = tuple(matrix.sum(axis=0, keepdims=True) for matrix in inputs)
+
+    brokers = {"broker_id": np.arange(len(ask))}
+    pooled = {}
+    for objective in objectives:
+        which = OBJECTIVES.index(objective)
+        optimal = optimal_nets(ask, bid, fixed, objective, time_limit)
+        none_funding, greedy_funding, optimal_funding = (funding(net)[which] for net in (unnetted, greedy, optimal))
+        brokers.update({
+            f"{objective}_none": none_funding,
+            f"{objective}_greedy": greedy_funding,
+            f"{objective}_optimal": optimal_funding,
+            f"{objective}_gap": greedy_funding - optimal_funding,
+        })
+
+        pool_optimal = optimal_nets(*pooled_inputs, objective)[0]
+        pooled[objective] = {
+            "none": float(funding(unnetted.sum(axis=0))[which]),
+            "greedy": float(funding(greedy.sum(axis=0))[which]),
+            "optimal": float(funding(pool_optimal)[which]),
+            "brokers_optimal": float(np.nansum(optimal_funding)),
+            "brokers_greedy": float(greedy_funding.sum()),
+            "solved": int(np.isfinite(optimal_funding).sum()),
+        }
+    return pl.DataFrame(brokers), pooled
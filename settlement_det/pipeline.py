@@ -0,0 +1,231 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import numpy as np
+import polars as pl
+
+import profiling
+from checkpoint import Checkpoint
+from ensemble import ENSEMBLE_OUTPUTS, bucket_outputs
+from grid import HOURLY, SettlementGrid
+from mbo import load_mbo, mbo_partitions, split_mbo
+from mm_filter import MarketMakerClassifier
+from simulation import simulate_brokers
+
+# per-partition result file, and the merged dataset written next to the partition directories
+OUTPUT_NAME = "buckets.parquet"
+FAILED_NAME = "_failed.json"
+CHECKPOINT_NAME = "_checkpoint"
+SPLIT_NAME = "_split"
+
+
+def partition_dir(out_dir, date: str, instrument_id: int):
+    # hive-style layout, out_dir/date=2024-12-06/instrument_id=123/
+    return os.path.join(out_dir, f"date={date}", f"instrument_id={instrument_id}")
+
+
+def partition_seed(seed: int, date: str, instrument_id: int) -> int:
+    """Seed of one partition, fixed by (seed, date, instrument) so it doesn't depend on scheduling"""
+    return int(np.random.SeedSequence([seed, int(date.replace("-", "")), int(instrument_id)]).generate_state(1)[0])
+
+
+def run_partition(path, date: str, instrument_id: int, out_dir, num_brokers: int = 3000, seed: int = 0,
+                  grid: SettlementGrid = None, cancel_threshold: float = 0.8, modify_threshold: float = 0.8,
+                  max_price: float = 1e6, checkpoint_interval: float = 30.0):
+    """
+    Preprocessing -> MM filter -> broker simulation -> per-bucket aggregation for one (date, instrument)
+
+    path is the MBO file, or (as run_pipeline does) the partition's own files from split_mbo, so
+    only its rows are read. The result is written to
+    partition_dir(...)/buckets.parquet through a temporary file, so a partition either has its
+    complete output or none at all. With profiling enabled the partition's stages also go to
+    profile.json next to it.
+
+    While the brokers are netted their state is checkpointed to _checkpoint/ in the partition
+    directory every checkpoint_interval seconds (None turns it off), so a partition that was
+    interrupted picks up from its finished brokers when it is run again (a checkpoint left by
+    other settings is discarded). The checkpoint is removed once the output is written.
+
+    Returns: (date, instrument_id, number of orders simulated)
+    """
+    grid = grid if grid is not None else HOURLY
+    directory = partition_dir(out_dir, date, instrument_id)
+    os.makedirs(directory, exist_ok=True)
+
+    with ExitStack() as stack:
+        recorder = stack.enter_context(profiling.capture()) if profiling.enabled() else None
+
+        df = load_mbo(path, date=date, instrument_id=instrument_id)
+        classifier = MarketMakerClassifier.cached(df, os.path.join(directory, "mm_action_counts.parquet"))
+        orders = classifier.exclude(df, cancel_threshold=cancel_threshold, modify_threshold=modify_threshold)
+        orders = orders.filter(pl.col("price") < max_price)
+        del df
+        # a whole day of events also has pre/post-market orders, which have no settlement bucket
+        orders = orders.filter(pl.Series(grid.slots_of(orders["ts_event"]) >= 0))
+
+        # one partition per worker process already, so the brokers are netted in-process
+        checkpoint = None
+        if checkpoint_interval is not None:
+            checkpoint = Checkpoint(os.path.join(directory, CHECKPOINT_NAME), interval=checkpoint_interval, reset=True)
+        pool = simulate_brokers(orders, num_brokers, workers=1, seed=partition_seed(seed, date, instrument_id),
+                                grid=grid, checkpoint=checkpoint)
+        outputs = bucket_outputs(pool)
+
+    if recorder is not None:
+        recorder.write(os.path.join(directory, "profile.json"))
+    frame = pl.DataFrame({
+        "date": [date] * len(grid),
+        "instrument_id": pl.Series([instrument_id] * len(grid), dtype=pl.Int64),
+        "settlement_slot": np.arange(len(grid), dtype=np.uint16),
+        "bucket": grid.labels,
+        **{name: outputs[name] for name in ENSEMBLE_OUTPUTS},
+        "orders": [len(orders)] * len(grid),
+        "num_brokers": [num_brokers] * len(grid),
+    })
+    output = os.path.join(directory, OUTPUT_NAME)
+    frame.write_parquet(output + ".tmp")
+    os.replace(output + ".tmp", output)
+    if checkpoint is not None:
+        checkpoint.clear()
+    return date, instrument_id, len(orders)
+
+
+def _run_partitions(sources, out_dir, todo, workers, settings):
+    """Run every (date, instrument_id) in todo from its sources file; returns {(date, instrument_id): traceback} of the failures"""
+    failed = {}
+    if workers == 1:
+        for date, instrument_id in todo:
+            try:
+                run_partition(sources[(date, instrument_id)], date, instrument_id, out_dir, **settings)
+            except Exception:
+                failed[(date, instrument_id)] = traceback.format_exc()
+        return failed
+
+    # workers run polars, so spawn rather than fork, and get a fresh process per partition so
+    # memory goes back to the OS after each one - peak memory is workers x one partition
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, max_tasks_per_child=1) as pool:
+        futures = {
+            pool.submit(run_partition, sources[(date, instrument_id)], date, instrument_id, out_dir, **settings):
+                (date, instrument_id)
+            for date, instrument_id in todo
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                # includes BrokenProcessPool when a worker dies (e.g. out of memory), which fails
+                # every partition still queued - they are simply retried
+                failed[futures[future]] = traceback.format_exc()
+    return failed
+
+
+def merge_outputs(out_dir) -> pl.DataFrame:
+    """Concatenate every finished partition's buckets into out_dir/buckets.parquet and return it"""
+    files = sorted(glob.glob(os.path.join(out_dir, "date=*", "instrument_id=*", OUTPUT_NAME)))
+    if not files:
+        return pl.DataFrame()
+    merged = (
+        pl.scan_parquet(files, hive_partitioning=False)
+        .sort("date", "instrument_id", "settlement_slot")
+        .collect(engine="streaming")
+    )
+    output = os.path.join(out_dir, OUTPUT_NAME)
+    merged.write_parquet(output + ".tmp")
+    os.replace(output + ".tmp", output)
+    return merged
+
+
+def run_pipeline(path, out_dir, workers=None, partitions=None, retries: int = 1, overwrite: bool = False,
+                 **settings):
+    """
+    Run the settlement pipeline for every (date, instrument_id) partition of an MBO file and merge the results
+
+    Parameters:
+    - path: databento MBO file (csv or parquet)
+    - out_dir: output directory, one sub-directory per partition plus the merged buckets.parquet
+    - workers: number of worker processes (defaults to the number of cores, 1 runs in-process)
+    - partitions: (date, instrument_id) pairs to run, None for every partition in the file
+    - retries: how many more times failed partitions are retried within this call
+    - overwrite: rerun partitions that already have an output; by default they're skipped, so
+      calling again after a failure only reruns what failed
+    - settings: passed on to run_partition (num_brokers, seed, grid, cancel_threshold, ...)
+
+    The partitions to run are first split out of the file in one streaming pass (split_mbo, into
+    out_dir/_split/, removed at the end), so every worker reads its own partition rather than
+    the whole file.
+
+    Returns: (merged DataFrame, {(date, instrument_id): traceback} of partitions that still failed).
+    The failures are also written to out_dir/_failed.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if partitions is None:
+        # biggest partitions first, so a large one doesn't start last and hold up the whole run
+        found = mbo_partitions(path).sort("events", descending=True)
+        partitions = list(zip(found["date"].to_list(), found["instrument_id"].to_list()))
+
+    todo = [
+        (date, instrument_id) for date, instrument_id in partitions
+        if overwrite or not os.path.isfile(os.path.join(partition_dir(out_dir, date, instrument_id), OUTPUT_NAME))
+    ]
+    workers = workers or os.cpu_count()
+    split_dir = os.path.join(out_dir, SPLIT_NAME)
+    sources = split_mbo(path, split_dir, todo) if todo else {}
+
+    failed = {}
+    for attempt in range(retries + 1):
+        if not todo:
+            break
+        failed = _run_partitions(sources, out_dir, todo, min(workers, len(todo)), settings)
+        todo = [partition for partition in todo if partition in failed]
+    shutil.rmtree(split_dir, ignore_errors=True)
+
+    failed_path = os.path.join(out_dir, FAILED_NAME)
+    if failed:
+        with open(failed_path, "w") as file:
+            json.dump([{"date": date, "instrument_id": instrument_id, "error": error}
+                       for (date, instrument_id), error in failed.items()], file, indent=2)
+    elif os.path.exists(failed_path):
+        os.remove(failed_path)
+
+    return merge_outputs(out_dir), failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Settlement simulation for every (date, instrument) of an MBO file")
+    parser.add_argument("path", help="databento MBO file, csv or parquet")
+    parser.add_argument("out_dir")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--brokers", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--date", action="append", help="only these dates (repeatable)")
+    parser.add_argument("--instrument", type=int, action="append", help="only these instrument_ids (repeatable)")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--checkpoint-interval", type=float, default=30.0,
+                        help="seconds between broker checkpoints within a partition")
+    args = parser.parse_args()
+
+    partitions = None
+    if args.date or args.instrument:
+        found = mbo_partitions(args.path)
+        if args.date:
+            found = found.filter(pl.col("date").is_in(args.date))
+        if args.instrument:
+            found = found.filter(pl.col("instrument_id").is_in(args.instrument))
+        partitions = list(zip(found["date"].to_list(), found["instrument_id"].to_list()))
+
+    merged, failed = run_pipeline(args.path, args.out_dir, workers=args.workers, partitions=partitions,
+                                  retries=args.retries, overwrite=args.overwrite,
+                                  num_brokers=args.brokers, seed=args.seed,
+                                  checkpoint_interval=args.checkpoint_interval)
+    print(f"{merged['date'].n_unique() if len(merged) else 0} days, {len(merged)} bucket rows merged")
+    for (date, instrument_id), error in failed.items():
+        print(f"failed: {date} instrument {instrument_id}\n{error}")
@@ -0,0 +1,246 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# netting counters kept per broker in BrokerPool.counters, in this order
+NETTING_COUNTERS = ("orders", "random_branch", "netted_orders", "transfers", "notional_offset")
+
+# set by enable(); every hook checks this first, so instrumentation costs one lookup when off
+_recorder = None
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS - the process' peak since it started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _rss_mb():
+    # current resident set size, None where there's no /proc (macOS)
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+class _NullStage():
+    """What stage() hands out while profiling is off: accepts and drops everything"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+    def count(self, **counters):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage():
+    """
+    One timed span of the pipeline: wall and CPU time, rows in / out, memory and counters
+
+    Set rows_in / rows_out (or call count()) inside the with block; everything is recorded when
+    the block exits. rss_delta_mb is how much the resident set grew over the stage (current RSS at
+    exit minus at entry, negative if it shrank), process_peak_rss_mb the peak of the whole process
+    so far, which is only the stage's own when it set a new peak.
+    """
+
+    def __init__(self, recorder, name, rows_in=None, **args):
+        self.recorder = recorder
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.args = args
+        self.counters = {}
+
+    def count(self, **counters):
+        """Add to this stage's counters"""
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def __enter__(self):
+        self._wall = time.perf_counter_ns()
+        self._cpu = time.process_time_ns()
+        self._rss = _rss_mb()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        rss = _rss_mb()
+        self.recorder.add({
+            "name": self.name,
+            "start_us": (self._wall - self.recorder.origin) / 1e3,
+            "wall_s": (end - self._wall) / 1e9,
+            "cpu_s": (time.process_time_ns() - self._cpu) / 1e9,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rss_delta_mb": rss - self._rss if rss is not None and self._rss is not None else None,
+            "process_peak_rss_mb": _peak_rss_mb(),
+            "counters": self.counters,
+            "args": self.args,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "failed": exc[0] is not None,
+        })
+        return False
+
+
+class Recorder():
+    """Collects Stage records and optional per-broker netting counters, and writes them out"""
+
+    def __init__(self, per_broker: bool = False):
+        self.per_broker = per_broker
+        self.origin = time.perf_counter_ns()
+        self.records = []
+        self.brokers = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def add_brokers(self, first_broker, counters):
+        # counters: (num_brokers, len(NETTING_COUNTERS)) rows for brokers first_broker, first_broker + 1, ...
+        with self._lock:
+            for offset, row in enumerate(counters.tolist()):
+                self.brokers.append({"broker_id": first_broker + offset, **dict(zip(NETTING_COUNTERS, row))})
+
+    def summary(self):
+        """Per stage name: calls, total wall / CPU time, rows in / out, largest RSS growth and process peak, summed counters"""
+        stages = {}
+        for record in self.records:
+            entry = stages.setdefault(record["name"], {
+                "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows_in": 0, "rows_out": 0,
+                "rss_delta_mb": None, "process_peak_rss_mb": 0.0, "counters": {},
+            })
+            entry["calls"] += 1
+            entry["wall_s"] += record["wall_s"]
+            entry["cpu_s"] += record["cpu_s"]
+            entry["rows_in"] += record["rows_in"] or 0
+            entry["rows_out"] += record["rows_out"] or 0
+            delta = record["rss_delta_mb"]
+            if delta is not None:
+                entry["rss_delta_mb"] = delta if entry["rss_delta_mb"] is None else max(entry["rss_delta_mb"], delta)
+            entry["process_peak_rss_mb"] = max(entry["process_peak_rss_mb"], record["process_peak_rss_mb"])
+            for name, value in record["counters"].items():
+                entry["counters"][name] = entry["counters"].get(name, 0) + value
+        return stages
+
+    def to_json(self):
+        return {"summary": self.summary(), "stages": self.records, "brokers": self.brokers}
+
+    def to_chrome_trace(self):
+        """Chrome trace event format (chrome://tracing, Perfetto): one complete event per stage"""
+        events = [
+            {
+                "name": record["name"], "cat": "stage", "ph": "X",
+                "ts": record["start_us"], "dur": record["wall_s"] * 1e6,
+                "pid": record["pid"], "tid": record["tid"],
+                "args": {
+                    "cpu_s": record["cpu_s"], "rows_in": record["rows_in"], "rows_out": record["rows_out"],
+                    "rss_delta_mb": record["rss_delta_mb"], "process_peak_rss_mb": record["process_peak_rss_mb"],
+                    **record["counters"], **record["args"],
+                },
+            }
+            for record in self.records
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, chrome: bool = None):
+        """Write to path as JSON, or as a Chrome trace (chrome=None picks it for *.trace.json)"""
+        chrome = str(path).endswith(".trace.json") if chrome is None else chrome
+        with open(path, "w") as file:
+            json.dump(self.to_chrome_trace() if chrome else self.to_json(), file, indent=1)
+
+
+def enable(path=None, per_broker: bool = False, chrome: bool = None):
+    """
+    Start recording stages, optionally written to path when the process exits
+
+    Parameters:
+    - path: output file, None to only keep the records in memory (see recorder())
+    - per_broker: also keep every broker's netting counters
+    - chrome: write a Chrome trace instead of JSON (None: for paths ending in .trace.json)
+
+    Returns: the Recorder
+    """
+    global _recorder
+    _recorder = Recorder(per_broker)
+    if path is not None:
+        atexit.register(_recorder.write, path, chrome)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def recorder():
+    return _recorder
+
+
+@contextmanager
+def capture():
+    """
+    Record into a fresh Recorder for the duration of the block (e.g. one pipeline partition)
+
+    The records are also handed on to the enclosing recorder afterwards. Only use while enabled.
+    """
+    global _recorder
+    outer = _recorder
+    inner = Recorder(outer.per_broker)
+    inner.origin = outer.origin
+    _recorder = inner
+    try:
+        yield inner
+    finally:
+        _recorder = outer
+        outer.records.extend(inner.records)
+        outer.brokers.extend(inner.brokers)
+
+
+def stage(name, rows_in=None, **args):
+    """
+    Context manager timing one pipeline stage, a no-op unless profiling is enabled
+
+        with profiling.stage("mm_filter", rows_in=len(df)) as span:
+            filtered = ...
+            span.rows_out = len(filtered)
+    """
+    if _recorder is None:
+        return _NULL_STAGE
+    return Stage(_recorder, name, rows_in, **args)
+
+
+def record_netting(span, counters, first_broker: int = 0):
+    """Sum a BrokerPool.counters block into a stage, and keep it per broker if asked for"""
+    if _recorder is None:
+        return
+    span.count(**dict(zip(NETTING_COUNTERS, counters.sum(axis=0).tolist())))
+    if _recorder.per_broker:
+        _recorder.add_brokers(first_broker, counters)
+
+
+# SETDET_PROFILE=profile.json (or profile.trace.json for a Chrome trace) turns profiling on for a
+# whole run without touching the scripts, SETDET_PROFILE_BROKERS=1 adds per-broker counters
+if os.environ.get("SETDET_PROFILE"):
+    enable(os.environ["SETDET_PROFILE"], per_broker=os.environ.get("SETDET_PROFILE_BROKERS") == "1")
@@ -1,14 +1,14 @@
+import os
 import polars as pl
-from broker import Broker
-from collections import defaultdict
-from tqdm import tqdm
+from mbo import load_mbo
+from mm_filter import MarketMakerClassifier
+from grid import NS_PER_SECOND, SettlementGrid
+from simulation import simulate_brokers
+from ensemble import run_ensemble
+from aggregation import summarize
 import plotly.graph_objects as go
 
-df = pl.read_csv("/Users/samuelho/databento/DBEQ-20241209-UB4KFCCU7A/dbeq-basic-20241107-20241206.mbo.csv")
-
-
-df = df.filter(pl.col("ts_recv").str.starts_with("2024-12-06"))
-
+MBO_PATH = "/Users/samuelho/databento/DBEQ-20241209-UB4KFCCU7A/dbeq-basic-20241107-20241206.mbo.csv"
 
 
 # take each ts_event as a trade that a broker has to execute
@@ -26,100 +26,73 @@ df = df.filter(pl.col("ts_recv").str.starts_with("2024-12-06"))
 
 # STEP 1: PREPROCESSING
 
-df = df.select(['ts_event', 'side', 'price', 'size', 'action', 'order_id']) # select only relevant volumns
-
-df = df.filter(pl.col("side") != "N") # only filter for bids and asks (idk what N is)
-
-
-df = df.with_columns((pl.col('price') * 1e-9).alias('price')) # convert from fixed precision integer to decimal
-
-df = df.with_columns(
-    pl.col("ts_event").str.to_datetime()
-) # convert to datetime, in UTC currently
+# select only relevant columns, only bids and asks (idk what N is), price from fixed precision integer
+# to decimal and ts_event to a UTC datetime - all pushed into one lazy scan of the file, for one day only
+df = load_mbo(MBO_PATH, date="2024-12-06")
 
 
 ## only filter for order_ids that are not being majorly modified 
 
 
 
-# Group by 'order_id' and count occurrences of each action
-action_counts = (
-    df.group_by("order_id")
-    .agg([
-        pl.col("action").filter(pl.col("action") == "A").count().alias("add_count"),
-        pl.col("action").filter(pl.col("action") == "C").count().alias("cancel_count"),
-        pl.col("action").filter(pl.col("action") == "M").count().alias("modify_count"),
-    ])
-)
-
-
-# Add cancel-to-add and modify-to-add ratios
-action_counts = action_counts.with_columns([
-    (pl.col("cancel_count") / pl.col("add_count")).alias("cancel_to_add_ratio"),
-    (pl.col("modify_count") / pl.col("add_count")).alias("modify_to_add_ratio"),
-])
-
-# Set thresholds for exclusion (e.g., 80% cancel-to-add or modify-to-add ratio)
-market_maker_order_ids = action_counts.filter(
-    (pl.col("cancel_to_add_ratio") > 0.8) | (pl.col("modify_to_add_ratio") > 0.8)
-).select("order_id")
+# Per-order add/cancel/modify counts are shared with the other scripts through a parquet cache
+classifier = MarketMakerClassifier.cached(df, "mm_action_counts_2024-12-06.parquet")
 
-# Exclude these order_ids from the original dataframe
-filtered_df = df.join(
-    market_maker_order_ids, on="order_id", how="anti"
-)
+# Exclude market-maker order_ids (e.g., 80% cancel-to-add or modify-to-add ratio) from the original dataframe
+filtered_df = classifier.exclude(df, cancel_threshold=0.8, modify_threshold=0.8)
 
 # remove absurd quoted prices (those above 1e6)
 filtered_df = filtered_df.filter(pl.col("price") < 1e6)
 
 
 # STEP 2: ALLOCATE THESE TRADES INTO 3000 SEPARATE BROKERS
-# brokers are instantiated by broker.py > class Broker()
+# STEP 3: run each broker's client_orders through the netting algorithm
+# simulation.py > simulate_brokers() shuffles, splits and nets across a process pool
 
 # Number of brokers
 num_brokers = 3000
 
-# Split the filtered dataframe into chunks for each broker
-shuffled_df = filtered_df.sample(fraction=1,shuffle=True) # shuffle it
-
-# Create a list of Broker instances
-brokers = []
-chunk_size = len(filtered_df) // num_brokers
+# same seed gives the same shuffle and settlement draws, however many workers are used
+seed = 0
 
-for i in range(num_brokers):
-    start_idx = i * chunk_size
-    end_idx = start_idx + chunk_size
-    thisbrokersdf = shuffled_df[start_idx:end_idx]
-    broker = Broker(client_orders=thisbrokersdf)
-    brokers.append(broker)
+# settlement buckets, e.g. SettlementGrid.every(15) for 15-minute windows
+# or SettlementGrid.from_times(["14:30", "16:00", "19:00", "21:00"]) for custom sessions
+grid = SettlementGrid.hourly(14, 22)
 
+# x axis of the charts: each bucket's start in ET hours (UTC-5), fractional on sub-hourly grids
+hour_et = dict(zip(grid.labels, (grid.boundaries[:-1] / (3600 * NS_PER_SECOND) - 5).tolist()))
 
+brokers = simulate_brokers(filtered_df, num_brokers, workers=os.cpu_count(), seed=seed, grid=grid)
 
+# Monte Carlo ensemble: rerun the shuffle and settlement draws this many times to get confidence
+# bands for the charts below (0 skips it and plots the single run only)
+replications = 1000
 
-# STEP 3: run client_orders one by one through the netting algorithm
+if replications:
+    ensemble_hours, ensemble = run_ensemble(filtered_df, num_brokers, replications, workers=os.cpu_count(),
+                                              seed=seed, grid=grid)
 
-# Process trades for each broker
-for broker in tqdm(brokers):
-    for trade in broker.client_orders.iter_rows(named=True):
-        # Convert the trade row to a Polars DataFrame with one row (required for netting_algorithm)
-        trade_event = pl.DataFrame([trade])
-        broker.netting_algorithm(trade_event)
 
-    broker.eod_netting()
+def ensemble_trace(name, label, color, sign=1):
+    # ensemble mean as markers, with a 95% band over replications as error bars
+    mean = ensemble[name].mean
+    lower, upper = ensemble[name].band()
+    above, below = (upper - mean, mean - lower) if sign > 0 else (mean - lower, upper - mean)
+    return go.Scatter(
+        x=[hour_et[hour] for hour in ensemble_hours],
+        y=sign * mean,
+        mode='markers',
+        name=label,
+        marker_color=color,
+        error_y=dict(type='data', symmetric=False, array=above, arrayminus=below)
+    )
 
 
 # STEP 4: across brokers, sum up their bid_hashmap and ask_hashmap by hour, create a visual distribution
 
-# Initialize aggregate hashmaps
-aggregate_bid_volume = defaultdict(float)
-aggregate_ask_volume = defaultdict(float)
-
-# Sum up the bid and ask hashmaps from all brokers
-for broker in brokers:
-    for hour, bid_volume in broker.bid_hashmap.items():
-        aggregate_bid_volume[hour] += bid_volume
-    for hour, ask_volume in broker.ask_hashmap.items():
-        aggregate_ask_volume[hour] += ask_volume
+# Sum up the bid and ask ledgers from all brokers (one sum(axis=0) over the pool matrices)
+aggregate_bid_volume = brokers.totals("bid_hashmap")
+aggregate_ask_volume = brokers.totals("ask_hashmap")
 
 # Convert the results to DataFrames for visualization
 bid_volume_df = pl.DataFrame({"hour": list(aggregate_bid_volume.keys()), "bid_volume": list(aggregate_bid_volume.values())})
@@ -130,13 +103,13 @@ ask_volume_df = pl.DataFrame({"hour": list(aggregate_ask_volume.keys()), "ask_vo
 
 # Convert UTC hours to ET (UTC-5)
 
-# Substring the first two characters of the hour_ET column
+# Look up each bucket label's ET start (hour_et)
 bid_volume_df = bid_volume_df.with_columns(
-    (pl.col("hour").str.slice(0, 2).cast(pl.Int32) - 5).alias("hour_ET")
+    pl.col("hour").replace_strict(hour_et, return_dtype=pl.Float64).alias("hour_ET")
 )
 
 ask_volume_df = ask_volume_df.with_columns(
-    (pl.col("hour").str.slice(0, 2).cast(pl.Int32) - 5).alias("hour_ET")
+    pl.col("hour").replace_strict(hour_et, return_dtype=pl.Float64).alias("hour_ET")
 )
 
 # Plot bid and ask volumes on the same plot
@@ -158,6 +131,10 @@ fig.add_trace(go.Bar(
     marker_color='red'
 ))
 
+if replications:
+    fig.add_trace(ensemble_trace("bid_volume", f'Bid Volume ({replications}-run mean, 95% band)', 'darkgreen'))
+    fig.add_trace(ensemble_trace("ask_volume", f'Ask Volume ({replications}-run mean, 95% band)', 'darkred', sign=-1))
+
 fig.update_layout(
     title='Bid and Ask Volume Distribution by Hour (ET)',
     xaxis_title='Hour (ET)',
@@ -230,45 +207,16 @@ fig.write_image("/Users/samuelho/bernoulli/settlement_det/net_volume_difference.
 
 
 # Next, compare broker.hashmap and broker.eod_hashmap. Create two violin plots per hour, taking the average and std. across all brokers of the net cashflow at every hours
-# Initialize lists to store net cashflow data for each hour
-net_cashflow_data = defaultdict(list)
-
-# Collect net cashflow data for each broker and each hour
-for broker in brokers:
-    for hour, net_cashflow in broker.hashmap.items():
-        net_cashflow_data[hour].append(net_cashflow)
-
-# Convert the net cashflow data to a DataFrame
-net_cashflow_df = pl.DataFrame({
-    "hour": list(net_cashflow_data.keys()),
-    "net_cashflow": [sum(values) / len(values) for values in net_cashflow_data.values()],
-    "std_dev": [pl.Series(values).std() for values in net_cashflow_data.values()]
-})
-
-# Convert UTC hours to ET (UTC-5)
-net_cashflow_df = net_cashflow_df.with_columns(
-    (pl.col("hour").str.slice(0, 2).cast(pl.Int32) - 5).alias("hour_ET")
-)
-
-# Initialize lists to store end-of-day net cashflow data for each hour
-eod_net_cashflow_data = defaultdict(list)
-
-# Collect end-of-day net cashflow data for each broker and each hour
-for broker in brokers:
-    for hour, net_cashflow in broker.eod_hashmap.items():
-        eod_net_cashflow_data[hour].append(net_cashflow)
+# aggregation.summarize gives mean, std, min/max and quantiles across brokers for every hour straight
+# from the pool matrices (use aggregation.StreamingSummary when the brokers don't fit in memory)
+def cashflow_summary(matrix):
+    return summarize(matrix, brokers.keys).rename({"bucket": "hour", "mean": "net_cashflow", "std": "std_dev"}).with_columns(
+        pl.col("hour").replace_strict(hour_et, return_dtype=pl.Float64).alias("hour_ET") # bucket start in ET (UTC-5)
+    )
 
-# Convert the end-of-day net cashflow data to a DataFrame
-eod_net_cashflow_df = pl.DataFrame({
-    "hour": list(eod_net_cashflow_data.keys()),
-    "net_cashflow": [sum(values) / len(values) for values in eod_net_cashflow_data.values()],
-    "std_dev": [pl.Series(values).std() for values in eod_net_cashflow_data.values()]
-})
 
-# Convert UTC hours to ET (UTC-5)
-eod_net_cashflow_df = eod_net_cashflow_df.with_columns(
-    (pl.col("hour").str.slice(0, 2).cast(pl.Int32) - 5).alias("hour_ET")
-)
+net_cashflow_df = cashflow_summary(brokers.net)
+eod_net_cashflow_df = cashflow_summary(brokers.eod)
 
 # Plot the average net cashflow for both hashmaps as side-by-side vertical bars
 fig = go.Figure()
@@ -289,6 +237,10 @@ fig.add_trace(go.Bar(
     marker_color='orange'
 ))
 
+if replications:
+    fig.add_trace(ensemble_trace("net_cashflow", f'With Settlement Choice ({replications}-run mean, 95% band)', 'navy'))
+    fig.add_trace(ensemble_trace("eod_net_cashflow", f'Default EOD Settlement ({replications}-run mean, 95% band)', 'darkorange'))
+
 fig.update_layout(
     title='Average Net Cashflow by Hour (ET)',
     xaxis_title='Hour (ET)',
@@ -313,6 +265,33 @@ fig.update_layout(
 fig.write_image("/Users/samuelho/bernoulli/settlement_det/net_cashflow_comparison.png")
 
 
+# Distribution of the net cashflow across brokers per hour: boxes from the quantiles (5%-95% whiskers)
+fig = go.Figure()
+
+for summary, label, color in ((net_cashflow_df, 'With Settlement Choice', 'blue'),
+                              (eod_net_cashflow_df, 'Default EOD Settlement', 'orange')):
+    fig.add_trace(go.Box(
+        x=summary["hour_ET"],
+        q1=summary["q25"], median=summary["q50"], q3=summary["q75"],
+        lowerfence=summary["q5"], upperfence=summary["q95"],
+        mean=summary["net_cashflow"], sd=summary["std_dev"],
+        name=label,
+        marker_color=color
+    ))
+
+fig.update_layout(
+    title='Net Cashflow Distribution Across Brokers by Hour (ET)',
+    xaxis_title='Hour (ET)',
+    yaxis_title='Net Cashflow',
+    boxmode='group',
+    autosize=False,
+    width=1280,
+    height=800
+)
+
+fig.write_image("/Users/samuelho/bernoulli/settlement_det/net_cashflow_distribution.png")
+
+
 
 """
 Let us consider a broker-dealer. They receive orders from their clients, and are trying to keep net cash flow as close to 0 as possible (any cashflow can be netted, since we are working with a cash pool-based blockchain - we are not working with multiple custodian banks to have to net individually).
@@ -0,0 +1,185 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+import polars as pl
+
+import profiling
+from broker import STATE_MATRICES, Broker, BrokerPool
+from checkpoint import Checkpoint, orders_fingerprint
+from grid import HOURLY, SettlementGrid
+
+# order columns shipped to the workers through shared memory, in this order
+ORDER_COLUMNS = (("slot", np.int32), ("is_ask", np.bool_), ("notional", np.float64))
+
+# set once per worker process by _attach_orders
+_orders = None
+_segments = []
+
+
+def order_columns(df: pl.DataFrame, grid: SettlementGrid = None):
+    """slot / is_ask / notional arrays for the preprocessed orders, the only inputs netting needs"""
+    grid = grid if grid is not None else HOURLY
+    return {
+        "slot": grid.slots_of(df['ts_event']).astype(np.int32),
+        "is_ask": (df['side'] == 'A').to_numpy(),
+        "notional": (df['price'] * df['size']).to_numpy(),
+    }
+
+
+def _attach_orders(names, num_orders):
+    global _orders, _segments
+    _orders = {}
+    _segments = []
+    for (column, dtype), name in zip(ORDER_COLUMNS, names):
+        segment = shared_memory.SharedMemory(name=name)
+        _segments.append(segment)
+        _orders[column] = np.ndarray((num_orders,), dtype=dtype, buffer=segment.buf)
+
+
+@contextmanager
+def order_pool(columns, workers):
+    """
+    Process pool whose workers see `columns` through shared memory (as simulation._orders)
+
+    Workers only touch numpy, so the pool forks where it can. That keeps it safe with polars
+    and avoids re-running the calling script, which spawn would do.
+    """
+    num_orders = len(columns["slot"])
+    segments = []
+    try:
+        for column, dtype in ORDER_COLUMNS:
+            segment = shared_memory.SharedMemory(create=True, size=max(num_orders * np.dtype(dtype).itemsize, 1))
+            segments.append(segment)
+            np.ndarray((num_orders,), dtype=dtype, buffer=segment.buf)[:] = columns[column]
+        names = [segment.name for segment in segments]
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_attach_orders, initargs=(names, num_orders)) as pool:
+            yield pool
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+
+def shuffle_orders(num_orders, entropy, key=()):
+    """Order permutation for one run, drawn from its own child seed"""
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=key + (0,)))
+    return rng.permutation(num_orders)
+
+
+def net_brokers(pool, start, stop, slots, is_ask, notionals, chunk_size, entropy, key=(), offset=0):
+    """
+    Net brokers [start, stop) into pool rows [start - offset, stop - offset)
+
+    The order arrays are already shuffled, broker i owns orders [i * chunk_size, (i + 1) * chunk_size).
+    Each broker's generator comes from SeedSequence(entropy, spawn_key=key + (1, broker_id)), so
+    its draws don't depend on which worker runs it.
+    """
+    for broker_id in range(start, stop):
+        orders = slice(broker_id * chunk_size, (broker_id + 1) * chunk_size)
+        seed = np.random.SeedSequence(entropy, spawn_key=key + (1, broker_id))
+        broker = Broker(client_orders=None, seed=seed, pool=pool, index=broker_id - offset)
+        broker.net_slots(slots[orders], is_ask[orders], notionals[orders])
+
+
+def _simulate_range(start, stop, chunk_size, entropy, grid):
+    # worker side of simulate_brokers, _orders already holds the shuffled orders
+    pool = BrokerPool(stop - start, grid)
+    net_brokers(pool, start, stop, _orders["slot"], _orders["is_ask"], _orders["notional"],
+                chunk_size, entropy, offset=start)
+    return start, pool
+
+
+def simulate_brokers(df: pl.DataFrame, num_brokers: int, workers=None, seed=None, grid: SettlementGrid = None,
+                     on_batch=None, checkpoint: Checkpoint = None):
+    """
+    Shuffle the client orders, split them evenly across brokers and run netting + EOD netting for each
+
+    Parameters:
+    - df: preprocessed orders with ts_event, side, price and size columns, or their
+      order_columns() arrays (e.g. MBODay.order_columns from the MBO store)
+    - num_brokers: number of brokers to split the orders across
+    - workers: number of worker processes (defaults to the number of cores, 1 runs in-process)
+    - seed: seed for the shuffle and for every broker's settlement draws
+    - grid: settlement buckets (hourly 14:00-22:00 UTC by default)
+    - on_batch: optional callback(start, part) called in broker order as each batch of brokers
+      finishes netting, part being a BrokerPool holding brokers [start, start + len(part)).
+      EOD netting isn't filled in yet at that point.
+    - checkpoint: optional checkpoint.Checkpoint written as batches finish. If it holds an
+      earlier run with the same orders and settings, the brokers that run finished are restored
+      instead of netted again (on_batch still sees them, in order).
+
+    Returns: BrokerPool with one row per broker (client_orders are not kept). The result is
+    the same for a given seed no matter how many workers are used.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+
+    source = df if isinstance(df, dict) else order_columns(df, grid)
+    total = len(source["slot"])
+    if checkpoint is not None:
+        settings = {
+            "num_brokers": num_brokers,
+            "seed": int(seed) if isinstance(seed, (int, np.integer)) else None,
+            "grid": (grid if grid is not None else HOURLY).boundaries.tolist(),
+            "orders": orders_fingerprint({name: source[name] for name, _ in ORDER_COLUMNS}),
+        }
+        entropy = checkpoint.open(settings, entropy)
+    with profiling.stage("allocation", rows_in=total, brokers=num_brokers) as span:
+        chunk_size = total // num_brokers
+        num_orders = chunk_size * num_brokers
+        order = shuffle_orders(total, entropy)[:num_orders]
+        columns = {name: values[order] for name, values in source.items()}
+        span.rows_out = num_orders
+
+    workers = workers or os.cpu_count()
+    batch = max(1, num_brokers // (workers * 4))
+    ranges = [(start, min(start + batch, num_brokers)) for start in range(0, num_brokers, batch)]
+
+    merged = BrokerPool(num_brokers, grid)
+    done = checkpoint.restore(merged) if checkpoint is not None else np.zeros(num_brokers, dtype=bool)
+    # a batch is only skipped if every broker in it was restored, so resuming with another
+    # number of workers just nets a few finished brokers again (to the same result)
+    todo = [(start, stop) for start, stop in ranges if not done[start:stop].all()]
+    with ExitStack() as stack:
+        span = stack.enter_context(profiling.stage("netting", rows_in=num_orders, brokers=num_brokers, workers=workers))
+        if workers == 1 or not todo:
+            global _orders
+            _orders = columns
+            parts = (_simulate_range(start, stop, chunk_size, entropy, grid) for start, stop in todo)
+        else:
+            pool = stack.enter_context(order_pool(columns, workers))
+            parts = pool.map(_simulate_range, *zip(*todo),
+                             [chunk_size] * len(todo), [entropy] * len(todo), [grid] * len(todo))
+
+        # stitch the results back together in broker order as they come in
+        for start, stop in ranges:
+            if done[start:stop].all():
+                part = merged.rows(start, stop)
+            else:
+                _, part = next(parts)
+                for matrix in STATE_MATRICES:
+                    getattr(merged, matrix)[start:stop] = getattr(part, matrix)
+                merged.dirty[start:stop] = True
+                done[start:stop] = True
+                profiling.record_netting(span, part.counters, start)
+            if on_batch is not None:
+                on_batch(start, part)
+            if checkpoint is not None:
+                checkpoint.write(merged, done)
+        if checkpoint is not None:
+            checkpoint.write(merged, done, force=True)
+        span.rows_out = num_brokers
+
+    # EOD netting doesn't depend on the draws, so it runs once over every broker's orders here
+    with profiling.stage("eod_netting", rows_in=num_orders, brokers=num_brokers) as span:
+        broker_ids = np.arange(num_orders) // max(chunk_size, 1)
+        merged.eod_netting_arrays(broker_ids, columns["slot"], columns["is_ask"], columns["notional"])
+        span.rows_out = num_brokers
+    return merged
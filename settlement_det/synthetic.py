@@ -0,0 +1,255 @@
+import itertools
+import os
+
+import numpy as np
+
+from grid import NS_PER_SECOND, _time_of_day
+
+# action codes of the generated events, their index is the code used internally
+ACTIONS = ("A", "M", "C", "F", "T")
+SIDES = ("B", "A", "N")
+ADD, MODIFY, CANCEL, FILL, TRADE = range(len(ACTIONS))
+BID, ASK, NONE = range(len(SIDES))
+
+TICK = 0.01
+
+# average number of events an order produces with the default lifecycle settings, used to turn
+# a row target into an order count (A + modifies + C or F(+T))
+_EVENTS_PER_ORDER = {True: 1 + 3.0 + 0.85 + 0.10 * 2, False: 1 + 0.3 + 0.35 + 0.45 * 2}
+
+
+class SyntheticMBO():
+    """
+    Vectorized generator of databento-shaped MBO streams, as chunked Arrow record batches
+
+    Every order goes through a lifecycle: an add (A), a number of modifies (M), then a cancel
+    (C) or a trade (T, aggressor side, order_id 0) and fill (F) on the resting order - or it just
+    rests until the close. A share of orders behave like market makers: short-lived, quoted close
+    to the mid, requoted (modified) several times and mostly cancelled, so MarketMakerClassifier
+    flags them. Orders arrive with U-shaped intraday seasonality (busy open and close) around a
+    per-instrument random-walk mid price.
+
+    The session is cut into windows of equal expected order flow. Each window draws its orders in
+    one vectorized pass; events falling past the window's end are carried over to the next one,
+    so batches come out in ts_event order and memory stays at roughly one window, however many
+    rows the day has.
+
+    Parameters:
+    - rows: approximate number of events in the day
+    - date: "YYYY-MM-DD" of the generated day
+    - instruments: instrument_ids, orders are spread evenly across them
+    - seed: seed for everything; the stream is fixed by (rows, seed, chunk_rows)
+    - chunk_rows: approximate rows per batch
+    - mm_share: share of orders that behave like market makers
+    - start, end: session (UTC time of day) orders arrive and live in, the settlement grid by default
+    - price: starting mid price of every instrument
+    - volatility: daily volatility of the mid (log terms)
+    - seasonality: how much busier the open and close are than midday (intensity multiplier - 1)
+    """
+
+    def __init__(self, rows: int = 1_000_000, date: str = "2024-12-06", instruments=(1,), seed: int = 0,
+                 chunk_rows: int = 1_000_000, mm_share: float = 0.3, start: str = "14:00", end: str = "22:00",
+                 price: float = 170.0, volatility: float = 0.02, seasonality: float = 2.0):
+        self.rows = rows
+        self.date = date
+        self.instruments = np.asarray(instruments, dtype=np.int64)
+        self.seed = seed
+        self.chunk_rows = chunk_rows
+        self.mm_share = mm_share
+        self.price = price
+        self.volatility = volatility
+        self.seasonality = seasonality
+
+        self.day = np.datetime64(date, "ns").astype(np.int64)
+        self.start = self.day + _time_of_day(start)
+        self.end = self.day + _time_of_day(end)
+
+        events_per_order = mm_share * _EVENTS_PER_ORDER[True] + (1 - mm_share) * _EVENTS_PER_ORDER[False]
+        self.num_orders = int(rows / events_per_order)
+        self.num_windows = max(1, -(-rows // chunk_rows))
+
+        # cumulative intensity on a one-second grid over the session, for inverse-CDF arrival times
+        seconds = np.arange(0, (self.end - self.start) // NS_PER_SECOND + 1)
+        position = 2 * seconds / max(seconds[-1], 1) - 1
+        intensity = 1 + seasonality * position ** 2
+        self._cumulative = np.concatenate([[0.0], np.cumsum((intensity[1:] + intensity[:-1]) / 2)])
+        self._cumulative /= self._cumulative[-1]
+        self._seconds = seconds
+
+    def _mid_paths(self):
+        # per-instrument random-walk mid, one point per second of the session
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(0,)))
+        steps = rng.normal(0, self.volatility / np.sqrt(len(self._seconds)), (len(self.instruments), len(self._seconds)))
+        return self.price * np.exp(np.cumsum(steps, axis=1))
+
+    def _arrival_times(self, rng, count, window):
+        # inverse CDF of the seasonal intensity, restricted to this window's share of it
+        lower, upper = window / self.num_windows, (window + 1) / self.num_windows
+        seconds = np.interp(rng.uniform(lower, upper, count), self._cumulative, self._seconds)
+        return np.sort(self.start + (seconds * NS_PER_SECOND).astype(np.int64))
+
+    def _window_events(self, window, mids, next_order_id):
+        """Every event of the orders arriving in one window, as a dict of numpy columns (unsorted)"""
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(1, window)))
+        count = rng.poisson(self.num_orders / self.num_windows)
+
+        added = self._arrival_times(rng, count, window)
+        is_mm = rng.random(count) < self.mm_share
+        is_ask = rng.random(count) < 0.5
+        instrument = rng.integers(0, len(self.instruments), count)
+        order_ids = np.arange(next_order_id, next_order_id + count, dtype=np.uint64)
+
+        # lifetimes: market makers requote within seconds, other orders rest for minutes,
+        # and nothing outlives the session
+        lifetime = rng.exponential(np.where(is_mm, 2.0, 120.0)) * NS_PER_SECOND
+        ended = np.minimum(added + lifetime.astype(np.int64), self.end - 1)
+        num_modifies = rng.poisson(np.where(is_mm, 3.0, 0.3))
+
+        # terminal: 0 rests until the close, 1 cancel, 2 trade + fill
+        terminal_draw = rng.random(count)
+        terminal = np.where(
+            is_mm,
+            np.where(terminal_draw < 0.85, 1, np.where(terminal_draw < 0.95, 2, 0)),
+            np.where(terminal_draw < 0.35, 1, np.where(terminal_draw < 0.80, 2, 0)),
+        )
+        per_order = 1 + num_modifies + (terminal > 0) + (terminal == 2)
+
+        # one row per event: its order and its position in the order's lifecycle
+        order = np.repeat(np.arange(count), per_order)
+        first = np.cumsum(per_order) - per_order
+        position = np.arange(len(order)) - first[order]
+        last = position == per_order[order] - 1
+
+        action = np.full(len(order), MODIFY, dtype=np.int8)
+        action[position == 0] = ADD
+        is_terminal = (terminal[order] > 0) & (position > num_modifies[order])
+        action[is_terminal & (terminal[order] == 1)] = CANCEL
+        action[is_terminal & (terminal[order] == 2) & ~last] = TRADE
+        action[is_terminal & (terminal[order] == 2) & last] = FILL
+
+        # modifies spread through the lifetime, each in its own slot so they stay in order;
+        # the add at the start, cancel / trade / fill at the end
+        span = ended[order] - added[order]
+        slot = (position - 1 + rng.random(len(order))) / (num_modifies[order] + 1)
+        ts_event = added[order] + (np.where(action == MODIFY, slot, 0.0) * span).astype(np.int64)
+        ts_event = np.where(is_terminal, ended[order], ts_event)
+
+        # quotes sit a geometric number of ticks behind the mid at the time - closer for market makers
+        second = np.clip((ts_event - self.start) // NS_PER_SECOND, 0, len(self._seconds) - 1)
+        mid = mids[instrument[order], second]
+        ticks_away = rng.geometric(np.where(is_mm[order], 0.5, 0.1)) - 1
+        side_sign = np.where(is_ask[order], 1.0, -1.0)
+        price = np.round(mid / TICK + side_sign * (ticks_away + 0.5)) * TICK
+
+        lots = np.where(is_mm, rng.integers(1, 5, count) * 100, np.maximum(1, rng.lognormal(4, 1.2, count)).astype(np.int64))
+        size = lots[order] + np.where(action == MODIFY, rng.integers(-1, 2, len(order)) * lots[order] // 4, 0)
+        size = np.maximum(size, 1)
+
+        # cancel / trade / fill carry the order's last quoted price and size
+        trade = np.flatnonzero(action == TRADE)
+        closing = np.flatnonzero((action == CANCEL) | (action == TRADE))
+        price[closing], size[closing] = price[closing - 1], size[closing - 1]
+        fill = np.flatnonzero(action == FILL)
+        price[fill], size[fill] = price[fill - 1], size[fill - 1]
+
+        side = np.where(is_ask[order], ASK, BID).astype(np.int8)
+        # the trade is reported on the aggressor's side (sometimes unknown), with order_id 0
+        side[trade] = np.where(rng.random(len(trade)) < 0.1, NONE, np.where(is_ask[order[trade]], BID, ASK))
+        event_order_ids = order_ids[order]
+        event_order_ids[trade] = 0
+
+        return {
+            "ts_event": ts_event,
+            "instrument_id": self.instruments[instrument[order]],
+            "action": action,
+            "side": side,
+            "price": np.round(price * 1e9).astype(np.int64),
+            "size": size.astype(np.uint32),
+            "order_id": event_order_ids,
+        }, next_order_id + count
+
+    def columns(self):
+        """Yield batches as dicts of numpy columns in ts_event order (action / side as codes into ACTIONS / SIDES)"""
+        mids = self._mid_paths()
+        latency = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(2,)))
+        pending = None
+        next_order_id = 1
+        sequence = 0
+        for window in range(self.num_windows):
+            events, next_order_id = self._window_events(window, mids, next_order_id)
+            if pending is not None:
+                events = {name: np.concatenate([pending[name], events[name]]) for name in events}
+
+            # a stable sort keeps each order's trade before its fill at the same timestamp
+            ordering = np.argsort(events["ts_event"], kind="stable")
+            events = {name: values[ordering] for name, values in events.items()}
+            if window < self.num_windows - 1:
+                # everything after the next window's first arrival can still get events before it
+                horizon = self.start + int(np.interp((window + 1) / self.num_windows, self._cumulative,
+                                                     self._seconds) * NS_PER_SECOND)
+                cut = np.searchsorted(events["ts_event"], horizon)
+                pending = {name: values[cut:] for name, values in events.items()}
+                events = {name: values[:cut] for name, values in events.items()}
+
+            count = len(events["ts_event"])
+            events["ts_recv"] = events["ts_event"] + latency.exponential(20_000, count).astype(np.int64)
+            events["sequence"] = np.arange(sequence, sequence + count, dtype=np.uint32)
+            sequence += count
+            yield events
+
+    def batches(self):
+        """Yield pyarrow RecordBatches in databento MBO column layout (fixed-precision int64 prices)"""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        actions, sides = pa.array(ACTIONS), pa.array(SIDES)
+        timestamp = pa.timestamp("ns", tz="UTC")
+        for events in self.columns():
+            yield pa.record_batch({
+                "ts_recv": pa.array(events["ts_recv"]).cast(timestamp),
+                "ts_event": pa.array(events["ts_event"]).cast(timestamp),
+                "instrument_id": pa.array(events["instrument_id"].astype(np.uint32)),
+                "action": pc.take(actions, pa.array(events["action"])),
+                "side": pc.take(sides, pa.array(events["side"])),
+                "price": pa.array(events["price"]),
+                "size": pa.array(events["size"]),
+                "order_id": pa.array(events["order_id"]),
+                "sequence": pa.array(events["sequence"]),
+            })
+
+    def frames(self):
+        """Yield the batches as polars DataFrames"""
+        import polars as pl
+
+        for batch in self.batches():
+            yield pl.from_arrow(batch)
+
+    def write(self, path):
+        """Stream the day to a .parquet, .arrow / .ipc or .csv file, one batch at a time; returns rows written"""
+        import pyarrow as pa
+
+        extension = os.path.splitext(str(path))[1].lower()
+        batches = self.batches()
+        first = next(batches)
+        if extension == ".parquet":
+            import pyarrow.parquet as pq
+
+            writer = pq.ParquetWriter(path, first.schema)
+            write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+        elif extension in (".arrow", ".ipc", ".feather"):
+            writer = pa.ipc.new_file(path, first.schema)
+            write = writer.write_batch
+        elif extension == ".csv":
+            import pyarrow.csv as csv
+
+            writer = csv.CSVWriter(path, first.schema)
+            write = writer.write_batch
+        else:
+            raise ValueError(f"unknown MBO file type {extension}, use .parquet, .arrow or .csv")
+
+        rows = 0
+        with writer:
+            for batch in itertools.chain([first], batches):
+                write(batch)
+                rows += batch.num_rows
+        return rows